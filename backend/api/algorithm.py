@@ -1,3 +1,7 @@
+import heapq
+from operator import itemgetter
+
+
 def quicksort_routes(routes):
     try:
         if not isinstance(routes, list):
@@ -27,3 +31,25 @@ def quicksort_routes(routes):
 
     except Exception as e:
         raise Exception(f"Algorithm error: {str(e)}")
+
+
+# TOP-K RANKING
+# heapq.nlargest keeps a bounded heap of the k best routes seen so far and
+# compares each new route with the weakest of them only: O(n log k) time
+# and O(k) memory over a stream of n routes, without copying the input.
+
+RANKING_METRICS = ("trip_count", "avg_fare", "avg_speed", "revenue")
+
+def top_k_routes(routes, k, metric="trip_count"):
+    """The k routes with the highest metric, best first.
+
+    routes is any iterable of mappings (dicts or sqlite3.Row) and is read
+    once. Ties keep the input order: of two routes with the same value, the
+    one seen first ranks higher, as in a stable sort. Routes whose metric
+    is None are skipped.
+    """
+    if metric not in RANKING_METRICS:
+        raise ValueError(f"metric must be one of {', '.join(RANKING_METRICS)}")
+    if k <= 0:
+        return []
+    return heapq.nlargest(k, (route for route in routes if route[metric] is not None), key=itemgetter(metric))
@@ -1,20 +1,64 @@
-from flask import Flask, jsonify
+from flask import Flask, Response, jsonify, request
 from flask_cors import CORS
+from werkzeug.exceptions import HTTPException
 from routes.trips import trips_bp
 from routes.stats import stats_bp
 from routes.zones import zones_bp
+from cache import cache_stats
+from database import pool_stats
+from json_provider import RowJSONProvider
+import metrics
 
 app = Flask(__name__)
+app.json = RowJSONProvider(app)
 CORS(app)
 
 app.register_blueprint(trips_bp, url_prefix="/api/trips")
 app.register_blueprint(stats_bp, url_prefix="/api/stats")
 app.register_blueprint(zones_bp, url_prefix="/api/zones")
 
+@app.before_request
+def start_request_metrics():
+    metrics.start_request()
+
+@app.after_request
+def record_request_metrics(response):
+    metrics.finish_request(request, response)
+    return response
+
 @app.route("/")
 def home():
     return {"message": "NYC Taxi API Running"}
 
+@app.route("/api/pool")
+def pool():
+    """Connection pool checkout metrics"""
+    return jsonify(pool_stats())
+
+@app.route("/api/cache")
+def cache():
+    """Response cache hit/miss metrics"""
+    return jsonify(cache_stats())
+
+@app.route("/api/metrics")
+def prometheus_metrics():
+    """Request, SQL and serialization metrics in the Prometheus text format"""
+    pool = pool_stats()
+    cache = cache_stats()
+    gauges = {
+        "taxi_api_pool_in_use": ("Connections checked out of the pool", pool["in_use"]),
+        "taxi_api_pool_idle": ("Idle pooled connections", pool["idle"]),
+        "taxi_api_cache_bytes": ("Bytes held by the response cache", cache["bytes"]),
+        "taxi_api_cache_entries": ("Responses held by the response cache", cache["entries"]),
+    }
+    counters = {
+        "taxi_api_pool_checkouts_total": ("Connection checkouts since start", pool["checkouts"]),
+        "taxi_api_pool_opened_total": ("Connections opened since start", pool["opened"]),
+        "taxi_api_cache_hits_total": ("Response cache hits since start", cache["hits"]),
+        "taxi_api_cache_misses_total": ("Response cache misses since start", cache["misses"]),
+    }
+    return Response(metrics.render(gauges, counters), mimetype="text/plain; version=0.0.4")
+
 @app.errorhandler(400)
 def bad_request(e):
     return jsonify({"error": "Bad Request", "details": str(e)}), 400
@@ -29,6 +73,9 @@ def server_error(e):
 
 @app.errorhandler(Exception)
 def handle_exception(e):
+    if not isinstance(e, HTTPException):
+        app.logger.exception("Unhandled error in %s %s", request.method, request.path)
+        metrics.record_exception(request)
     return jsonify({"error": "Unexpected Error", "details": str(e)}), 500
 
 if __name__ == "__main__":
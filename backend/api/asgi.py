@@ -0,0 +1,243 @@
+import asyncio
+import contextvars
+import io
+import json
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app as flask_app
+from cache import cached_reply
+from database import POOL_SIZE, data_version
+
+
+# ASGI SERVING
+# Production entry point: run with any ASGI server, e.g.
+#   uvicorn asgi:application --host 0.0.0.0 --port 5000
+# The event loop only accepts connections and moves bytes. Flask views,
+# and with them every SQLite call, run on a bounded pool of worker
+# threads, one pooled read-only connection each. Stats that are already
+# in the result cache (or unchanged for the client, a 304) are answered on
+# the loop without taking a worker.
+
+WORKER_THREADS = POOL_SIZE
+# Requests running or queued for a worker before new ones get a 503
+MAX_PENDING_REQUESTS = 256
+# Time a view gets to produce its response (not to stream the body)
+REQUEST_TIMEOUT_SECONDS = 30
+CACHED_PATH_PREFIX = "/api/stats/"
+
+def error_body(message):
+    return json.dumps({"error": message}).encode("utf-8")
+
+def wsgi_environ(scope, body):
+    """WSGI environ for an ASGI http scope (PEP 3333 from the ASGI spec)"""
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = "HTTP_" + name
+        environ[name] = f"{environ[name]},{value}" if name in environ else value
+    return environ
+
+def start_wsgi(wsgi_app, environ):
+    """Call the WSGI app up to its response headers; returns (status, headers, body iterator)"""
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"] = int(status.split(" ", 1)[0])
+        started["headers"] = headers
+
+    body = wsgi_app(environ, start_response)
+    return started["status"], started["headers"], iter(body)
+
+def close_body(chunks):
+    close = getattr(chunks, "close", None)
+    if close:
+        close()
+
+class ASGIApp:
+    """ASGI adapter for the Flask app with a bounded SQLite thread pool.
+
+    At most max_pending requests may be running or queued for the
+    workers; past that a request is turned away with a 503 at once rather
+    than queueing without bound. A view that has not responded within
+    timeout seconds gets a 504. Its thread still runs to completion, and
+    it keeps counting as pending until it does, so slow queries apply
+    backpressure instead of piling up. A streamed body counts as pending
+    until it has been sent or closed.
+    """
+
+    def __init__(self, wsgi_app, workers=WORKER_THREADS, max_pending=MAX_PENDING_REQUESTS,
+                 timeout=REQUEST_TIMEOUT_SECONDS):
+        self.wsgi_app = wsgi_app
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sqlite")
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.stats = {
+            "requests": 0,
+            "served_on_loop": 0,
+            "rejected": 0,
+            "timed_out": 0,
+            "peak_pending": 0,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def http(self, scope, receive, send):
+        self.stats["requests"] += 1
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        environ = wsgi_environ(scope, body)
+
+        cached = self.cached_response(environ)
+        if cached is not None:
+            self.stats["served_on_loop"] += 1
+            status, headers, body = cached
+            await self.send_response(send, status, headers, [body])
+            return
+
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.stats["rejected"] += 1
+                rejected = True
+            else:
+                self.pending += 1
+                self.stats["peak_pending"] = max(self.stats["peak_pending"], self.pending)
+                rejected = False
+        if rejected:
+            await self.send_error(send, 503, "Server busy, retry shortly", [("Retry-After", "1")])
+            return
+
+        # Every step of one request runs in the same copied context, so
+        # Flask's request context survives hopping between worker threads
+        # while a streamed body is produced.
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        # finish_late is attached to the executor's own future, so it runs
+        # on the worker thread even if the loop has moved on or stopped
+        work = self.executor.submit(context.run, start_wsgi, self.wsgi_app, environ)
+        try:
+            status, headers, chunks = await asyncio.wait_for(asyncio.wrap_future(work), self.timeout)
+        except asyncio.TimeoutError:
+            self.stats["timed_out"] += 1
+            work.add_done_callback(lambda done: self.finish_late(done, context))
+            await self.send_error(send, 504, "Request timed out")
+            return
+        except BaseException:
+            work.add_done_callback(lambda done: self.finish_late(done, context))
+            raise
+
+        # The request stays pending until its body is exhausted or closed,
+        # so long streamed exports count against max_pending too.
+        try:
+            await self.send_response(send, status, headers, self.worker_chunks(loop, context, chunks))
+        finally:
+            await loop.run_in_executor(self.executor, context.run, close_body, chunks)
+            self.release()
+
+    def release(self):
+        with self.lock:
+            self.pending -= 1
+
+    def finish_late(self, future, context):
+        """Close the body of a response nobody will read, e.g. an export holding a connection"""
+        if not future.cancelled() and future.exception() is None:
+            context.run(close_body, future.result()[2])
+        self.release()
+
+    def cached_response(self, environ):
+        """(status, headers, body) of a cached stats response or 304, or None.
+
+        Only runs when the data version is known without a query, so it
+        never blocks the loop on SQLite, and only for a path that matches
+        a route. cached_reply answers only requests whose exact URL has a
+        cached 200, so invalid parameters still reach the view.
+        """
+        if environ["REQUEST_METHOD"] != "GET" or not environ["PATH_INFO"].startswith(CACHED_PATH_PREFIX):
+            return None
+        version = data_version(read=False)
+        if version is None:
+            return None
+
+        with self.wsgi_app.request_context(environ) as context:
+            if context.request.routing_exception is not None:
+                return None
+            # before_request hooks, e.g. starting the request metrics
+            self.wsgi_app.preprocess_request()
+            try:
+                response = cached_reply(version)
+            except ValueError:
+                return None
+            if response is None:
+                return None
+            # after_request hooks, e.g. the CORS headers
+            response = self.wsgi_app.process_response(response)
+            return response.status_code, response.headers.to_wsgi_list(), response.get_data()
+
+    async def worker_chunks(self, loop, context, chunks):
+        """Body chunks of a WSGI response, each pulled on a worker thread; http closes the body"""
+        while True:
+            chunk = await loop.run_in_executor(self.executor, context.run, next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    async def send_response(self, send, status, headers, chunks):
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers],
+        })
+        if hasattr(chunks, "__aiter__"):
+            async for chunk in chunks:
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        else:
+            for chunk in chunks:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def send_error(self, send, status, message, headers=()):
+        headers = [("Content-Type", "application/json")] + list(headers)
+        await self.send_response(send, status, headers, [error_body(message)])
+
+application = ASGIApp(flask_app)
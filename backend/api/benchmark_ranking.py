@@ -0,0 +1,52 @@
+import argparse
+import random
+import sys
+import time
+
+from algorithm import quicksort_routes, top_k_routes
+
+
+# RANKING BENCHMARK
+# Times picking the top k of n candidate routes: quicksort_routes over the
+# whole list, then a slice, against the bounded heap in top_k_routes.
+# Trip counts are skewed like real route volumes, so there are many ties.
+
+def make_routes(num_routes, seed=42):
+    rng = random.Random(seed)
+    return [
+        {
+            "route": f"Route {i}",
+            "trip_count": int(rng.paretovariate(1.2) * 10),
+            "avg_fare": round(rng.uniform(5, 80), 2),
+        }
+        for i in range(num_routes)
+    ]
+
+
+def best_of(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark top-k route ranking")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--k", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    # Heavily tied counts make quicksort's partitions uneven; give it room.
+    sys.setrecursionlimit(100_000)
+
+    print(f"top {args.k}, best of {args.repeat}")
+    for size in args.sizes:
+        routes = make_routes(size)
+        assert top_k_routes(routes, args.k) == quicksort_routes(routes)[:args.k]
+
+        quicksort = best_of(lambda: quicksort_routes(routes)[:args.k], args.repeat)
+        heap = best_of(lambda: top_k_routes(routes, args.k), args.repeat)
+        print(f"{size:>10,} routes  quicksort {quicksort * 1000:9.1f} ms  heap {heap * 1000:8.1f} ms  {quicksort / heap:5.1f}x")
@@ -0,0 +1,94 @@
+import argparse
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+import json_provider
+
+
+# SERIALIZATION BENCHMARK
+# Times turning a page of trip rows into response JSON: the original path
+# ([dict(row) for row in rows] through Flask's default provider, which
+# sorts keys) against RowJSONProvider, with and without orjson.
+
+def make_rows(num_rows, seed=42):
+    """sqlite3.Row objects shaped like the /api/trips columns"""
+    rng = random.Random(seed)
+    start = datetime(2019, 1, 1)
+    conn = sqlite3.connect(":memory:")
+    conn.row_factory = sqlite3.Row
+    conn.execute("""
+        CREATE TABLE trips (
+            trip_id INTEGER, VendorID INTEGER, tpep_pickup_datetime TEXT, tpep_dropoff_datetime TEXT,
+            pickup_date TEXT, pickup_hour INTEGER, pickup_weekday INTEGER, passenger_count INTEGER,
+            trip_distance FLOAT, fare_amount FLOAT, tip_amount FLOAT, total_amount FLOAT,
+            trip_speed_mph FLOAT, tip_percentage FLOAT, time_category TEXT,
+            pickup_borough TEXT, pickup_zone TEXT, dropoff_borough TEXT, dropoff_zone TEXT
+        )
+    """)
+
+    rows = []
+    for trip_id in range(1, num_rows + 1):
+        pickup = start + timedelta(seconds=rng.randint(0, 31 * 86400 - 7200))
+        distance = round(rng.uniform(0.2, 15), 2)
+        minutes = rng.randint(3, 60)
+        fare = round(2.5 + distance * 2.5, 2)
+        tip = round(fare * rng.choice([0, 0.15, 0.2]), 2)
+        rows.append((
+            trip_id, rng.choice([1, 2]), pickup.strftime("%Y-%m-%d %H:%M:%S"),
+            (pickup + timedelta(minutes=minutes)).strftime("%Y-%m-%d %H:%M:%S"),
+            pickup.strftime("%Y-%m-%d"), pickup.hour, int(pickup.strftime("%w")), rng.randint(1, 4),
+            distance, fare, tip, round(fare + tip + 0.8, 2), round(distance / (minutes / 60), 2),
+            round(tip / fare * 100, 2), rng.choice(["morning_rush", "midday", "night"]),
+            "Manhattan", rng.choice(["Midtown Center", "Upper East Side North"]),
+            rng.choice(["Manhattan", "Queens"]), rng.choice(["JFK Airport", "Midtown Center"]),
+        ))
+    conn.executemany(f"INSERT INTO trips VALUES ({', '.join('?' * 19)})", rows)
+    return conn.execute("SELECT * FROM trips").fetchall()
+
+
+def run_original(provider, rows):
+    return provider.dumps([dict(row) for row in rows], separators=(",", ":"))
+
+
+def run_rows(provider, rows):
+    return provider.dumps(rows)
+
+
+def best_of(func, provider, rows, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(provider, rows)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark per-row JSON serialization")
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    app = Flask(__name__)
+    default_provider = DefaultJSONProvider(app)
+    row_provider = json_provider.RowJSONProvider(app)
+
+    results = [("dicts + default provider", best_of(run_original, default_provider, rows, args.repeat))]
+
+    installed_orjson = json_provider.orjson
+    json_provider.orjson = None
+    results.append(("RowJSONProvider (json)", best_of(run_rows, row_provider, rows, args.repeat)))
+    json_provider.orjson = installed_orjson
+    if installed_orjson is not None:
+        results.append(("RowJSONProvider (orjson)", best_of(run_rows, row_provider, rows, args.repeat)))
+
+    baseline = results[0][1]
+    print(f"{args.rows:,} rows, best of {args.repeat}")
+    for name, seconds in results:
+        print(f"{name:28s} {seconds / args.rows * 1e6:6.2f} us/row  {baseline / seconds:4.1f}x")
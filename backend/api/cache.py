@@ -0,0 +1,184 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timezone
+from functools import wraps
+
+from flask import Response, make_response, request
+
+from database import data_version
+from formats import response_format
+
+
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+CACHE_TTL_SECONDS = 300
+# How long browsers and proxies may reuse a stats response before revalidating
+HTTP_MAX_AGE_SECONDS = 60
+
+CachedResponse = namedtuple("CachedResponse", ["body", "mimetype", "etag", "version", "expires_at"])
+
+class ResultCache:
+    """Serialized response bodies, reused until the data changes or the TTL runs out.
+
+    Entries are kept in least-recently-used order and evicted from the old
+    end once their bodies exceed max_bytes. Each entry records the data
+    version it was computed from; the first lookup that sees a newer
+    version drops every entry.
+    """
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES, ttl=CACHE_TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.version = None
+        self.size = 0
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "expired": 0,
+            "evicted": 0,
+            "invalidated": 0,
+        }
+
+    def drop(self, key):
+        self.size -= len(self.entries.pop(key).body)
+
+    def get(self, key, version, record_miss=True, record_hit=True):
+        with self.lock:
+            if version != self.version:
+                self.stats["invalidated"] += len(self.entries)
+                self.entries.clear()
+                self.size = 0
+                self.version = version
+
+            entry = self.entries.get(key)
+            if entry is not None and entry.expires_at <= time.monotonic():
+                self.drop(key)
+                self.stats["expired"] += 1
+                entry = None
+
+            if entry is None:
+                if record_miss:
+                    self.stats["misses"] += 1
+                return None
+
+            self.entries.move_to_end(key)
+            if record_hit:
+                self.stats["hits"] += 1
+            return entry
+
+    def put(self, key, version, body, mimetype):
+        entry = CachedResponse(body, mimetype, version_etag(key, version), version, time.monotonic() + self.ttl)
+        if len(body) > self.max_bytes:
+            return entry
+
+        with self.lock:
+            if version != self.version:
+                return entry
+            if key in self.entries:
+                self.drop(key)
+            self.entries[key] = entry
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self.drop(next(iter(self.entries)))
+                self.stats["evicted"] += 1
+        return entry
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.version = None
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self.entries)
+            stats["bytes"] = self.size
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+result_cache = ResultCache()
+
+def version_etag(key, version):
+    """ETag for a response, from its cache key and the data version alone.
+
+    A response only changes when the data does, so the tag can be checked
+    against If-None-Match without running the query.
+    """
+    return hashlib.blake2b(repr((key, version)).encode("utf-8"), digest_size=16).hexdigest()
+
+def version_time(version):
+    """When the data version was stamped, for Last-Modified"""
+    updated_at = version[2]
+    if updated_at is None:
+        return None
+    return datetime.strptime(updated_at, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+
+def not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    since = request.if_modified_since
+    return last_modified is not None and since is not None and last_modified <= since
+
+def cache_stats():
+    return result_cache.snapshot()
+
+def cached_reply(version, view=None):
+    """Response to the current request from the data version and result_cache.
+
+    A matching If-None-Match or If-Modified-Since gets a 304 with no query
+    and no re-encoding, but only when this exact request already has a
+    cached 200 body; the validators say nothing about whether the request
+    itself is valid. Otherwise a cached body is sent as stored, or the
+    view is called, and a 200 response is cached and then checked against
+    the validators. With no view, None is returned on a miss. Raises
+    ValueError for an unknown format.
+    """
+    key = (request.path, response_format(), tuple(sorted(request.args.items(multi=True))))
+    etag = version_etag(key, version)
+    last_modified = version_time(version)
+
+    if not_modified(etag, last_modified) and result_cache.get(key, version, False, False) is not None:
+        response = Response(status=304)
+    else:
+        entry = result_cache.get(key, version, record_miss=view is not None)
+        if entry is None:
+            if view is None:
+                return None
+            response = make_response(view())
+            if response.status_code != 200:
+                return response
+            entry = result_cache.put(key, version, response.get_data(), response.mimetype)
+        if not_modified(etag, last_modified):
+            response = Response(status=304)
+        else:
+            response = Response(entry.body, mimetype=entry.mimetype)
+
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = HTTP_MAX_AGE_SECONDS
+    response.vary.add("Accept")
+    return response
+
+def cached_response(view):
+    """Serve a GET endpoint's successful responses through cached_reply.
+
+    The cache key is the path, the query params and the negotiated format,
+    so JSON, Arrow and Parquet bodies are cached separately. Responses
+    carry an ETag and Last-Modified from the data version.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        try:
+            response_format()
+        except ValueError:
+            return view(*args, **kwargs)
+        return cached_reply(data_version(), lambda: view(*args, **kwargs))
+
+    return wrapper
@@ -1,25 +1,252 @@
 import os
 import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
 from functools import lru_cache
 
+from metrics import TimedConnection
+
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 DB_PATH = os.path.join(BASE_DIR, "database", "nyc_taxi.db")
 
-def get_connection():
+DATE_FORMAT = "%Y-%m-%d"
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+PARTITION_TEMPLATE = "trips_template"
+
+POOL_SIZE = 8
+STATEMENT_CACHE_SIZE = 256
+VERSION_CHECK_SECONDS = 1.0
+
+# Applied once when a pooled connection is opened.
+READ_PRAGMAS = [
+    "PRAGMA query_only = ON;",
+    "PRAGMA mmap_size = 268435456;",
+    "PRAGMA cache_size = -65536;",
+    "PRAGMA temp_store = MEMORY;",
+]
+
+def database_identity(path):
+    """(path, device, inode) of the database file; changes when insert_data.py rebuilds it"""
     try:
-        conn = sqlite3.connect(DB_PATH)
+        stat = os.stat(path)
+    except OSError:
+        return (path, None, None)
+    return (path, stat.st_dev, stat.st_ino)
+
+class ConnectionPool:
+    """Warm, read-only SQLite connections shared by the request threads.
+
+    Idle connections are kept on a LIFO stack, so a checkout gets the one
+    used most recently, with the warmest page cache and statement cache.
+    Connections to a database file that has since been replaced are
+    closed instead of reused.
+    """
+
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.idle = []
+        self.identities = {}
+        self.stats = {
+            "checkouts": 0,
+            "reused": 0,
+            "opened": 0,
+            "discarded": 0,
+            "in_use": 0,
+            "peak_in_use": 0,
+            "checkout_seconds": 0.0,
+        }
+
+    def open(self, identity):
+        conn = sqlite3.connect(
+            f"file:{identity[0]}?mode=ro",
+            uri=True,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
+            # Autocommit: a stray write must not leave an idle connection
+            # holding a transaction that blocks insert_data.py.
+            isolation_level=None,
+            factory=TimedConnection,
+        )
         conn.row_factory = sqlite3.Row
+        for pragma in READ_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def discard(self, conn):
+        self.identities.pop(id(conn), None)
+        conn.close()
+        self.stats["discarded"] += 1
+
+    def checkout(self):
+        started = time.perf_counter()
+        identity = database_identity(DB_PATH)
+        conn = None
+
+        with self.lock:
+            while self.idle:
+                candidate = self.idle.pop()
+                if self.identities.get(id(candidate)) == identity:
+                    conn = candidate
+                    self.stats["reused"] += 1
+                    break
+                self.discard(candidate)
+
+        if conn is None:
+            conn = self.open(identity)
+            with self.lock:
+                self.identities[id(conn)] = identity
+                self.stats["opened"] += 1
+
+        with self.lock:
+            self.stats["checkouts"] += 1
+            self.stats["in_use"] += 1
+            self.stats["peak_in_use"] = max(self.stats["peak_in_use"], self.stats["in_use"])
+            self.stats["checkout_seconds"] += time.perf_counter() - started
         return conn
+
+    def release(self, conn):
+        with self.lock:
+            self.stats["in_use"] -= 1
+            if len(self.idle) < self.size and self.identities.get(id(conn)) == database_identity(DB_PATH):
+                self.idle.append(conn)
+            else:
+                self.discard(conn)
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["idle"] = len(self.idle)
+        stats["avg_checkout_ms"] = round(stats["checkout_seconds"] / stats["checkouts"] * 1000, 4) if stats["checkouts"] else 0.0
+        return stats
+
+pool = ConnectionPool()
+
+def get_connection():
+    """Check a read-only connection out of the pool; hand it back with release_connection"""
+    try:
+        return pool.checkout()
     except sqlite3.Error as e:
         raise Exception(f"Database connection failed: {str(e)}")
 
-@lru_cache(maxsize=32)
-def cached_query(query):
+def release_connection(conn):
+    pool.release(conn)
+
+def pool_stats():
+    return pool.snapshot()
+
+@lru_cache(maxsize=4)
+def load_zone_ids(identity):
+    """Zone name -> LocationIDs for one database file (see database_identity)"""
+    zone_map = {}
+    conn = get_connection()
     try:
-        conn = get_connection()
-        rows = conn.execute(query).fetchall()
-        conn.close()
-        return [dict(row) for row in rows]
-    except sqlite3.Error as e:
-        raise Exception(f"Database query error: {str(e)}")
+        for row in conn.execute("SELECT LocationID, Zone FROM zones ORDER BY LocationID"):
+            zone_map.setdefault(row["Zone"], []).append(row["LocationID"])
+    finally:
+        release_connection(conn)
+    return {zone: tuple(ids) for zone, ids in zone_map.items()}
+
+def zone_ids(name):
+    """LocationIDs with this zone name; a few names (e.g. Corona) cover more than one"""
+    return load_zone_ids(database_identity(DB_PATH)).get(name, ())
+
+version_lock = threading.Lock()
+version_state = {"identity": None, "checked_at": 0.0, "version": None}
+
+def data_version(read=True):
+    """(database identity, version, updated_at) stamp of the trip data.
+
+    insert_data.py and fix_dates.py bump the data_version row whenever they
+    change trips. The row is re-read at most every VERSION_CHECK_SECONDS,
+    while a rebuilt database file is noticed at once by its identity. With
+    read=False the database is never queried: None is returned when the
+    stamp is due to be re-read.
+    """
+    identity = database_identity(DB_PATH)
+    now = time.monotonic()
+    with version_lock:
+        if identity == version_state["identity"] and now - version_state["checked_at"] < VERSION_CHECK_SECONDS:
+            return version_state["version"]
+    if not read:
+        return None
+
+    conn = get_connection()
+    try:
+        row = conn.execute("SELECT version, updated_at FROM data_version").fetchone()
+    except sqlite3.OperationalError:
+        # Built before data_version existed
+        row = None
+    finally:
+        release_connection(conn)
+
+    version = (identity,) + (tuple(row) if row else (0, None))
+    with version_lock:
+        version_state.update(identity=identity, checked_at=now, version=version)
+    return version
+
+def date_bounds(start_date=None, end_date=None):
+    """Turn inclusive YYYY-MM-DD query dates into [start, end) datetime strings.
+
+    Raises ValueError if a date is malformed.
+    """
+    start = end = None
+    if start_date:
+        start = datetime.strptime(start_date, DATE_FORMAT).strftime(DATETIME_FORMAT)
+    if end_date:
+        end = (datetime.strptime(end_date, DATE_FORMAT) + timedelta(days=1)).strftime(DATETIME_FORMAT)
+    return start, end
+
+def pickup_filter(start=None, end=None):
+    """WHERE condition and params restricting tpep_pickup_datetime to [start, end)"""
+    conditions, params = ["1=1"], []
+    if start:
+        conditions.append("tpep_pickup_datetime >= ?")
+        params.append(start)
+    if end:
+        conditions.append("tpep_pickup_datetime < ?")
+        params.append(end)
+    return " AND ".join(conditions), params
+
+def pickup_date_filter(start=None, end=None):
+    """pickup_filter for tables keyed by pickup_date ('YYYY-MM-DD')"""
+    conditions, params = ["1=1"], []
+    if start:
+        conditions.append("pickup_date >= ?")
+        params.append(start[:10])
+    if end:
+        conditions.append("pickup_date < ?")
+        params.append(end[:10])
+    return " AND ".join(conditions), params
+
+def trip_partitions(conn, start=None, end=None):
+    """Monthly trip tables overlapping [start, end), oldest first"""
+    query = "SELECT table_name FROM trip_partitions WHERE 1=1"
+    params = []
+    if start:
+        query += " AND end_datetime > ?"
+        params.append(start)
+    if end:
+        query += " AND start_datetime < ?"
+        params.append(end)
+    query += " ORDER BY start_datetime"
+    return [row[0] for row in conn.execute(query, params)]
+
+def trips_source(conn, start=None, end=None):
+    """FROM-clause source reading only the partitions that overlap [start, end)"""
+    tables = trip_partitions(conn, start, end) or [PARTITION_TEMPLATE]
+    if len(tables) == 1:
+        return tables[0]
+    return "(" + " UNION ALL ".join(f"SELECT * FROM {table}" for table in tables) + ")"
+
+def trip_partition_for_id(conn, trip_id):
+    """Partition holding trip_id, from the id range each loaded file recorded"""
+    row = conn.execute("""
+        SELECT p.table_name
+        FROM ingested_files f
+        JOIN trip_partitions p ON p.month = f.month
+        WHERE ? BETWEEN f.first_trip_id AND f.last_trip_id
+    """, (trip_id,)).fetchone()
+    return row[0] if row else None
@@ -0,0 +1,102 @@
+import sqlite3
+
+import numpy as np
+
+
+# DISTRIBUTIONS FROM SKETCHES
+# database/sketches.py defines the sketches and their bucket layout; the
+# API only reads them. A percentile or histogram for any slice adds up the
+# sketches in it, all in one vectorized pass, and reads the answer off the
+# cumulative counts. Each bucket is reported as 2 gamma^i / (gamma + 1),
+# as sketches.py lays them out. gamma is always read from the database,
+# never assumed, so the API decodes whatever the loader wrote.
+
+# The measures sketches.py builds; test_sketch_definitions_match keeps
+# the two lists equal.
+SKETCH_MEASURES = ("fare_amount", "trip_speed_mph", "tip_percentage")
+DEFAULT_QUANTILES = (0.5, 0.9, 0.99)
+
+def stored_sketch_gamma(conn):
+    """gamma the stored sketches were built with, or None if they have not been built.
+
+    Unlike the loader's sketch_gamma, there is no default: without stored
+    sketches there is nothing to decode.
+    """
+    try:
+        row = conn.execute("SELECT gamma FROM sketch_settings").fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return row[0] if row else None
+
+def quantile_name(q):
+    return f"p{q * 100:g}"
+
+def merge_sketches(rows):
+    """Sum sketches into one per group.
+
+    rows are (group, zero_count, min_bucket, counts blob). Returns (groups
+    in first-seen order, zero counts per group, lowest bucket, group x
+    bucket count matrix).
+    """
+    groups = list(dict.fromkeys(row[0] for row in rows))
+    positions = {group: i for i, group in enumerate(groups)}
+    group_index = np.array([positions[row[0]] for row in rows], dtype=np.intp)
+    zero_counts = np.bincount(group_index, weights=[row[1] for row in rows], minlength=len(groups))
+
+    min_buckets = np.array([row[2] for row in rows], dtype=np.int64)
+    lengths = np.array([len(row[3]) // 4 for row in rows], dtype=np.int64)
+    counts = np.frombuffer(b"".join(row[3] for row in rows), dtype="<u4")
+    if not len(counts):
+        return groups, zero_counts, 0, np.zeros((len(groups), 0))
+
+    low = int(min_buckets[lengths > 0].min())
+    width = int((min_buckets + lengths)[lengths > 0].max()) - low
+    # Cell of every stored count in the group x bucket matrix: its position
+    # in the joined blobs, shifted by where its sketch starts in the matrix
+    starts = np.cumsum(lengths) - lengths
+    shifts = group_index * width + (min_buckets - low) - starts
+    cells = np.arange(len(counts)) + np.repeat(shifts, lengths)
+    merged = np.bincount(cells, weights=counts, minlength=len(groups) * width).reshape(len(groups), width)
+    return groups, zero_counts, low, merged
+
+def bucket_values(gamma, low, width):
+    return 2 * gamma ** np.arange(low, low + width) / (gamma + 1)
+
+def quantiles(gamma, zero_counts, low, merged, qs):
+    """groups x len(qs) matrix of quantiles, None where a group has no trips"""
+    values = bucket_values(gamma, low, merged.shape[1])
+    cumulative = np.cumsum(merged, axis=1)
+    results = []
+    for zero_count, row in zip(zero_counts, cumulative):
+        total = zero_count + (row[-1] if len(row) else 0)
+        if not total:
+            results.append([None] * len(qs))
+            continue
+        group = []
+        for q in qs:
+            # Lower rank, as in DDSketch: the value at rank q (n - 1)
+            rank = q * (total - 1)
+            if rank < zero_count:
+                group.append(0.0)
+            else:
+                group.append(round(float(values[np.searchsorted(row, rank - zero_count, side="right")]), 2))
+        results.append(group)
+    return results
+
+def histogram(gamma, zero_count, low, counts, max_bins):
+    """Bins of values in (lower, upper] with trip counts, merging adjacent buckets down to max_bins"""
+    bins = []
+    if zero_count:
+        bins.append({"lower": 0.0, "upper": 0.0, "trip_count": int(zero_count)})
+    nonzero = np.flatnonzero(counts)
+    if not len(nonzero):
+        return bins
+    first, last = int(nonzero[0]), int(nonzero[-1])
+    step = -(-(last - first + 1) // max_bins)
+    for start in range(first, last + 1, step):
+        bins.append({
+            "lower": round(gamma ** (low + start - 1), 2),
+            "upper": round(gamma ** (low + start + step - 1), 2),
+            "trip_count": int(counts[start:start + step].sum()),
+        })
+    return bins
@@ -0,0 +1,167 @@
+import os
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+
+import database
+from database import database_identity, get_connection, release_connection
+
+
+# ORIGIN-DESTINATION MATRIX
+# database/od_matrix.py writes a dense pickup x dropoff matrix of trip
+# totals beside the database at load time. It is memory-mapped here, so
+# routes, borough flows and per-zone totals are array reductions over
+# pages the OS already caches, instead of GROUP BYs over the trips.
+# Cell [i, j] is PULocationID i + 1 to DOLocationID j + 1.
+
+OD_MATRIX_NAME = "od_matrix.npy"
+
+# metric: (sum field, count field); count None means a plain total
+OD_METRICS = {
+    "trip_count": ("trip_count", None),
+    "revenue": ("total_amount_sum", None),
+    "avg_fare": ("fare_amount_sum", "fare_amount_count"),
+    "avg_distance": ("trip_distance_sum", "trip_distance_count"),
+    "avg_speed": ("trip_speed_mph_sum", "trip_speed_mph_count"),
+}
+OD_GROUPS = ("zone", "borough")
+
+# For one database: matrix indexes of its LocationIDs in (Borough, Zone)
+# order, and the labels of each grouping with the position where each
+# label's run of indexes starts.
+ZoneGroups = namedtuple("ZoneGroups", ["order", "boroughs", "borough_starts", "routes", "route_starts"])
+
+def od_matrix_path():
+    return os.path.join(os.path.dirname(database.DB_PATH), OD_MATRIX_NAME)
+
+@lru_cache(maxsize=2)
+def load_od_matrix(identity):
+    return np.load(identity[0], mmap_mode="r")
+
+def od_matrix_identity():
+    """database_identity of the matrix file, or None if it has not been built"""
+    identity = database_identity(od_matrix_path())
+    return identity if identity[1] is not None else None
+
+def od_matrix():
+    """The memory-mapped matrix, or None if it has not been built"""
+    identity = od_matrix_identity()
+    return load_od_matrix(identity) if identity else None
+
+def runs(labels):
+    """(label of each run of equal labels, index where the run starts)"""
+    starts = [i for i, label in enumerate(labels) if i == 0 or label != labels[i - 1]]
+    return [labels[i] for i in starts], np.array(starts, dtype=np.intp)
+
+@lru_cache(maxsize=4)
+def load_zone_groups(identity):
+    conn = get_connection()
+    try:
+        rows = conn.execute("SELECT LocationID, Borough, Zone FROM zones ORDER BY Borough, Zone").fetchall()
+    finally:
+        release_connection(conn)
+    order = np.array([row["LocationID"] - 1 for row in rows], dtype=np.intp)
+    boroughs, borough_starts = runs([row["Borough"] for row in rows])
+    # Some zone names (e.g. Corona) cover more than one LocationID, and
+    # routes are ranked by name, like agg_routes.
+    routes, route_starts = runs([(row["Borough"], row["Zone"]) for row in rows])
+    return ZoneGroups(order, boroughs, borough_starts, routes, route_starts)
+
+def zone_groups():
+    return load_zone_groups(database_identity(database.DB_PATH))
+
+def grouped(matrix, order, starts, fields):
+    """Totals of fields with rows and columns summed into groups.
+
+    Rows and columns are put in group order, so each group is a run that
+    reduceat sums in one pass.
+    """
+    return {
+        field: np.add.reduceat(np.add.reduceat(matrix[field][np.ix_(order, order)], starts, axis=0), starts, axis=1)
+        for field in fields
+    }
+
+def metric_values(totals, metric, axis=None):
+    """metric from the totals, summed over axis first if given; averages with no trips are NaN"""
+    sum_field, count_field = OD_METRICS[metric]
+    fields = (sum_field,) if count_field is None else (sum_field, count_field)
+    values = [np.asarray(totals[field]) if axis is None else np.asarray(totals[field]).sum(axis=axis) for field in fields]
+    if count_field is None:
+        return values[0]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(values[1] > 0, values[0] / values[1], np.nan)
+
+def to_json_values(values):
+    """Nested lists rounded to 2 places, with NaN as None"""
+    rounded = np.round(np.asarray(values, dtype=np.float64), 2)
+    if rounded.ndim > 1:
+        return [to_json_values(row) for row in rounded]
+    return [None if value != value else value for value in rounded.tolist()]
+
+def od_flows(matrix, metric, group="zone"):
+    """metric for every origin-destination pair, with per-origin and per-destination totals"""
+    if group == "borough":
+        groups = zone_groups()
+        sum_field, count_field = OD_METRICS[metric]
+        fields = [field for field in (sum_field, count_field) if field]
+        totals = grouped(matrix, groups.order, groups.borough_starts, fields)
+        labels = groups.boroughs
+    else:
+        totals = matrix
+        labels = list(range(1, matrix.shape[0] + 1))
+    return {
+        "metric": metric,
+        "group": group,
+        "labels": labels,
+        "matrix": to_json_values(metric_values(totals, metric)),
+        "outbound": to_json_values(metric_values(totals, metric, axis=1)),
+        "inbound": to_json_values(metric_values(totals, metric, axis=0)),
+    }
+
+@lru_cache(maxsize=2)
+def load_route_totals(matrix_identity, db_identity):
+    matrix = load_od_matrix(matrix_identity)
+    groups = load_zone_groups(db_identity)
+    return grouped(matrix, groups.order, groups.route_starts, matrix.dtype.names)
+
+def od_route_rows(min_trips):
+    """Routes by zone name with more than min_trips trips, in name order, or None without a matrix.
+
+    Rows have the columns of the agg_routes query in routes/stats.py, so
+    either can feed top_k_routes. The per-route totals are summed once per
+    matrix file.
+    """
+    matrix_identity = od_matrix_identity()
+    if matrix_identity is None:
+        return None
+    groups = zone_groups()
+    totals = load_route_totals(matrix_identity, database_identity(database.DB_PATH))
+    counts = totals["trip_count"]
+    pickups, dropoffs = np.nonzero(counts > min_trips)
+    if not len(pickups):
+        return []
+
+    columns = {
+        "trip_count": counts[pickups, dropoffs].astype(np.int64).tolist(),
+        "revenue": to_json_values(totals["total_amount_sum"][pickups, dropoffs]),
+    }
+    for name in ("avg_fare", "avg_distance", "avg_speed"):
+        sum_field, count_field = OD_METRICS[name]
+        pair_totals = {field: totals[field][pickups, dropoffs] for field in (sum_field, count_field)}
+        columns[name] = to_json_values(metric_values(pair_totals, name))
+
+    rows = []
+    for i, (pickup, dropoff) in enumerate(zip(pickups.tolist(), dropoffs.tolist())):
+        (pickup_borough, pickup_zone), (dropoff_borough, dropoff_zone) = groups.routes[pickup], groups.routes[dropoff]
+        rows.append({
+            "route": f"{pickup_borough} -> {dropoff_borough}",
+            "pickup_zone": pickup_zone,
+            "dropoff_zone": dropoff_zone,
+            "trip_count": columns["trip_count"][i],
+            "avg_fare": columns["avg_fare"][i],
+            "avg_distance": columns["avg_distance"][i],
+            "avg_speed": columns["avg_speed"][i],
+            "revenue": columns["revenue"][i],
+        })
+    return rows
@@ -0,0 +1,96 @@
+import sqlite3
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from flask import Response, jsonify, request
+
+from metrics import serialization
+
+
+JSON_MIMETYPE = "application/json"
+ARROW_MIMETYPE = "application/vnd.apache.arrow.stream"
+PARQUET_MIMETYPE = "application/vnd.apache.parquet"
+
+# format= query param value: mimetype. JSON first, so it wins for */*.
+FORMATS = {
+    "json": JSON_MIMETYPE,
+    "arrow": ARROW_MIMETYPE,
+    "parquet": PARQUET_MIMETYPE,
+}
+
+# Rows fetched from SQLite per Arrow record batch
+ARROW_BATCH_SIZE = 10000
+
+def response_format():
+    """Format the client asked for, from the format param or else the Accept header.
+
+    Raises ValueError for an unknown format param.
+    """
+    requested = request.args.get("format")
+    if requested:
+        if requested not in FORMATS:
+            raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+        return requested
+
+    best = request.accept_mimetypes.best_match(list(FORMATS.values()), default=JSON_MIMETYPE)
+    return next(name for name, mimetype in FORMATS.items() if mimetype == best)
+
+def cursor_table(cursor, batch_size=ARROW_BATCH_SIZE):
+    """Build an Arrow table from a cursor, one record batch per fetchmany.
+
+    SQLite columns have no fixed type, so each batch's types are inferred
+    and the batches are unified at the end (e.g. an all-NULL batch takes
+    the type of the others).
+    """
+    columns = [column[0] for column in cursor.description]
+    tables = []
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        arrays = [pa.array(values) for values in zip(*rows)]
+        tables.append(pa.Table.from_arrays(arrays, names=columns))
+
+    if not tables:
+        return pa.table({name: pa.nulls(0) for name in columns})
+    return pa.concat_tables(tables, promote_options="permissive")
+
+def encode_table(table, fmt):
+    sink = pa.BufferOutputStream()
+    if fmt == "arrow":
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        pq.write_table(table, sink)
+    return sink.getvalue()
+
+def respond(data, headers=None):
+    """Send rows as JSON, an Arrow IPC stream or Parquet, as the client negotiated.
+
+    data is a cursor, a list of sqlite3.Row or dicts, or a single row dict.
+    The columnar formats read a cursor in batches.
+    """
+    try:
+        fmt = response_format()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if fmt == "json":
+        if isinstance(data, sqlite3.Cursor):
+            data = data.fetchall()
+        response = jsonify(data)
+    else:
+        with serialization():
+            if isinstance(data, sqlite3.Cursor):
+                table = cursor_table(data)
+            elif data and isinstance(data, list) and isinstance(data[0], sqlite3.Row):
+                table = pa.Table.from_arrays([pa.array(values) for values in zip(*data)], names=data[0].keys())
+            else:
+                table = pa.Table.from_pylist([data] if isinstance(data, dict) else data)
+            body = encode_table(table, fmt).to_pybytes()
+        response = Response(body, mimetype=FORMATS[fmt])
+
+    response.headers["Vary"] = "Accept"
+    if headers:
+        response.headers.update(headers)
+    return response
@@ -0,0 +1,84 @@
+import json
+import sqlite3
+from json.encoder import encode_basestring_ascii
+
+from flask.json.provider import DefaultJSONProvider
+
+from metrics import serialization
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# ROW-AWARE JSON
+# Routes can jsonify lists of sqlite3.Row as they come from fetchall, with
+# no [dict(row) for row in rows] step. A list of rows is encoded a column
+# at a time: numeric columns go through the C encoder in one call, string
+# columns through the C string escaper, and each row is filled into a
+# template that already holds the encoded keys. orjson is used instead
+# when it is installed.
+
+NUMERIC_TYPES = {int, float, type(None)}
+
+def encode_column(values):
+    if set(map(type, values)) <= NUMERIC_TYPES:
+        # Numbers and null never contain ", ", so the list can be split.
+        return json.dumps(values).strip("[]").split(", ")
+    return [
+        encode_basestring_ascii(value) if type(value) is str else json.dumps(value, default=row_default)
+        for value in values
+    ]
+
+def encode_rows(rows):
+    """JSON array of objects for a list of sqlite3.Row sharing the same columns"""
+    keys = rows[0].keys()
+    if orjson is not None:
+        return orjson.dumps([dict(zip(keys, row)) for row in rows]).decode("utf-8")
+
+    # % in a key is escaped so the template keeps it as literal text
+    template = "{" + ",".join(encode_basestring_ascii(key).replace("%", "%%") + ":%s" for key in keys) + "}"
+    columns = [encode_column(values) for values in zip(*rows)]
+    return "[" + ",".join([template % values for values in zip(*columns)]) + "]"
+
+def is_row_list(obj):
+    return isinstance(obj, list) and bool(obj) and isinstance(obj[0], sqlite3.Row)
+
+def row_default(obj):
+    if isinstance(obj, sqlite3.Row):
+        return dict(zip(obj.keys(), obj))
+    return DefaultJSONProvider.default(obj)
+
+class RowJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider that encodes sqlite3.Row lists directly.
+
+    Responses are always compact and keep the column order of the query
+    rather than sorting keys.
+    """
+
+    sort_keys = False
+    default = staticmethod(row_default)
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        if is_row_list(obj):
+            return encode_rows(obj)
+        if isinstance(obj, dict) and any(map(is_row_list, obj.values())):
+            # e.g. {"trips": [rows], "next_cursor": ...}
+            return "{" + ",".join(
+                encode_basestring_ascii(str(key)) + ":" + self.dumps(value) for key, value in obj.items()
+            ) + "}"
+        if orjson is not None:
+            try:
+                return orjson.dumps(obj, default=row_default).decode("utf-8")
+            except TypeError:
+                pass
+        return json.dumps(obj, default=row_default, separators=(",", ":"))
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        with serialization():
+            body = f"{self.dumps(obj)}\n"
+        return self._app.response_class(body, mimetype=self.mimetype)
@@ -0,0 +1,277 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+# REQUEST METRICS
+# app.py starts a RequestMetrics for every request. Pooled connections
+# are TimedConnections, whose cursors add the time spent in SQLite and the
+# rows fetched to it, and the JSON provider and formats.respond add the
+# time spent encoding. When the request finishes, its totals go into the
+# per-endpoint histograms served at /api/metrics. A streamed response is
+# only finished when its body is closed, since its queries run while the
+# body is sent.
+
+# Seconds a query may take before it is logged with its plan
+SLOW_QUERY_SECONDS = float(os.environ.get("SLOW_QUERY_SECONDS", 0.5))
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ROW_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+
+logger = logging.getLogger("taxi_api.slow_queries")
+current_request = ContextVar("current_request", default=None)
+
+class RequestMetrics:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_seconds = 0.0
+        self.sql_rows = 0
+        self.serialize_seconds = 0.0
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that reports its SQLite time and fetched rows to the current request.
+
+    sqlite3 runs a statement up to its first row in execute, and the rest
+    in the fetch calls or while the cursor is iterated, so all are timed. A query whose total crosses
+    SLOW_QUERY_SECONDS is logged once, when it finishes.
+    """
+
+    elapsed = 0.0
+    logged = False
+
+    def timed(self, method, *args):
+        started = time.perf_counter()
+        result = method(self, *args)
+        elapsed = time.perf_counter() - started
+        self.elapsed += elapsed
+        request = current_request.get()
+        if request is not None:
+            request.sql_seconds += elapsed
+            if isinstance(result, list):
+                request.sql_rows += len(result)
+            elif result is not None and method is sqlite3.Cursor.fetchone:
+                request.sql_rows += 1
+        return result
+
+    def execute(self, sql, parameters=()):
+        self.sql, self.parameters = sql, parameters
+        self.timed(sqlite3.Cursor.execute, sql, parameters)
+        if self.elapsed > SLOW_QUERY_SECONDS:
+            # Aggregates do all their work before the first row
+            self.log_slow_query()
+        return self
+
+    def fetchone(self):
+        row = self.timed(sqlite3.Cursor.fetchone)
+        if row is None:
+            self.finished()
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        rows = self.timed(sqlite3.Cursor.fetchmany, size)
+        if len(rows) < size:
+            self.finished()
+        return rows
+
+    def fetchall(self):
+        rows = self.timed(sqlite3.Cursor.fetchall)
+        self.finished()
+        return rows
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        # The C iterator would bypass the timed fetch methods
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+    def finished(self):
+        if self.elapsed > SLOW_QUERY_SECONDS:
+            self.log_slow_query()
+
+    def log_slow_query(self):
+        if self.logged:
+            return
+        self.logged = True
+        slow_queries.increment()
+        try:
+            plan = sqlite3.Connection.execute(
+                self.connection, "EXPLAIN QUERY PLAN " + self.sql, self.parameters
+            ).fetchall()
+            plan = "\n".join(f"  {row[3]}" for row in plan)
+        except sqlite3.Error as e:
+            plan = f"  unavailable: {e}"
+        logger.warning(
+            "Slow query (%.3fs): %s\nparams: %r\nplan:\n%s",
+            self.elapsed, " ".join(self.sql.split()), self.parameters, plan,
+        )
+
+class TimedConnection(sqlite3.Connection):
+    def execute(self, sql, parameters=()):
+        return self.cursor(TimedCursor).execute(sql, parameters)
+
+@contextmanager
+def serialization():
+    """Time encoding a response, less any SQLite time spent fetching rows inside it"""
+    request = current_request.get()
+    if request is None:
+        yield
+        return
+    started = time.perf_counter()
+    sql_before = request.sql_seconds
+    try:
+        yield
+    finally:
+        request.serialize_seconds += time.perf_counter() - started - (request.sql_seconds - sql_before)
+
+class Counter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def increment(self, labels=(), amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self, name):
+        with self.lock:
+            values = dict(self.values)
+        return [f"{name}{format_labels(labels)} {value}" for labels, value in sorted(values.items())]
+
+class Histogram:
+    """Prometheus-style histogram: bucket counts, sum and count per label set"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def observe(self, labels, value):
+        with self.lock:
+            counts, total, observed = self.series.get(labels, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.series[labels] = (counts, total + value, observed + 1)
+
+    def samples(self, name):
+        with self.lock:
+            series = {labels: (list(counts), total, observed) for labels, (counts, total, observed) in self.series.items()}
+        lines = []
+        for labels, (counts, total, observed) in sorted(series.items()):
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', str(float(bound))),))} {count}")
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {observed}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{name}_count{format_labels(labels)} {observed}")
+        return lines
+
+def label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{label_value(value)}"' for name, value in labels) + "}"
+
+requests_total = Counter()
+request_seconds = Histogram(LATENCY_BUCKETS)
+sql_seconds = Histogram(LATENCY_BUCKETS)
+sql_rows = Histogram(ROW_BUCKETS)
+serialize_seconds = Histogram(LATENCY_BUCKETS)
+exceptions_total = Counter()
+slow_queries = Counter()
+
+# name: (type, help, metric)
+METRICS = {
+    "taxi_api_requests_total": ("counter", "Requests by endpoint, method and status", requests_total),
+    "taxi_api_request_duration_seconds": ("histogram", "Time to produce a response, by endpoint", request_seconds),
+    "taxi_api_sql_duration_seconds": ("histogram", "Time spent in SQLite per request, by endpoint", sql_seconds),
+    "taxi_api_sql_rows": ("histogram", "Rows fetched from SQLite per request, by endpoint", sql_rows),
+    "taxi_api_serialization_duration_seconds": ("histogram", "Time spent encoding the response per request, by endpoint", serialize_seconds),
+    "taxi_api_exceptions_total": ("counter", "Unhandled exceptions by endpoint", exceptions_total),
+    "taxi_api_slow_queries_total": ("counter", "Queries slower than SLOW_QUERY_SECONDS", slow_queries),
+}
+
+def start_request():
+    current_request.set(RequestMetrics())
+
+def endpoint_label(request):
+    # The route pattern, not the path, so /api/trips/<id> is one series
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+def finish_request(request, response):
+    metrics = current_request.get()
+    if metrics is None:
+        return
+    current_request.set(None)
+    labels = (endpoint_label(request), request.method, response.status_code)
+    if response.is_streamed:
+        response.response = StreamedBody(response.response, metrics, labels)
+    else:
+        record_request(metrics, *labels)
+
+def record_request(metrics, endpoint, method, status):
+    endpoint = (("endpoint", endpoint),)
+    requests_total.increment(endpoint + (("method", method), ("status", status)))
+    request_seconds.observe(endpoint, time.perf_counter() - metrics.started)
+    sql_seconds.observe(endpoint, metrics.sql_seconds)
+    sql_rows.observe(endpoint, metrics.sql_rows)
+    serialize_seconds.observe(endpoint, metrics.serialize_seconds)
+
+class StreamedBody:
+    """Body of a streamed response, counted against its request until it is closed.
+
+    The chunks are produced after after_request has run, by whichever
+    thread the server sends them from, so the request's metrics are made
+    current while each chunk is pulled.
+    """
+
+    def __init__(self, body, metrics, labels):
+        self.body = body
+        self.metrics = metrics
+        self.labels = labels
+        self.closed = False
+
+    def __iter__(self):
+        iterator = iter(self.body)
+        while True:
+            token = current_request.set(self.metrics)
+            try:
+                chunk = next(iterator, None)
+            finally:
+                current_request.reset(token)
+            if chunk is None:
+                return
+            yield chunk
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if hasattr(self.body, "close"):
+                self.body.close()
+        finally:
+            record_request(self.metrics, *self.labels)
+
+def record_exception(request):
+    exceptions_total.increment((("endpoint", endpoint_label(request)),))
+
+def render(gauges, counters):
+    """All metrics in the Prometheus text format, plus gauges and counters as {name: (help, value)}"""
+    lines = []
+    for name, (kind, help_text, metric) in METRICS.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        lines += metric.samples(name)
+    for kind, values in (("gauge", gauges), ("counter", counters)):
+        for name, (help_text, value) in values.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"]
+    return "\n".join(lines) + "\n"
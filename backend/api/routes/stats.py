@@ -1,453 +1,583 @@
-const API_BASE = '/api'; // same origin safer than hardcoding localhost
-
-const state = {
-    view: 'dashboard',
-    page: 1,
-    pageSize: 50,
-    charts: {},
-    data: {}
-};
-
-<<<<<<< HEAD
-/* =========================
-   Formatting Helpers
-========================= */
-const format = {
-    num: (n) => (n || n === 0) ? n.toLocaleString() : '--',
-    curr: (n) => (n || n === 0)
-        ? `$${Number(n).toLocaleString(undefined, { minimumFractionDigits: 2, maximumFractionDigits: 2 })}`
-        : '--',
-    dec: (n, d = 1) => (n || n === 0) ? Number(n).toFixed(d) : '--'
-};
-
-/* =========================
-   UI Helpers
-========================= */
-const ui = {
-    show: (id) => document.getElementById(id)?.classList.remove('hidden'),
-    hide: (id) => document.getElementById(id)?.classList.add('hidden'),
-    get: (id) => document.getElementById(id),
-    setText: (id, text) => {
-        const el = document.getElementById(id);
-        if (el) el.textContent = text;
-    }
-};
-
-/* =========================
-   API Layer
-========================= */
-const api = {
-    async fetch(endpoint) {
-        try {
-            const res = await fetch(`${API_BASE}${endpoint}`);
-            if (!res.ok) throw new Error(`HTTP ${res.status}`);
-            return await res.json();
-        } catch (err) {
-            console.error(`API Error (${endpoint}):`, err);
-            return null;
-        }
-    },
-    summary: () => api.fetch('/stats/summary'),
-    hourly: () => api.fetch('/stats/hourly-patterns'),
-    boroughRevenue: () => api.fetch('/stats/borough-revenue'),
-    dailyRevenue: () => api.fetch('/stats/daily-revenue'),
-    timeCategories: () => api.fetch('/stats/time-categories'),
-    routes: () => api.fetch('/stats/top-routes'),
-    trips: (limit, offset) => api.fetch(`/trips?limit=${limit}&offset=${offset}`)
-};
-
-/* =========================
-   Chart Configuration
-========================= */
-const chartDefaults = {
-    responsive: true,
-    maintainAspectRatio: true,
-    plugins: {
-        legend: { display: false }
-    },
-    scales: {
-        y: { beginAtZero: true, grid: { color: '#e5e7eb' } },
-        x: { grid: { display: false } }
-    }
-};
-
-const charts = {
-    destroy(id) {
-        if (state.charts[id]) {
-            state.charts[id].destroy();
-            delete state.charts[id];
-        }
-    },
-
-    create(id, config) {
-        charts.destroy(id);
-        const canvas = ui.get(id);
-        if (!canvas) return;
-
-        const ctx = canvas.getContext('2d');
-        state.charts[id] = new Chart(ctx, config);
-    },
-
-    bar(id, labels, values, color = '#4f46e5') {
-        charts.create(id, {
-            type: 'bar',
-            data: {
-                labels,
-                datasets: [{
-                    data: values,
-                    backgroundColor: color,
-                    borderRadius: 6
-                }]
-            },
-            options: chartDefaults
-        });
-    },
-
-    line(id, labels, values, color = '#4f46e5') {
-        charts.create(id, {
-            type: 'line',
-            data: {
-                labels,
-                datasets: [{
-                    data: values,
-                    borderColor: color,
-                    backgroundColor: `${color}33`,
-                    fill: true,
-                    tension: 0.4,
-                    pointRadius: 4
-                }]
-            },
-            options: chartDefaults
-        });
-    },
-
-    doughnut(id, labels, values) {
-        charts.create(id, {
-            type: 'doughnut',
-            data: {
-                labels,
-                datasets: [{
-                    data: values,
-                    backgroundColor: [
-                        '#4f46e5',
-                        '#7c3aed',
-                        '#ec4899',
-                        '#f59e0b',
-                        '#10b981'
-                    ],
-                    borderWidth: 2,
-                    borderColor: '#fff'
-                }]
-            },
-            options: {
-                responsive: true,
-                plugins: {
-                    legend: { display: true, position: 'bottom' }
-                }
-            }
-        });
-    }
-};
-
-/* =========================
-   Views
-========================= */
-const views = {
-
-    async dashboard() {
-        ui.show('loader');
-
-        const [summary, hourly, boroughs] = await Promise.all([
-            api.summary(),
-            api.hourly(),
-            api.boroughRevenue()
-        ]);
-
-        if (summary) {
-            ui.setText('stat-trips', format.num(summary.total_trips));
-            ui.setText('stat-revenue', format.curr(summary.total_revenue));
-            ui.setText('stat-fare', format.curr(summary.avg_fare));
-        }
-
-        if (hourly?.length) {
-            charts.bar(
-                'hourly-chart',
-                hourly.map(h => `${h.hour}:00`),
-                hourly.map(h => h.trip_count)
-            );
-        }
-
-        if (boroughs?.length) {
-            charts.doughnut(
-                'borough-chart',
-                boroughs.map(b => b.borough),
-                boroughs.map(b => b.total_revenue)
-            );
-        }
-
-        ui.hide('loader');
-    },
-
-    async analytics() {
-        ui.show('loader');
-
-        const [daily, timeCategories] = await Promise.all([
-            api.dailyRevenue(),
-            api.timeCategories()
-        ]);
-
-        if (daily?.length) {
-            charts.line(
-                'daily-chart',
-                daily.map(d => d.date),
-                daily.map(d => d.total_revenue)
-            );
-        }
-
-        if (timeCategories?.length) {
-            charts.bar(
-                'time-chart',
-                timeCategories.map(t => t.time_category),
-                timeCategories.map(t => t.avg_fare),
-                '#7c3aed'
-            );
-
-            charts.bar(
-                'speed-chart',
-                timeCategories.map(t => t.time_category),
-                timeCategories.map(t => t.avg_speed),
-                '#10b981'
-            );
-        }
-
-        ui.hide('loader');
-    },
-
-    async data() {
-        ui.show('loader');
-
-        const offset = (state.page - 1) * state.pageSize;
-        const trips = await api.trips(state.pageSize, offset);
-
-        if (trips?.length) {
-            state.data.trips = trips;
-
-            const tbody = ui.get('data-tbody');
-            tbody.innerHTML = '';
-
-            trips.forEach(trip => {
-                const row = tbody.insertRow();
-                row.innerHTML = `
-                    <td>${trip.trip_id}</td>
-                    <td>${trip.pickup_datetime}</td>
-                    <td>${trip.pickup_borough}</td>
-                    <td>${trip.dropoff_borough}</td>
-                    <td>${format.dec(trip.distance)} mi</td>
-                    <td>${format.curr(trip.fare)}</td>
-                    <td>${format.dec(trip.speed)} mph</td>
-                `;
-            });
-
-            ui.setText('page-info', `Page ${state.page}`);
-        }
-
-        ui.hide('loader');
-    }
-};
-
-/* =========================
-   Navigation
-========================= */
-const navigate = (view) => {
-    state.view = view;
-
-    document.querySelectorAll('.view')
-        .forEach(v => v.classList.toggle('active', v.id === `${view}-view`));
-
-    if (views[view]) views[view]();
-};
-
-/* =========================
-   CSV Export
-========================= */
-const exportCSV = () => {
-    const data = state.data.trips;
-    if (!data?.length) return alert('No data to export');
-
-    const headers = Object.keys(data[0]);
-    const rows = data.map(obj => headers.map(h => obj[h]));
-
-    const csv = [headers, ...rows].map(r => r.join(',')).join('\n');
-
-    const blob = new Blob([csv], { type: 'text/csv' });
-    const url = URL.createObjectURL(blob);
-    const a = document.createElement('a');
-
-    a.href = url;
-    a.download = `nyc-taxi-${Date.now()}.csv`;
-    a.click();
-
-    URL.revokeObjectURL(url);
-};
-
-/* =========================
-   Init
-========================= */
-const init = () => {
-    document.querySelectorAll('.nav-item').forEach(item => {
-        item.addEventListener('click', e => {
-            e.preventDefault();
-            navigate(item.dataset.view);
-        });
-    });
-
-    ui.get('refresh-btn')?.addEventListener('click', () => {
-        if (views[state.view]) views[state.view]();
-    });
-
-    ui.get('export-btn')?.addEventListener('click', exportCSV);
-
-    navigate('dashboard');
-};
-
-document.addEventListener('DOMContentLoaded', init);
-=======
+from flask import Blueprint, request, jsonify
+from database import (
+    get_connection, release_connection,
+    date_bounds, pickup_filter, pickup_date_filter, trips_source, zone_ids,
+)
+from algorithm import RANKING_METRICS, top_k_routes
+from cache import cached_response
+from formats import respond, response_format
+from distributions import (
+    DEFAULT_QUANTILES, SKETCH_MEASURES,
+    histogram, merge_sketches, quantile_name, quantiles, stored_sketch_gamma,
+)
+from flows import OD_GROUPS, OD_METRICS, od_flows, od_matrix, od_route_rows
+
+stats_bp = Blueprint("stats", __name__)
+
 @stats_bp.route("/borough-revenue")
 def borough_revenue():
     """Alias for boroughs endpoint"""
     return boroughs()
 
-@stats_bp.route("/overview")
-def overview():
-    """Get overall statistics"""
+def view_response(view):
+    """Every row of one of the v_* views in schema.sql"""
+    conn = None
+    try:
+        conn = get_connection()
+        return respond(conn.execute(f"SELECT * FROM {view}"))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    finally:
+        if conn:
+            release_connection(conn)
+
+def requested_date_range():
+    """[start, end) pickup bounds from the start_date/end_date query params"""
+    return date_bounds(request.args.get("start_date"), request.args.get("end_date"))
+
+# METRIC QUERIES
+# Shared by the single endpoints and /batch. Overview and summary are two
+# projections of the same totals, so a batch asking for both reads
+# agg_daily once.
+
+DAILY_TOTALS_SQL = """
+    SELECT
+        COALESCE(SUM(trip_count), 0) AS total_trips,
+        ROUND(SUM(total_amount_sum), 2) AS total_revenue,
+        ROUND(SUM(total_amount_sum) / SUM(total_amount_count), 2) AS avg_total_amount,
+        ROUND(SUM(fare_amount_sum) / SUM(fare_amount_count), 2) AS avg_fare_amount,
+        ROUND(SUM(trip_distance_sum), 2) AS total_distance,
+        ROUND(SUM(trip_distance_sum) / SUM(trip_distance_count), 2) AS avg_distance,
+        ROUND(SUM(trip_speed_mph_sum) / SUM(trip_speed_mph_count), 2) AS avg_speed,
+        ROUND(SUM(tip_percentage_sum) / SUM(tip_percentage_count), 2) AS avg_tip_pct
+    FROM agg_daily
+    WHERE {where}
+"""
+
+# response field: DAILY_TOTALS_SQL column
+OVERVIEW_FIELDS = {
+    "total_trips": "total_trips",
+    "total_revenue": "total_revenue",
+    "avg_fare": "avg_total_amount",
+    "avg_distance": "avg_distance",
+    "avg_speed": "avg_speed",
+    "avg_tip_pct": "avg_tip_pct",
+}
+SUMMARY_FIELDS = {
+    "total_trips": "total_trips",
+    "avg_fare": "avg_fare_amount",
+    "total_distance": "total_distance",
+    "total_revenue": "total_revenue",
+}
+
+VIEW_METRICS = {
+    "hourly": "v_hourly_demand",
+    "boroughs": "v_borough_revenue",
+    "daily": "v_daily_revenue",
+    "time-categories": "v_time_category_stats",
+}
+TOTALS_METRICS = {"overview": OVERVIEW_FIELDS, "summary": SUMMARY_FIELDS}
+BATCH_METRICS = list(TOTALS_METRICS) + list(VIEW_METRICS) + ["top-routes", "fare-distribution"]
+
+def daily_totals(conn, start, end):
+    where, params = pickup_date_filter(start, end)
+    return conn.execute(DAILY_TOTALS_SQL.format(where=where), params).fetchone()
+
+def pick(totals, fields):
+    return {name: totals[column] for name, column in fields.items()}
+
+# Routes with fewer trips are too sparse for their averages to rank on
+TOP_ROUTES_MIN_TRIPS = 100
+TOP_ROUTES_DEFAULT_K = 20
+TOP_ROUTES_MAX_K = 1000
+
+def top_routes_params():
+    """(k, metric) from the query params. Raises ValueError with a message for the client."""
+    try:
+        k = int(request.args.get("k", TOP_ROUTES_DEFAULT_K))
+    except ValueError:
+        raise ValueError("k must be an integer")
+    if not 1 <= k <= TOP_ROUTES_MAX_K:
+        raise ValueError(f"k must be between 1 and {TOP_ROUTES_MAX_K}")
+    metric = request.args.get("metric", "trip_count")
+    if metric not in RANKING_METRICS:
+        raise ValueError(f"metric must be one of {', '.join(RANKING_METRICS)}")
+    return k, metric
+
+def top_routes_rows(conn, k, metric):
+    """The k busiest routes by metric, ranked by passing every route through a bounded heap.
+
+    Routes come from the OD matrix when it has been built, otherwise from
+    agg_routes. Either way they are in name order, so routes with equal
+    values rank by name.
+    """
+    routes = od_route_rows(TOP_ROUTES_MIN_TRIPS)
+    if routes is not None:
+        return top_k_routes(routes, k, metric)
+
+    cursor = conn.execute("""
+        SELECT
+            pickup_borough || ' -> ' || dropoff_borough AS route,
+            pickup_zone,
+            dropoff_zone,
+            trip_count,
+            ROUND(fare_amount_sum / fare_amount_count, 2) AS avg_fare,
+            ROUND(trip_distance_sum / trip_distance_count, 2) AS avg_distance,
+            ROUND(trip_speed_mph_sum / trip_speed_mph_count, 2) AS avg_speed,
+            ROUND(total_amount_sum, 2) AS revenue
+        FROM agg_routes
+        WHERE trip_count > ?
+        ORDER BY pickup_borough, pickup_zone, dropoff_borough, dropoff_zone
+    """, (TOP_ROUTES_MIN_TRIPS,))
+    return top_k_routes(cursor, k, metric)
+
+def fare_distribution_cursor(conn, start, end):
+    where, params = pickup_filter(start, end)
+    return conn.execute(f"""
+        SELECT
+            ROUND(fare_amount, 0) as fare_bucket,
+            COUNT(*) as trip_count
+        FROM {trips_source(conn, start, end)}
+        WHERE {where}
+        GROUP BY fare_bucket
+        ORDER BY fare_bucket
+    """, params)
+
+# CUBE QUERIES
+# /cube answers any filter and group-by over agg_cube, the finest rollup
+# the loader keeps. Dimensions, filters and metrics are whitelisted SQL;
+# only their names and bound values come from the request.
+
+# name: SQL expression over agg_cube c and, for pickup names, zones z
+CUBE_DIMENSIONS = {
+    "pickup_date": "c.pickup_date",
+    "pickup_hour": "c.pickup_hour",
+    "time_category": "NULLIF(c.time_category, '')",
+    "PULocationID": "c.PULocationID",
+    "pickup_zone": "z.Zone",
+    "pickup_borough": "z.Borough",
+    "dropoff_borough": "c.dropoff_borough",
+}
+# filter param: (column, value parser); comma-separated values are ORed
+CUBE_FILTERS = {
+    "pickup_hour": ("c.pickup_hour", int),
+    "time_category": ("c.time_category", str),
+    "PULocationID": ("c.PULocationID", int),
+    "pickup_borough": ("z.Borough", str),
+    "dropoff_borough": ("c.dropoff_borough", str),
+}
+CUBE_METRICS = {
+    "trip_count": "SUM(c.trip_count)",
+    "total_revenue": "ROUND(SUM(c.total_amount_sum), 2)",
+    "avg_trip_value": "ROUND(SUM(c.total_amount_sum) / SUM(c.total_amount_count), 2)",
+    "avg_fare": "ROUND(SUM(c.fare_amount_sum) / SUM(c.fare_amount_count), 2)",
+    "avg_distance": "ROUND(SUM(c.trip_distance_sum) / SUM(c.trip_distance_count), 2)",
+    "avg_speed": "ROUND(SUM(c.trip_speed_mph_sum) / SUM(c.trip_speed_mph_count), 2)",
+    "avg_tip_pct": "ROUND(SUM(c.tip_percentage_sum) / SUM(c.tip_percentage_count), 2)",
+    "avg_efficiency": "ROUND(SUM(c.efficiency_score_sum) / SUM(c.efficiency_score_count), 2)",
+}
+CUBE_DEFAULT_METRICS = ["trip_count", "total_revenue", "avg_fare", "avg_speed"]
+# Dimensions and filters that need zones joined
+CUBE_ZONE_COLUMNS = {"pickup_zone", "pickup_borough"}
+
+def name_list(args, param, allowed, default=()):
+    """Comma-separated names from a query param, each checked against allowed"""
+    names = [name.strip() for name in args.get(param, "").split(",") if name.strip()] or list(default)
+    unknown = [name for name in names if name not in allowed]
+    if unknown:
+        raise ValueError(f"unknown {param}: {', '.join(unknown)}; choose from {', '.join(allowed)}")
+    return names
+
+def cube_query(args, start, end):
+    """SQL and params for a /cube request. Raises ValueError with a message for the client."""
+    dimensions = name_list(args, "group_by", CUBE_DIMENSIONS)
+    metrics = name_list(args, "metrics", CUBE_METRICS, CUBE_DEFAULT_METRICS)
+
+    where, params = pickup_date_filter(start, end)
+    conditions = [where]
+    filtered = []
+    for name, (column, parse) in CUBE_FILTERS.items():
+        values = [value.strip() for value in args.get(name, "").split(",") if value.strip()]
+        if not values:
+            continue
+        try:
+            params.extend(parse(value) for value in values)
+        except ValueError:
+            raise ValueError(f"{name} must be a comma-separated list of integers")
+        conditions.append(f"{column} IN ({', '.join('?' * len(values))})")
+        filtered.append(name)
+    pickup_zone = args.get("pickup_zone")
+    if pickup_zone:
+        ids = zone_ids(pickup_zone)
+        conditions.append(f"c.PULocationID IN ({', '.join('?' * len(ids))})")
+        params.extend(ids)
+
+    selects = [f"{CUBE_DIMENSIONS[name]} AS {name}" for name in dimensions]
+    selects += [f"{CUBE_METRICS[name]} AS {name}" for name in metrics]
+    query = f"SELECT {', '.join(selects)} FROM agg_cube c"
+    if CUBE_ZONE_COLUMNS.intersection(dimensions + filtered):
+        query += " JOIN zones z ON z.LocationID = c.PULocationID"
+    query += f" WHERE {' AND '.join(conditions)}"
+    if dimensions:
+        positions = ", ".join(str(i + 1) for i in range(len(dimensions)))
+        query += f" GROUP BY {positions} ORDER BY {positions}"
+    return query, params
+
+# SKETCH QUERIES
+# Percentiles and histograms of fares, speeds and tips for any date range
+# and pickup zones, from the per-day, per-zone sketches in trip_sketches.
+
+# group_by name: SQL expression over trip_sketches s and zones z
+SKETCH_GROUPS = {
+    "pickup_date": "s.pickup_date",
+    "PULocationID": "s.PULocationID",
+    "pickup_zone": "z.Zone",
+    "pickup_borough": "z.Borough",
+}
+HISTOGRAM_DEFAULT_BINS = 40
+HISTOGRAM_MAX_BINS = 500
+
+def sketch_query(args, start, end, group=None):
+    """SQL and params selecting (group, zero_count, min_bucket, counts) sketches.
+
+    Raises ValueError with a message for the client.
+    """
+    measure = args.get("measure", "fare_amount")
+    if measure not in SKETCH_MEASURES:
+        raise ValueError(f"measure must be one of {', '.join(SKETCH_MEASURES)}")
+
+    where, params = pickup_date_filter(start, end)
+    conditions = [where, "s.measure = ?"]
+    params.append(measure)
+    pickup_zone = args.get("pickup_zone")
+    if pickup_zone:
+        ids = zone_ids(pickup_zone)
+        conditions.append(f"s.PULocationID IN ({', '.join('?' * len(ids))})")
+        params.extend(ids)
+    location_ids = [value.strip() for value in args.get("PULocationID", "").split(",") if value.strip()]
+    if location_ids:
+        try:
+            params.extend(int(value) for value in location_ids)
+        except ValueError:
+            raise ValueError("PULocationID must be a comma-separated list of integers")
+        conditions.append(f"s.PULocationID IN ({', '.join('?' * len(location_ids))})")
+    pickup_borough = args.get("pickup_borough")
+    if pickup_borough:
+        conditions.append("z.Borough = ?")
+        params.append(pickup_borough)
+
+    query = f"""
+        SELECT {SKETCH_GROUPS[group] if group else "NULL"}, s.zero_count, s.min_bucket, s.counts
+        FROM trip_sketches s
+        JOIN zones z ON z.LocationID = s.PULocationID
+        WHERE {" AND ".join(conditions)}
+    """
+    if group:
+        query += " ORDER BY 1"
+    return query, params
+
+def quantile_params(args):
+    """Group name (or None) and quantiles from the query params. Raises ValueError."""
+    group = args.get("group_by") or None
+    if group and group not in SKETCH_GROUPS:
+        raise ValueError(f"group_by must be one of {', '.join(SKETCH_GROUPS)}")
+    try:
+        qs = [float(q) for q in args.get("quantiles", "").split(",") if q.strip()] or list(DEFAULT_QUANTILES)
+    except ValueError:
+        raise ValueError("quantiles must be comma-separated numbers between 0 and 1")
+    if not all(0 <= q <= 1 for q in qs):
+        raise ValueError("quantiles must be comma-separated numbers between 0 and 1")
+    return group, qs
+
+def totals_response(fields):
     conn = None
     try:
+        try:
+            start, end = requested_date_range()
+        except ValueError:
+            return jsonify({"error": "start_date and end_date must be YYYY-MM-DD"}), 400
+
         conn = get_connection()
-        row = conn.execute("""
-            SELECT
-                COUNT(*) AS total_trips,
-                ROUND(SUM(total_amount), 2) AS total_revenue,
-                ROUND(AVG(total_amount), 2) AS avg_fare,
-                ROUND(AVG(trip_distance), 2) AS avg_distance,
-                ROUND(AVG(trip_speed_mph), 2) AS avg_speed,
-                ROUND(AVG(tip_percentage), 2) AS avg_tip_pct
-            FROM trips
-        """).fetchone()
-        return jsonify(dict(row))
+        return respond(pick(daily_totals(conn, start, end), fields))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     finally:
         if conn:
-            conn.close()
+            release_connection(conn)
+
+@stats_bp.route("/overview")
+@cached_response
+def overview():
+    """Get overall statistics"""
+    return totals_response(OVERVIEW_FIELDS)
 
 @stats_bp.route("/hourly")
+@cached_response
 def hourly():
     """Get hourly demand patterns"""
-    try:
-        return jsonify(cached_query("SELECT * FROM v_hourly_demand"))
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    return view_response("v_hourly_demand")
 
 @stats_bp.route("/boroughs")
+@cached_response
 def boroughs():
     """Get borough statistics"""
-    try:
-        return jsonify(cached_query("SELECT * FROM v_borough_revenue"))
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    return view_response("v_borough_revenue")
 
 @stats_bp.route("/daily")
+@cached_response
 def daily():
     """Get daily revenue statistics"""
-    try:
-        return jsonify(cached_query("SELECT * FROM v_daily_revenue"))
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    return view_response("v_daily_revenue")
 
 @stats_bp.route("/time-categories")
+@cached_response
 def time_categories():
     """Get time category statistics"""
+    return view_response("v_time_category_stats")
+
+@stats_bp.route("/top-routes")
+@cached_response
+def top_routes():
+    """Get the top k routes (default 20) by trip_count, avg_fare, avg_speed or revenue"""
+    conn = None
     try:
-        return jsonify(cached_query("SELECT * FROM v_time_category_stats"))
+        try:
+            k, metric = top_routes_params()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        conn = get_connection()
+        return respond(top_routes_rows(conn, k, metric))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+    finally:
+        if conn:
+            release_connection(conn)
+
+@stats_bp.route("/od-matrix")
+@cached_response
+def origin_destination_matrix():
+    """Zone-to-zone (or borough-to-borough with group=borough) flows of one metric
+
+    Also returns the per-origin (outbound) and per-destination (inbound)
+    totals. Zone labels are LocationIDs.
+    """
+    metric = request.args.get("metric", "trip_count")
+    if metric not in OD_METRICS:
+        return jsonify({"error": f"metric must be one of {', '.join(OD_METRICS)}"}), 400
+    group = request.args.get("group", "zone")
+    if group not in OD_GROUPS:
+        return jsonify({"error": f"group must be one of {', '.join(OD_GROUPS)}"}), 400
+    try:
+        fmt = response_format()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if fmt != "json":
+        return jsonify({"error": "od-matrix responses are JSON only"}), 406
 
-@stats_bp.route("/top-routes")
-def top_routes():
-    """Get top routes sorted by trip count"""
+    try:
+        matrix = od_matrix()
+        if matrix is None:
+            return jsonify({"error": "OD matrix has not been built; run database/od_matrix.py"}), 503
+        return jsonify(od_flows(matrix, metric, group))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@stats_bp.route("/cube")
+@cached_response
+def cube():
+    """Trip metrics for any filter and group-by, e.g. /cube?group_by=pickup_hour&pickup_borough=Manhattan
+
+    group_by and metrics take comma-separated names. Filters are
+    start_date/end_date, pickup_zone, and any of pickup_hour,
+    time_category, PULocationID, pickup_borough and dropoff_borough with
+    comma-separated values.
+    """
     conn = None
     try:
+        try:
+            start, end = requested_date_range()
+        except ValueError:
+            return jsonify({"error": "start_date and end_date must be YYYY-MM-DD"}), 400
+        try:
+            query, params = cube_query(request.args, start, end)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
         conn = get_connection()
-        rows = conn.execute("""
-            SELECT
-                route,
-                pickup_zone,
-                dropoff_zone,
-                trip_count,
-                avg_fare,
-                avg_distance,
-                avg_speed
-            FROM v_top_routes
-            LIMIT 20
-        """).fetchall()
-        routes = [dict(row) for row in rows]
-        sorted_routes = quicksort_routes(routes)
-        return jsonify(sorted_routes)
+        return respond(conn.execute(query, params))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     finally:
         if conn:
-            conn.close()
+            release_connection(conn)
 
-@stats_bp.route("/summary")
-def summary():
-    """Legacy endpoint"""
+@stats_bp.route("/quantiles")
+@cached_response
+def quantiles_view():
+    """Percentiles of a measure, e.g. /quantiles?measure=trip_speed_mph&group_by=pickup_borough
+
+    Defaults to p50, p90 and p99 of fare_amount over all trips. Values are
+    within 1% of the exact percentile. Filters are start_date/end_date,
+    pickup_zone, pickup_borough and PULocationID.
+    """
     conn = None
     try:
+        try:
+            start, end = requested_date_range()
+        except ValueError:
+            return jsonify({"error": "start_date and end_date must be YYYY-MM-DD"}), 400
+        try:
+            group, qs = quantile_params(request.args)
+            query, params = sketch_query(request.args, start, end, group)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
         conn = get_connection()
-        row = conn.execute("""
-            SELECT
-                COUNT(*) AS total_trips,
-                ROUND(AVG(fare_amount), 2) AS avg_fare,
-                ROUND(SUM(trip_distance), 2) AS total_distance,
-                ROUND(SUM(total_amount), 2) AS total_revenue
-            FROM trips
-        """).fetchone()
-        return jsonify(dict(row))
+        gamma = stored_sketch_gamma(conn)
+        if gamma is None:
+            return jsonify({"error": "Quantile sketches have not been built; run database/sketches.py"}), 503
+        rows = conn.execute(query, params).fetchall()
+        if not rows and not group:
+            rows = [(None, 0, 0, b"")]
+
+        groups, zero_counts, low, merged = merge_sketches(rows)
+        totals = zero_counts + merged.sum(axis=1)
+        results = []
+        for key, total, values in zip(groups, totals, quantiles(gamma, zero_counts, low, merged, qs)):
+            result = {group: key} if group else {}
+            result["trip_count"] = int(total)
+            result.update(zip(map(quantile_name, qs), values))
+            results.append(result)
+        return respond(results)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     finally:
         if conn:
-            conn.close()
+            release_connection(conn)
 
-@stats_bp.route("/hourly-patterns")
-def hourly_patterns():
-    """Legacy endpoint"""
+@stats_bp.route("/histogram")
+@cached_response
+def histogram_view():
+    """Histogram of a measure in log-spaced bins, e.g. /histogram?measure=fare_amount&bins=40
+
+    Takes the same filters as /quantiles.
+    """
+    conn = None
     try:
-        return jsonify(cached_query("SELECT * FROM v_hourly_demand"))
+        try:
+            start, end = requested_date_range()
+        except ValueError:
+            return jsonify({"error": "start_date and end_date must be YYYY-MM-DD"}), 400
+        try:
+            bins = int(request.args.get("bins", HISTOGRAM_DEFAULT_BINS))
+        except ValueError:
+            return jsonify({"error": "bins must be an integer"}), 400
+        if not 1 <= bins <= HISTOGRAM_MAX_BINS:
+            return jsonify({"error": f"bins must be between 1 and {HISTOGRAM_MAX_BINS}"}), 400
+        try:
+            query, params = sketch_query(request.args, start, end)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        conn = get_connection()
+        gamma = stored_sketch_gamma(conn)
+        if gamma is None:
+            return jsonify({"error": "Quantile sketches have not been built; run database/sketches.py"}), 503
+        rows = conn.execute(query, params).fetchall()
+        if not rows:
+            return respond([])
+        _, zero_counts, low, merged = merge_sketches(rows)
+        return respond(histogram(gamma, zero_counts[0], low, merged[0], bins))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+    finally:
+        if conn:
+            release_connection(conn)
+
+@stats_bp.route("/summary")
+@cached_response
+def summary():
+    """Legacy endpoint"""
+    return totals_response(SUMMARY_FIELDS)
+
+@stats_bp.route("/hourly-patterns")
+@cached_response
+def hourly_patterns():
+    """Legacy endpoint"""
+    return view_response("v_hourly_demand")
 
 @stats_bp.route("/fare-distribution")
+@cached_response
 def fare_distribution():
     """Get fare distribution"""
     conn = None
     try:
+        try:
+            start, end = requested_date_range()
+        except ValueError:
+            return jsonify({"error": "start_date and end_date must be YYYY-MM-DD"}), 400
+
         conn = get_connection()
-        rows = conn.execute("""
-            SELECT
-                ROUND(fare_amount, 0) as fare_bucket,
-                COUNT(*) as trip_count
-            FROM trips
-            GROUP BY fare_bucket
-            ORDER BY fare_bucket
-        """).fetchall()
-        return jsonify([dict(row) for row in rows])
+        return respond(fare_distribution_cursor(conn, start, end))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     finally:
         if conn:
-            conn.close()
+            release_connection(conn)
+
+@stats_bp.route("/batch")
+@cached_response
+def batch():
+    """Several stats in one response, e.g. /batch?metrics=summary,hourly,boroughs
+
+    Every metric is read on one connection. The response is a JSON object
+    keyed by metric name.
+    """
+    metrics = [name.strip() for name in request.args.get("metrics", "").split(",") if name.strip()]
+    if not metrics:
+        return jsonify({"error": f"metrics is required, choose from {', '.join(BATCH_METRICS)}"}), 400
+    unknown = [name for name in metrics if name not in BATCH_METRICS]
+    if unknown:
+        return jsonify({"error": f"unknown metrics: {', '.join(unknown)}"}), 400
+
+    try:
+        fmt = response_format()
+        # k and metric only mean something to top-routes
+        k, metric = top_routes_params() if "top-routes" in metrics else (None, None)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if fmt != "json":
+        return jsonify({"error": "batch responses are JSON only"}), 406
+
+    conn = None
+    try:
+        try:
+            start, end = requested_date_range()
+        except ValueError:
+            return jsonify({"error": "start_date and end_date must be YYYY-MM-DD"}), 400
+
+        conn = get_connection()
+        results = {}
+        totals = None
+        for name in metrics:
+            if name in TOTALS_METRICS:
+                if totals is None:
+                    totals = daily_totals(conn, start, end)
+                results[name] = pick(totals, TOTALS_METRICS[name])
+            elif name in VIEW_METRICS:
+                results[name] = conn.execute(f"SELECT * FROM {VIEW_METRICS[name]}").fetchall()
+            elif name == "top-routes":
+                results[name] = top_routes_rows(conn, k, metric)
+            else:
+                results[name] = fare_distribution_cursor(conn, start, end).fetchall()
+        return jsonify(results)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    finally:
+        if conn:
+            release_connection(conn)
+
 @stats_bp.route("/daily-revenue")
 def daily_revenue():
     """Alias for daily endpoint"""
@@ -457,4 +587,3 @@ def daily_revenue():
 def time_category_stats():
     """Alias for time-categories endpoint"""
     return time_categories()
->>>>>>> 572e0b9 (debugging)
@@ -1,55 +1,177 @@
-from flask import Blueprint, request, jsonify
-from database import get_connection
+import base64
+import csv
+import io
+import json
+
+from flask import Blueprint, Response, request, jsonify, stream_with_context
+from database import (
+    PARTITION_TEMPLATE, get_connection, release_connection,
+    date_bounds, trips_source, trip_partitions, trip_partition_for_id, zone_ids,
+)
+from formats import respond, response_format
 
 trips_bp = Blueprint("trips", __name__)
 
-@trips_bp.route("/", methods=["GET"])
+# Rows fetched per round trip while streaming an export
+EXPORT_BATCH_SIZE = 2000
+EXPORT_MIMETYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+# Same columns as v_trips_enriched, over only the partitions a request needs.
+ENRICHED_TRIPS_SQL = """
+    SELECT
+        t.trip_id,
+        t.VendorID,
+        t.tpep_pickup_datetime,
+        t.tpep_dropoff_datetime,
+        DATE(t.tpep_pickup_datetime) AS pickup_date,
+        CAST(STRFTIME('%H', t.tpep_pickup_datetime) AS INTEGER) AS pickup_hour,
+        CAST(STRFTIME('%w', t.tpep_pickup_datetime) AS INTEGER) AS pickup_weekday,
+        t.passenger_count,
+        t.trip_distance,
+        t.fare_amount,
+        t.tip_amount,
+        t.total_amount,
+        t.trip_speed_mph,
+        t.tip_percentage,
+        t.time_category,
+        pu.Borough AS pickup_borough,
+        pu.Zone AS pickup_zone,
+        do.Borough AS dropoff_borough,
+        do.Zone AS dropoff_zone
+    FROM {source} t
+    JOIN zones pu ON t.PULocationID = pu.LocationID
+    JOIN zones do ON t.DOLocationID = do.LocationID
+"""
+
+def encode_cursor(trip):
+    """Opaque page cursor holding the (pickup time, trip_id) of the last trip sent"""
+    key = json.dumps([trip["tpep_pickup_datetime"], trip["trip_id"]])
+    return base64.urlsafe_b64encode(key.encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor; None for the first page. Raises ValueError if malformed."""
+    if not cursor:
+        return None
+    try:
+        pickup, trip_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (TypeError, ValueError) as e:
+        raise ValueError("invalid cursor") from e
+    if not isinstance(pickup, str) or not isinstance(trip_id, int):
+        raise ValueError("invalid cursor")
+    return pickup, trip_id
+
+def zone_condition(column, zone):
+    """Match a zone name by LocationID so the trips indexes can be used"""
+    ids = zone_ids(zone)
+    if len(ids) == 1:
+        return f"{column} = ?", list(ids)
+    return f"{column} IN ({', '.join('?' * len(ids))})", list(ids)
+
+def trip_filters(args):
+    """Translate search params into conditions on the trips columns.
+
+    Returns (where, params, start, end), where [start, end) is the pickup
+    range used to pick partitions. Raises ValueError with a message for
+    the client if a param is malformed.
+    """
+    conditions = ["1=1"]
+    params = []
+    start = end = None
+
+    # Date range, as a pickup datetime range the indexes can seek on
+    start_date = args.get("start_date")
+    end_date = args.get("end_date")
+
+    if start_date and end_date:
+        try:
+            start, end = date_bounds(start_date, end_date)
+        except ValueError:
+            raise ValueError("start_date and end_date must be YYYY-MM-DD")
+        conditions.append("t.tpep_pickup_datetime >= ? AND t.tpep_pickup_datetime < ?")
+        params.extend([start, end])
+
+    # Pickup zone
+    pickup_zone = args.get("pickup_zone")
+    if pickup_zone:
+        condition, ids = zone_condition("t.PULocationID", pickup_zone)
+        conditions.append(condition)
+        params.extend(ids)
+
+    # Dropoff zone
+    dropoff_zone = args.get("dropoff_zone")
+    if dropoff_zone:
+        condition, ids = zone_condition("t.DOLocationID", dropoff_zone)
+        conditions.append(condition)
+        params.extend(ids)
+
+    # Fare range
+    min_fare = args.get("min_fare")
+    max_fare = args.get("max_fare")
+
+    if min_fare:
+        try:
+            params.append(float(min_fare))
+        except ValueError:
+            raise ValueError("min_fare must be numeric")
+        conditions.append("t.fare_amount >= ?")
+
+    if max_fare:
+        try:
+            params.append(float(max_fare))
+        except ValueError:
+            raise ValueError("max_fare must be numeric")
+        conditions.append("t.fare_amount <= ?")
+
+    return " AND ".join(conditions), params, start, end
+
+def keyset_sql(table, where, after):
+    query = ENRICHED_TRIPS_SQL.format(source=table) + f" WHERE {where}"
+    if after:
+        query += " AND t.tpep_pickup_datetime >= ? AND (t.tpep_pickup_datetime > ? OR t.trip_id > ?)"
+    return query + " ORDER BY t.tpep_pickup_datetime, t.trip_id LIMIT ?"
+
+def keyset_page(conn, where, params, start, end, after, limit):
+    """One page of trips ordered by (pickup time, trip_id), starting after the key after.
+
+    Partitions are disjoint months, so they are read oldest first and the
+    walk stops once the page is full. Within a partition the seek and the
+    ORDER BY are both served by an index on pickup datetime whose entries
+    end in trip_id, so a page costs the same however deep it is.
+    """
+    if after:
+        start = max(start or "", after[0])
+
+    rows = []
+    for table in trip_partitions(conn, start, end):
+        page_params = list(params)
+        if after:
+            page_params += [after[0], after[0], after[1]]
+        page_params.append(limit - len(rows))
+
+        rows += conn.execute(keyset_sql(table, where, after), page_params).fetchall()
+        if len(rows) >= limit:
+            break
+
+    return rows
+
+@trips_bp.route("/", methods=["GET"], strict_slashes=False)
 def get_trips():
+    """Search trips.
+
+    Pages with limit/offset and returns a list, or, when a cursor param is
+    given (empty for the first page), pages by keyset and returns
+    {"trips": [...], "next_cursor": ...}. Arrow and Parquet responses hold
+    just the trips, with the next cursor in the X-Next-Cursor header.
+    """
     conn = None
     try:
         conn = get_connection()
-        query = "SELECT * FROM v_trips_enriched WHERE 1=1"
-        params = []
-
-        # Validate date range
-        start_date = request.args.get("start_date")
-        end_date = request.args.get("end_date")
-
-        if start_date and end_date:
-            query += " AND pickup_date BETWEEN ? AND ?"
-            params.extend([start_date, end_date])
-
-        # Pickup zone
-        pickup_zone = request.args.get("pickup_zone")
-        if pickup_zone:
-            query += " AND pickup_zone = ?"
-            params.append(pickup_zone)
-
-        # Dropoff zone
-        dropoff_zone = request.args.get("dropoff_zone")
-        if dropoff_zone:
-            query += " AND dropoff_zone = ?"
-            params.append(dropoff_zone)
-
-        # Fare range
-        min_fare = request.args.get("min_fare")
-        max_fare = request.args.get("max_fare")
-
-        if min_fare:
-            try:
-                float(min_fare)
-                query += " AND fare_amount >= ?"
-                params.append(min_fare)
-            except ValueError:
-                return jsonify({"error": "min_fare must be numeric"}), 400
 
-        if max_fare:
-            try:
-                float(max_fare)
-                query += " AND fare_amount <= ?"
-                params.append(max_fare)
-            except ValueError:
-                return jsonify({"error": "max_fare must be numeric"}), 400
+        try:
+            where, params, start, end = trip_filters(request.args)
+            fmt = response_format()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
         # Pagination
         try:
@@ -58,19 +180,103 @@ def get_trips():
         except ValueError:
             return jsonify({"error": "limit and offset must be integers"}), 400
 
-        query += " LIMIT ? OFFSET ?"
-        params.extend([limit, offset])
+        cursor = request.args.get("cursor")
 
-        rows = conn.execute(query, params).fetchall()
+        if cursor is not None:
+            if limit < 1:
+                return jsonify({"error": "limit must be positive"}), 400
+            try:
+                after = decode_cursor(cursor)
+            except ValueError:
+                return jsonify({"error": "invalid cursor"}), 400
 
-        return jsonify([dict(row) for row in rows])
+            trips = keyset_page(conn, where, params, start, end, after, limit)
+            next_cursor = encode_cursor(trips[-1]) if len(trips) == limit else None
+            if fmt != "json":
+                return respond(trips, headers={"X-Next-Cursor": next_cursor or ""})
+            return jsonify({"trips": trips, "next_cursor": next_cursor})
+
+        # Only the monthly partitions overlapping the range are read.
+        source = trips_source(conn, start, end)
+        query = ENRICHED_TRIPS_SQL.format(source=source) + f" WHERE {where} LIMIT ? OFFSET ?"
+        params.extend([limit, offset])
+
+        return respond(conn.execute(query, params))
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
     finally:
         if conn:
-            conn.close()
+            release_connection(conn)
+
+
+def export_rows(where, params, start, end):
+    """Yield (columns, batch of rows) for the matching trips, oldest partition first.
+
+    Rows are pulled with fetchmany, so memory stays bounded by one batch no
+    matter how large the result is. There is no ORDER BY: sorting would
+    make SQLite buffer the whole result before the first row comes out.
+    The generator holds its own pooled connection and returns it when it
+    finishes or is closed because the client went away.
+    """
+    conn = get_connection()
+    try:
+        # With no partition in range the empty template still yields the
+        # columns, so a CSV export always starts with its header
+        for table in trip_partitions(conn, start, end) or [PARTITION_TEMPLATE]:
+            cursor = conn.execute(ENRICHED_TRIPS_SQL.format(source=table) + f" WHERE {where}", params)
+            columns = [column[0] for column in cursor.description]
+            while True:
+                rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+                yield columns, rows
+                if len(rows) < EXPORT_BATCH_SIZE:
+                    break
+    finally:
+        release_connection(conn)
+
+def csv_chunks(batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    header_sent = False
+    for columns, rows in batches:
+        if not header_sent:
+            writer.writerow(columns)
+            header_sent = True
+        writer.writerows(rows)
+        if buffer.tell():
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+def ndjson_chunks(batches):
+    for columns, rows in batches:
+        if rows:
+            yield "".join(json.dumps(dict(zip(columns, row))) + "\n" for row in rows)
+
+@trips_bp.route("/export", methods=["GET"])
+def export_trips():
+    """Stream every trip matching the search filters as CSV (default) or NDJSON"""
+    export_format = request.args.get("format", "csv")
+    if export_format not in EXPORT_MIMETYPES:
+        return jsonify({"error": "format must be csv or ndjson"}), 400
+
+    try:
+        where, params, start, end = trip_filters(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    batches = export_rows(where, params, start, end)
+    chunks = csv_chunks(batches) if export_format == "csv" else ndjson_chunks(batches)
+
+    # No Content-Length, so the body is sent with chunked transfer encoding.
+    return Response(
+        stream_with_context(chunks),
+        mimetype=EXPORT_MIMETYPES[export_format],
+        headers={"Content-Disposition": f"attachment; filename=nyc-taxi-trips.{export_format}"},
+    )
 
 
 @trips_bp.route("/<int:trip_id>", methods=["GET"])
@@ -78,19 +284,22 @@ def get_trip(trip_id):
     conn = None
     try:
         conn = get_connection()
-        row = conn.execute(
-            "SELECT * FROM v_trips_enriched WHERE trip_id = ?",
-            (trip_id,)
-        ).fetchone()
+        partition = trip_partition_for_id(conn, trip_id)
+        row = None
+        if partition:
+            row = conn.execute(
+                ENRICHED_TRIPS_SQL.format(source=partition) + " WHERE t.trip_id = ?",
+                (trip_id,)
+            ).fetchone()
 
         if not row:
             return jsonify({"error": "Trip not found"}), 404
 
-        return jsonify(dict(row))
+        return respond(dict(row))
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
     finally:
         if conn:
-            conn.close()
+            release_connection(conn)
@@ -1,5 +1,5 @@
 from flask import Blueprint, jsonify
-from database import get_connection
+from database import get_connection, release_connection
 
 zones_bp = Blueprint("zones", __name__)
 
@@ -9,9 +9,9 @@ def get_zones():
     try:
         conn = get_connection()
         rows = conn.execute("SELECT * FROM zones").fetchall()
-        return jsonify([dict(row) for row in rows])
+        return jsonify(rows)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     finally:
         if conn:
-            conn.close()
+            release_connection(conn)
@@ -0,0 +1,108 @@
+import csv
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+import database
+from cache import result_cache
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+sys.path.insert(0, os.path.join(REPO_DIR, "database"))
+
+import insert_data  # noqa: E402
+
+ZONES = [
+    (1, "EWR", "Newark Airport", "EWR"),
+    (132, "Queens", "JFK Airport", "Airports"),
+    (138, "Queens", "LaGuardia Airport", "Airports"),
+    (161, "Manhattan", "Midtown Center", "Yellow Zone"),
+    (236, "Manhattan", "Upper East Side North", "Yellow Zone"),
+    (237, "Manhattan", "Upper East Side South", "Yellow Zone"),
+]
+# Enough zones that a zone filter is as selective as on real data, so the
+# planner makes the same index choices the query plan tests check.
+ZONES += [(location_id, "Brooklyn", f"Zone {location_id}", "Boro Zone") for location_id in range(10, 34)]
+
+TRIP_FIELDS = [
+    "VendorID", "tpep_pickup_datetime", "tpep_dropoff_datetime", "passenger_count",
+    "trip_distance", "RatecodeID", "store_and_fwd_flag", "PULocationID", "DOLocationID",
+    "payment_type", "fare_amount", "extra", "mta_tax", "tip_amount", "tolls_amount",
+    "improvement_surcharge", "total_amount", "congestion_surcharge", "trip_speed_mph",
+    "cost_per_mile", "time_category", "tip_percentage", "efficiency_score",
+]
+
+
+def time_category(hour):
+    if hour < 6:
+        return "late_night"
+    if hour < 10:
+        return "morning_rush"
+    if hour < 16:
+        return "midday"
+    if hour < 20:
+        return "evening_rush"
+    return "night"
+
+
+def write_trips(path, month, num_trips, seed):
+    rng = random.Random(seed)
+    start = datetime.strptime(month + "-01", "%Y-%m-%d")
+    location_ids = [zone[0] for zone in ZONES]
+
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(TRIP_FIELDS)
+        for _ in range(num_trips):
+            pickup = start + timedelta(seconds=rng.randint(0, 27 * 86400))
+            distance = round(rng.uniform(0.5, 12), 2)
+            minutes = max(5, round(distance * rng.uniform(2, 6)))
+            dropoff = pickup + timedelta(minutes=minutes)
+            fare = round(2.5 + distance * 2.5, 2)
+            tip = round(fare * 0.15, 2)
+            total = round(fare + tip + 0.8, 2)
+            speed = round(distance / (minutes / 60), 2)
+            writer.writerow([
+                rng.choice([1, 2]),
+                pickup.strftime("%Y-%m-%d %H:%M:%S"),
+                dropoff.strftime("%Y-%m-%d %H:%M:%S"),
+                rng.randint(1, 4), distance, 1, "N",
+                rng.choice(location_ids), rng.choice(location_ids),
+                1, fare, 0.5, 0.5, tip, 0, 0.3, total, "",
+                speed, round(fare / distance, 2), time_category(pickup.hour),
+                round(tip / fare * 100, 2), round(speed / fare, 2),
+            ])
+
+
+@pytest.fixture(scope="session", autouse=True)
+def fixture_db(tmp_path_factory):
+    """Build a two-month database with insert_data.py and point the API at it"""
+    root = tmp_path_factory.mktemp("nyc_taxi")
+
+    zones_file = root / "taxi_zone_lookup.csv"
+    with open(zones_file, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["LocationID", "Borough", "Zone", "service_zone"])
+        writer.writerows(ZONES)
+
+    insert_data.ZONES_FILE = str(zones_file)
+    insert_data.DB_FILE = str(root / "nyc_taxi.db")
+    insert_data.DUPLICATES_LOG = str(root / "duplicates.csv")
+    insert_data.FINGERPRINTS_FILE = str(root / "trip_fingerprints.npy")
+    insert_data.OD_MATRIX_FILE = str(root / "od_matrix.npy")
+
+    argv = sys.argv
+    try:
+        for month, extra_args, seed in [("2019-01", [], 1), ("2019-02", ["--append"], 2)]:
+            trips_file = root / f"yellow_tripdata_{month}_cleaned.csv"
+            write_trips(trips_file, month, 1500, seed)
+            sys.argv = ["insert_data.py", "--trips", str(trips_file)] + extra_args
+            insert_data.main()
+    finally:
+        sys.argv = argv
+
+    database.DB_PATH = insert_data.DB_FILE
+    result_cache.clear()
+    return insert_data.DB_FILE
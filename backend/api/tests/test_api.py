@@ -26,3 +26,865 @@ def test_top_routes(client):
     r = client.get("/api/stats/top-routes")
     assert r.status_code == 200
 
+
+def test_partition_pruning(fixture_db):
+    import sqlite3
+    from database import date_bounds, trips_source
+    conn = sqlite3.connect(fixture_db)
+    assert trips_source(conn, *date_bounds("2019-02-03", "2019-02-10")) == "trips_2019_02"
+    assert "trips_2019_01" in trips_source(conn, *date_bounds("2019-01-30", "2019-02-02"))
+    assert "trips_2019_02" in trips_source(conn)
+    conn.close()
+
+def test_trips_date_range(client):
+    r = client.get("/api/trips?start_date=2019-02-03&end_date=2019-02-10&limit=500")
+    assert r.status_code == 200
+    trips = r.get_json()
+    assert trips
+    assert all("2019-02-03" <= t["pickup_date"] <= "2019-02-10" for t in trips)
+
+def test_bad_date(client):
+    r = client.get("/api/trips?start_date=2019-02&end_date=2019-02-10")
+    assert r.status_code == 400
+
+def test_trip_in_later_partition(client):
+    r = client.get("/api/trips/2000")
+    assert r.status_code == 200
+    assert r.get_json()["pickup_date"].startswith("2019-02")
+
+def test_summary_date_range(client):
+    whole = client.get("/api/stats/summary").get_json()
+    january = client.get("/api/stats/summary?start_date=2019-01-01&end_date=2019-01-31").get_json()
+    assert 0 < january["total_trips"] < whole["total_trips"]
+
+def test_aggregates_match_trips(client, fixture_db):
+    import sqlite3
+    conn = sqlite3.connect(fixture_db)
+    trip_count, revenue = conn.execute("SELECT COUNT(*), SUM(total_amount) FROM trips").fetchone()
+    conn.close()
+
+    daily = client.get("/api/stats/daily").get_json()
+    hourly = client.get("/api/stats/hourly").get_json()
+    boroughs = client.get("/api/stats/boroughs").get_json()
+    assert sum(d["total_trips"] for d in daily) == trip_count
+    assert sum(h["trip_count"] for h in hourly) == trip_count
+    assert abs(sum(b["total_revenue"] for b in boroughs) - revenue) < 0.1
+
+def test_pool_reuses_connections(client):
+    before = client.get("/api/pool").get_json()
+    for _ in range(5):
+        assert client.get("/api/zones/").status_code == 200
+    after = client.get("/api/pool").get_json()
+    assert after["checkouts"] - before["checkouts"] == 5
+    assert after["opened"] - before["opened"] <= 1
+    assert after["in_use"] == 0
+
+def test_pool_is_read_only():
+    import sqlite3
+    from database import get_connection, release_connection
+    conn = get_connection()
+    try:
+        with pytest.raises(sqlite3.OperationalError):
+            conn.execute("DELETE FROM zones")
+    finally:
+        release_connection(conn)
+
+def walk_pages(client, query):
+    trips, cursor = [], ""
+    while cursor is not None:
+        r = client.get(f"/api/trips?{query}&cursor={cursor}")
+        assert r.status_code == 200
+        page = r.get_json()
+        trips += page["trips"]
+        cursor = page["next_cursor"]
+    return trips
+
+def test_cursor_pagination_covers_every_trip(client, fixture_db):
+    import sqlite3
+    conn = sqlite3.connect(fixture_db)
+    expected = conn.execute("SELECT trip_id FROM trips ORDER BY tpep_pickup_datetime, trip_id").fetchall()
+    conn.close()
+
+    trips = walk_pages(client, "limit=37")
+    assert [t["trip_id"] for t in trips] == [row[0] for row in expected]
+
+def test_cursor_pagination_with_filters(client):
+    query = "start_date=2019-01-20&end_date=2019-02-05&min_fare=10&limit=7"
+    trips = walk_pages(client, query)
+    everything = client.get(f"/api/trips?{query.replace('limit=7', 'limit=100000')}").get_json()
+    assert sorted(t["trip_id"] for t in trips) == sorted(t["trip_id"] for t in everything)
+    assert {t["pickup_date"][:7] for t in trips} == {"2019-01", "2019-02"}
+    assert all(t["fare_amount"] >= 10 for t in trips)
+
+def test_bad_cursor(client):
+    assert client.get("/api/trips?cursor=not-a-cursor").status_code == 400
+
+def test_export_ndjson_streams_every_match(client, monkeypatch):
+    import json
+    from routes import trips
+    monkeypatch.setattr(trips, "EXPORT_BATCH_SIZE", 50)
+    query = "start_date=2019-01-20&end_date=2019-02-05&min_fare=10"
+    r = client.get(f"/api/trips/export?format=ndjson&{query}")
+    assert r.status_code == 200
+    assert r.is_streamed and r.mimetype == "application/x-ndjson"
+    exported = [json.loads(line) for line in r.get_data(as_text=True).splitlines()]
+    everything = client.get(f"/api/trips?{query}&limit=100000").get_json()
+    assert sorted(t["trip_id"] for t in exported) == sorted(t["trip_id"] for t in everything)
+
+def test_export_csv(client):
+    import csv
+    r = client.get("/api/trips/export?pickup_zone=JFK Airport")
+    assert r.status_code == 200 and r.mimetype == "text/csv"
+    rows = list(csv.DictReader(r.get_data(as_text=True).splitlines()))
+    assert rows and all(row["pickup_zone"] == "JFK Airport" for row in rows)
+    assert len(rows) == len(client.get("/api/trips?pickup_zone=JFK Airport&limit=100000").get_json())
+
+    # Outside every partition: just the header, the same as a range with no matches
+    empty = client.get("/api/trips/export?start_date=2020-01-01&end_date=2020-01-31").get_data(as_text=True)
+    no_match = client.get("/api/trips/export?pickup_zone=Nowhere").get_data(as_text=True)
+    assert empty == no_match and empty.startswith("trip_id,") and empty.count("\n") == 1
+
+def test_export_bad_format(client):
+    assert client.get("/api/trips/export?format=xml").status_code == 400
+
+def test_trips_as_arrow(client):
+    import pyarrow as pa
+    r = client.get("/api/trips?limit=100", headers={"Accept": "application/vnd.apache.arrow.stream"})
+    assert r.status_code == 200 and r.mimetype == "application/vnd.apache.arrow.stream"
+    table = pa.ipc.open_stream(r.data).read_all()
+    assert table.column("trip_id").to_pylist() == [t["trip_id"] for t in client.get("/api/trips?limit=100").get_json()]
+
+def test_trip_pages_as_arrow(client):
+    import pyarrow as pa
+    r = client.get("/api/trips?cursor=&limit=10&format=arrow")
+    assert pa.ipc.open_stream(r.data).read_all().num_rows == 10
+    assert r.headers["X-Next-Cursor"] == client.get("/api/trips?cursor=&limit=10").get_json()["next_cursor"]
+
+@pytest.mark.parametrize("path", ["/api/stats/fare-distribution", "/api/stats/hourly", "/api/stats/overview"])
+def test_stats_as_parquet(client, path):
+    import io
+    import pyarrow.parquet as pq
+    r = client.get(f"{path}?format=parquet")
+    assert r.status_code == 200 and r.mimetype == "application/vnd.apache.parquet"
+    expected = client.get(path).get_json()
+    assert pq.read_table(io.BytesIO(r.data)).to_pylist() == (expected if isinstance(expected, list) else [expected])
+
+def test_bad_response_format(client):
+    assert client.get("/api/stats/hourly?format=xml").status_code == 400
+    assert client.get("/api/trips?format=xml").status_code == 400
+
+@pytest.mark.parametrize("use_orjson", [False, True])
+def test_row_json_matches_dicts(fixture_db, monkeypatch, use_orjson):
+    import json
+    import sqlite3
+    import json_provider
+    from routes.trips import ENRICHED_TRIPS_SQL
+    if use_orjson and json_provider.orjson is None:
+        pytest.skip("orjson not installed")
+    if not use_orjson:
+        monkeypatch.setattr(json_provider, "orjson", None)
+
+    conn = sqlite3.connect(fixture_db)
+    conn.row_factory = sqlite3.Row
+    trips = conn.execute(ENRICHED_TRIPS_SQL.format(source="trips") + " LIMIT 200").fetchall()
+    mixed = conn.execute("""
+        SELECT 1 AS a, NULL AS b, 'say "hi", caf\u00e9' AS c, 2.5 AS d, 3 AS "tip_%", '%s' AS "pct_%s"
+        UNION ALL SELECT NULL, 'x', NULL, 1e300, NULL, '100%'
+    """).fetchall()
+    conn.close()
+
+    for rows in (trips, mixed):
+        encoded = json_provider.encode_rows(rows)
+        assert json.loads(encoded) == [dict(row) for row in rows]
+        assert list(json.loads(encoded)[0]) == rows[0].keys()
+
+def test_cached_stats_hits(client):
+    from cache import result_cache
+    result_cache.clear()
+    before = result_cache.snapshot()
+    first = client.get("/api/stats/hourly")
+    second = client.get("/api/stats/hourly")
+    after = result_cache.snapshot()
+    assert first.data == second.data and first.headers["ETag"] == second.headers["ETag"]
+    assert after["misses"] - before["misses"] == 1 and after["hits"] - before["hits"] == 1
+    assert client.get("/api/stats/hourly?format=arrow").headers["ETag"] != first.headers["ETag"]
+    assert client.get("/api/cache").get_json()["entries"] == 2
+
+def test_cache_invalidated_by_data_version(client, fixture_db, monkeypatch):
+    import sqlite3
+    import database
+    from data_version import bump_data_version
+    monkeypatch.setattr(database, "VERSION_CHECK_SECONDS", 0)
+    client.get("/api/stats/daily")
+    misses = client.get("/api/cache").get_json()["misses"]
+
+    conn = sqlite3.connect(fixture_db)
+    bump_data_version(conn)
+    conn.commit()
+    conn.close()
+
+    client.get("/api/stats/daily")
+    stats = client.get("/api/cache").get_json()
+    assert stats["misses"] == misses + 1 and stats["invalidated"] >= 1
+
+def test_stats_conditional_requests(client, fixture_db, monkeypatch):
+    import sqlite3
+    import database
+    from data_version import bump_data_version
+    monkeypatch.setattr(database, "VERSION_CHECK_SECONDS", 0)
+    r = client.get("/api/stats/boroughs")
+    assert r.status_code == 200
+    assert r.headers["Cache-Control"] == "public, max-age=60" and r.last_modified
+    etag = r.headers["ETag"]
+
+    monkeypatch.setattr(database, "VERSION_CHECK_SECONDS", 60)
+    cache_before = client.get("/api/cache").get_json()
+    pool_before = client.get("/api/pool").get_json()
+    revalidated = client.get("/api/stats/boroughs", headers={"If-None-Match": etag})
+    assert revalidated.status_code == 304 and revalidated.data == b"" and revalidated.headers["ETag"] == etag
+    since = client.get("/api/stats/boroughs", headers={"If-Modified-Since": r.headers["Last-Modified"]})
+    assert since.status_code == 304
+    # Neither the cache nor the database was touched
+    assert client.get("/api/cache").get_json()["misses"] == cache_before["misses"]
+    assert client.get("/api/cache").get_json()["hits"] == cache_before["hits"]
+    assert client.get("/api/pool").get_json()["checkouts"] == pool_before["checkouts"]
+
+    # Validators never stand in for validating the request itself
+    for bad in ["/api/stats/batch?metrics=bogus", "/api/stats/top-routes?k=abc",
+                "/api/stats/cube?group_by=nope", "/api/stats/summary?start_date=garbage"]:
+        for headers in [{"If-Modified-Since": r.headers["Last-Modified"]}, {"If-None-Match": "*"}]:
+            assert client.get(bad, headers=headers).status_code == 400, (bad, headers)
+    # A valid request not cached yet is run, then revalidated
+    fresh = client.get("/api/stats/hourly?start_date=2019-01-02", headers={"If-Modified-Since": r.headers["Last-Modified"]})
+    assert fresh.status_code == 304
+
+    monkeypatch.setattr(database, "VERSION_CHECK_SECONDS", 0)
+    conn = sqlite3.connect(fixture_db)
+    bump_data_version(conn)
+    conn.commit()
+    conn.close()
+    changed = client.get("/api/stats/boroughs", headers={"If-None-Match": etag})
+    assert changed.status_code == 200 and changed.headers["ETag"] != etag
+
+def test_stats_batch(client, monkeypatch):
+    import database
+    from cache import result_cache
+    from routes import stats
+    metrics = ["summary", "overview", "hourly", "boroughs", "daily", "time-categories", "top-routes", "fare-distribution"]
+    query = "start_date=2019-01-05&end_date=2019-02-10"
+
+    result_cache.clear()
+    monkeypatch.setattr(database, "VERSION_CHECK_SECONDS", 60)
+    database.data_version()
+    totals_calls = []
+    daily_totals = stats.daily_totals
+    monkeypatch.setattr(stats, "daily_totals", lambda *args: totals_calls.append(args) or daily_totals(*args))
+    checkouts = client.get("/api/pool").get_json()["checkouts"]
+
+    r = client.get(f"/api/stats/batch?metrics={','.join(metrics)}&{query}")
+    assert r.status_code == 200
+    assert client.get("/api/pool").get_json()["checkouts"] == checkouts + 1
+    assert len(totals_calls) == 1
+
+    batch = r.get_json()
+    assert list(batch) == metrics
+    for name in metrics:
+        assert batch[name] == client.get(f"/api/stats/{name}?{query}").get_json()
+
+def test_stats_batch_bad_metrics(client):
+    assert client.get("/api/stats/batch").status_code == 400
+    assert client.get("/api/stats/batch?metrics=hourly,nope").status_code == 400
+    assert client.get("/api/stats/batch?metrics=hourly&format=arrow").status_code == 406
+    assert client.get("/api/stats/batch?metrics=hourly,top-routes&k=0").status_code == 400
+    # k and metric are only checked when top-routes is asked for
+    assert client.get("/api/stats/batch?metrics=hourly&k=0&metric=nope").status_code == 200
+
+def test_result_cache_budget_and_ttl(monkeypatch):
+    from cache import ResultCache
+    cache = ResultCache(max_bytes=10, ttl=60)
+    assert cache.get("a", 1) is None
+    cache.put("a", 1, b"12345", "application/json")
+    cache.put("b", 1, b"12345", "application/json")
+    assert cache.get("a", 1) is not None
+    cache.put("c", 1, b"12345", "application/json")
+    assert cache.get("b", 1) is None and cache.get("a", 1) and cache.get("c", 1)
+    assert cache.snapshot()["evicted"] == 1
+
+    cache.ttl = 0
+    cache.put("d", 1, b"1", "application/json")
+    assert cache.get("d", 1) is None and cache.snapshot()["expired"] == 1
+
+def asgi_get(asgi_app, path, query="", headers=()):
+    """GET through an ASGI app; returns (status, headers, body, number of body messages)"""
+    import asyncio
+    scope = {
+        "type": "http", "method": "GET", "path": path, "query_string": query.encode(),
+        "headers": [(b"origin", b"http://localhost:5500")] + [(name.encode(), value.encode()) for name, value in headers],
+        "http_version": "1.1",
+        "scheme": "http", "server": ("testserver", 80), "client": ("127.0.0.1", 4000), "root_path": "",
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(asgi_app(scope, receive, send))
+    headers = {name.decode(): value.decode() for name, value in messages[0]["headers"]}
+    bodies = [m["body"] for m in messages[1:] if m["body"]]
+    return messages[0]["status"], headers, b"".join(bodies), len(bodies)
+
+def test_asgi_matches_wsgi(client):
+    import json
+    from asgi import application
+    status, headers, body, _ = asgi_get(application, "/api/trips", "limit=20&min_fare=10")
+    assert status == 200 and headers["content-type"] == "application/json"
+    assert json.loads(body) == client.get("/api/trips?limit=20&min_fare=10").get_json()
+    assert asgi_get(application, "/api/trips/999999999")[0] == 404
+
+def test_asgi_serves_cached_stats_on_loop(monkeypatch):
+    import database
+    from asgi import application
+    from cache import result_cache
+    result_cache.clear()
+    monkeypatch.setattr(database, "VERSION_CHECK_SECONDS", 60)
+    first = asgi_get(application, "/api/stats/time-categories")
+    on_loop = application.stats["served_on_loop"]
+    checkouts = database.pool_stats()["checkouts"]
+    second = asgi_get(application, "/api/stats/time-categories")
+    assert second[0] == 200 and second[2] == first[2]
+    assert second[1]["access-control-allow-origin"] and second[1]["etag"] == first[1]["etag"]
+    assert application.stats["served_on_loop"] == on_loop + 1
+    assert database.pool_stats()["checkouts"] == checkouts
+
+    # Revalidation headers never answer for unknown routes or bad params
+    for header in [("If-None-Match", "*"), ("If-Modified-Since", first[1]["last-modified"])]:
+        assert asgi_get(application, "/api/stats/nope", headers=[header])[0] == 404
+        assert asgi_get(application, "/api/stats/top-routes", "k=abc", headers=[header])[0] == 400
+        assert asgi_get(application, "/api/stats/time-categories", headers=[header])[0] == 304
+
+def test_asgi_streams_exports(monkeypatch):
+    from asgi import application
+    from routes import trips
+    monkeypatch.setattr(trips, "EXPORT_BATCH_SIZE", 100)
+    status, _, body, chunks = asgi_get(application, "/api/trips/export", "start_date=2019-02-01&end_date=2019-02-28")
+    assert status == 200 and chunks > 1
+    assert len(body.decode().splitlines()) == 1501
+
+def test_asgi_backpressure_and_timeout():
+    import time
+    from flask import Flask
+    from asgi import ASGIApp
+    from app import app
+
+    busy = ASGIApp(app, max_pending=0)
+    status, headers, _, _ = asgi_get(busy, "/api/trips")
+    assert status == 503 and headers["retry-after"] == "1" and busy.stats["rejected"] == 1
+
+    slow_app = Flask("slow")
+    slow_app.add_url_rule("/slow", "slow", lambda: time.sleep(0.5) or "done")
+    slow = ASGIApp(slow_app, timeout=0.05)
+    assert asgi_get(slow, "/slow")[0] == 504
+    assert slow.stats["timed_out"] == 1
+    time.sleep(0.6)
+    assert slow.pending == 0
+
+def test_asgi_streamed_body_counts_as_pending():
+    import asyncio
+    from flask import Flask
+    from asgi import ASGIApp
+
+    stream_app = Flask("stream")
+    stream_app.add_url_rule("/stream", "stream", lambda: (chunk for chunk in ["a", "b", "c"]))
+    streaming = ASGIApp(stream_app, max_pending=1)
+    pending_while_streaming = []
+
+    async def run():
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            if message["type"] == "http.response.body" and message["body"]:
+                pending_while_streaming.append(streaming.pending)
+                if len(pending_while_streaming) == 1:
+                    # A second request while the first body is still streaming
+                    status = asgi_status(streaming)
+                    pending_while_streaming.append(await status)
+
+        async def asgi_status(asgi_app):
+            messages = []
+
+            async def collect(message):
+                messages.append(message)
+            scope = {"type": "http", "method": "GET", "path": "/stream", "query_string": b"", "headers": []}
+            await asgi_app(scope, receive, collect)
+            return messages[0]["status"]
+
+        scope = {"type": "http", "method": "GET", "path": "/stream", "query_string": b"", "headers": []}
+        await streaming(scope, receive, send)
+
+    asyncio.run(run())
+    assert pending_while_streaming[:2] == [1, 503]
+    assert streaming.pending == 0
+
+def metric_value(text, sample):
+    for line in text.splitlines():
+        if line.startswith(sample + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return 0.0
+
+def test_prometheus_metrics(client):
+    before = client.get("/api/metrics").get_data(as_text=True)
+    assert client.get("/api/trips?limit=40").status_code == 200
+    client.get("/api/trips/999999999")
+    r = client.get("/api/metrics")
+    assert r.status_code == 200 and r.mimetype == "text/plain"
+    text = r.get_data(as_text=True)
+
+    trips = 'endpoint="/api/trips/"'
+    assert "# TYPE taxi_api_request_duration_seconds histogram" in text
+    for name in ["request_duration_seconds", "sql_duration_seconds", "serialization_duration_seconds"]:
+        sample = f"taxi_api_{name}_count{{{trips}}}"
+        assert metric_value(text, sample) == metric_value(before, sample) + 1
+    rows = f"taxi_api_sql_rows_sum{{{trips}}}"
+    assert metric_value(text, rows) - metric_value(before, rows) >= 40
+    not_found = 'taxi_api_requests_total{endpoint="/api/trips/<int:trip_id>",method="GET",status="404"}'
+    assert metric_value(text, not_found) == metric_value(before, not_found) + 1
+    assert f'taxi_api_request_duration_seconds_bucket{{{trips},le="+Inf"}}' in text
+    for name in ["pool_checkouts_total", "pool_opened_total", "cache_hits_total", "cache_misses_total"]:
+        assert f"# TYPE taxi_api_{name} counter" in text and f"\ntaxi_api_{name} " in text
+    assert "# TYPE taxi_api_pool_in_use gauge" in text
+
+def test_streamed_export_metrics(client):
+    before = client.get("/api/metrics").get_data(as_text=True)
+    export = 'endpoint="/api/trips/export"'
+    rows = f"taxi_api_sql_rows_sum{{{export}}}"
+    count = f"taxi_api_request_duration_seconds_count{{{export}}}"
+
+    r = client.get("/api/trips/export?format=ndjson")
+    body = r.get_data(as_text=True)
+    middle = client.get("/api/metrics").get_data(as_text=True)
+    r.close()
+    text = client.get("/api/metrics").get_data(as_text=True)
+
+    # Recorded once, when the body is closed, with the rows it fetched
+    assert metric_value(middle, count) == metric_value(before, count)
+    assert metric_value(text, count) == metric_value(before, count) + 1
+    assert metric_value(text, rows) - metric_value(before, rows) >= body.count("\n") > 0
+    sql = f"taxi_api_sql_duration_seconds_sum{{{export}}}"
+    assert metric_value(text, sql) > metric_value(before, sql)
+
+def test_iterated_cursor_is_timed(monkeypatch, caplog):
+    import sqlite3
+    import metrics
+    conn = sqlite3.connect(":memory:", factory=metrics.TimedConnection)
+    request = metrics.RequestMetrics()
+    token = metrics.current_request.set(request)
+    try:
+        cursor = conn.execute("WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 50) SELECT i FROM n")
+        monkeypatch.setattr(metrics, "SLOW_QUERY_SECONDS", 0)
+        with caplog.at_level("WARNING", logger="taxi_api.slow_queries"):
+            assert [row[0] for row in cursor] == list(range(1, 51))
+    finally:
+        metrics.current_request.reset(token)
+        conn.close()
+    assert request.sql_rows == 50 and request.sql_seconds > 0
+    assert any("WITH RECURSIVE" in record.getMessage() for record in caplog.records)
+
+def test_slow_query_log(client, monkeypatch, caplog):
+    import metrics
+    monkeypatch.setattr(metrics, "SLOW_QUERY_SECONDS", 0)
+    with caplog.at_level("WARNING", logger="taxi_api.slow_queries"):
+        client.get("/api/trips?limit=5&pickup_zone=Midtown Center")
+    slow = [record.getMessage() for record in caplog.records if "t.PULocationID = ?" in record.getMessage()]
+    assert slow and "params: [161, 5, 0]" in slow[0]
+    assert "plan:" in slow[0] and "SEARCH trips_2019_01 USING INDEX" in slow[0]
+
+def test_unhandled_exceptions_are_logged(client, monkeypatch, caplog):
+    import cache
+
+    def broken(read=True):
+        raise RuntimeError("version table is gone")
+
+    monkeypatch.setattr(cache, "data_version", broken)
+    with caplog.at_level("ERROR"):
+        r = client.get("/api/stats/hourly")
+    assert r.status_code == 500
+    assert any("Unhandled error in GET /api/stats/hourly" in record.getMessage() for record in caplog.records)
+    assert 'taxi_api_exceptions_total{endpoint="/api/stats/hourly"} 1' in client.get("/api/metrics").get_data(as_text=True)
+
+def test_top_k_routes_matches_stable_sort():
+    import random
+    from algorithm import top_k_routes
+    rng = random.Random(7)
+    routes = [
+        {"id": i, "trip_count": rng.randint(1, 30), "avg_fare": rng.choice([None, 9.5, 12.0, 15.25])}
+        for i in range(2000)
+    ]
+    for metric in ["trip_count", "avg_fare"]:
+        ranked = [r for r in routes if r[metric] is not None]
+        ranked = sorted(ranked, key=lambda r: -r[metric])
+        for k in [1, 10, 500, 5000]:
+            assert top_k_routes(iter(routes), k, metric) == ranked[:k]
+    assert top_k_routes(routes, 0) == []
+    with pytest.raises(ValueError):
+        top_k_routes(routes, 5, "trip_id")
+
+def test_top_routes_k_and_metric(client, fixture_db, monkeypatch):
+    import sqlite3
+    from cache import result_cache
+    from routes import stats
+    monkeypatch.setattr(stats, "TOP_ROUTES_MIN_TRIPS", 0)
+    # Keep responses computed with the patched threshold out of later tests
+    monkeypatch.setattr(result_cache, "max_bytes", 0)
+    routes = client.get("/api/stats/top-routes?k=7&metric=revenue").get_json()
+    assert len(routes) == 7
+
+    conn = sqlite3.connect(fixture_db)
+    best = conn.execute("SELECT ROUND(total_amount_sum, 2) FROM agg_routes ORDER BY total_amount_sum DESC LIMIT 7").fetchall()
+    conn.close()
+    assert [r["revenue"] for r in routes] == [row[0] for row in best]
+    assert len(client.get("/api/stats/top-routes").get_json()) == 20
+
+    assert client.get("/api/stats/top-routes?k=0").status_code == 400
+    assert client.get("/api/stats/top-routes?k=abc").status_code == 400
+    assert client.get("/api/stats/top-routes?metric=distance").status_code == 400
+
+SEARCH_PLANS = [
+    ({"start_date": "2019-01-10", "end_date": "2019-01-12"}, ["pickup_datetime"]),
+    ({"pickup_zone": "Midtown Center"}, ["pickup_search"]),
+    ({"dropoff_zone": "JFK Airport"}, ["dropoff_search"]),
+    # Zone plus date can seek on either index, whichever is more selective.
+    ({"pickup_zone": "Midtown Center", "start_date": "2019-01-10", "end_date": "2019-01-12"},
+     ["pickup_search", "pickup_datetime"]),
+    ({"dropoff_zone": "JFK Airport", "start_date": "2019-01-10", "end_date": "2019-01-12"},
+     ["dropoff_search", "pickup_datetime"]),
+    ({"pickup_zone": "Midtown Center", "dropoff_zone": "JFK Airport"}, ["route_search"]),
+    ({"pickup_zone": "Midtown Center", "min_fare": "20", "max_fare": "40"}, ["pickup_search"]),
+    ({"min_fare": "20", "start_date": "2019-01-10", "end_date": "2019-01-12"}, ["pickup_datetime", "time_fare", "fare"]),
+]
+
+@pytest.mark.parametrize("args,indexes", SEARCH_PLANS)
+def test_search_query_plan(args, indexes):
+    from database import get_connection, release_connection
+    from routes.trips import trip_filters, keyset_sql
+
+    where, params, _, _ = trip_filters(args)
+    conn = get_connection()
+    try:
+        plan = [row[3] for row in conn.execute(
+            "EXPLAIN QUERY PLAN " + keyset_sql("trips_2019_01", where, ("2019-01-10 00:00:00", 1)),
+            params + ["2019-01-10 00:00:00", "2019-01-10 00:00:00", 1, 50]
+        )]
+    finally:
+        release_connection(conn)
+
+    trips_step = next(step for step in plan if step.split()[1] == "t")
+    assert trips_step.startswith("SEARCH t USING INDEX idx_trips_2019_01")
+    assert any(f"idx_trips_2019_01_{index} " in trips_step for index in indexes)
+    assert "USE TEMP B-TREE FOR ORDER BY" not in plan
+
+def test_zone_name_resolves_to_ids(client):
+    trips = client.get("/api/trips?pickup_zone=JFK%20Airport&limit=1000").get_json()
+    assert trips
+    assert all(t["pickup_zone"] == "JFK Airport" for t in trips)
+    assert client.get("/api/trips?pickup_zone=Nowhere").get_json() == []
+
+def test_od_matrix_matches_trips(client, fixture_db, tmp_path):
+    import os
+    import sqlite3
+    import numpy as np
+    from od_matrix import rebuild_od_matrix
+    conn = sqlite3.connect(fixture_db)
+
+    body = client.get("/api/stats/od-matrix").get_json()
+    size = conn.execute("SELECT MAX(LocationID) FROM zones").fetchone()[0]
+    assert body["labels"] == list(range(1, size + 1))
+    assert len(body["matrix"]) == size and len(body["matrix"][0]) == size
+    assert sum(body["outbound"]) == conn.execute("SELECT COUNT(*) FROM trips").fetchone()[0]
+    for pickup, dropoff, count in conn.execute("SELECT PULocationID, DOLocationID, COUNT(*) FROM trips GROUP BY 1, 2"):
+        assert body["matrix"][pickup - 1][dropoff - 1] == count
+    for dropoff, count in conn.execute("SELECT DOLocationID, COUNT(*) FROM trips GROUP BY 1"):
+        assert body["inbound"][dropoff - 1] == count
+
+    body = client.get("/api/stats/od-matrix?group=borough&metric=avg_fare").get_json()
+    expected = conn.execute("""
+        SELECT pu.Borough, do.Borough, AVG(fare_amount)
+        FROM trips t
+        JOIN zones pu ON t.PULocationID = pu.LocationID
+        JOIN zones do ON t.DOLocationID = do.LocationID
+        GROUP BY 1, 2
+    """).fetchall()
+    assert body["labels"] == sorted(body["labels"])
+    for pickup, dropoff, avg_fare in expected:
+        assert body["matrix"][body["labels"].index(pickup)][body["labels"].index(dropoff)] == round(avg_fare, 2)
+
+    # The February append was folded into January's matrix; it matches a rebuild
+    rebuild_od_matrix(conn, str(tmp_path / "rebuilt.npy"))
+    conn.close()
+    rebuilt = np.load(tmp_path / "rebuilt.npy")
+    loaded = np.load(os.path.join(os.path.dirname(fixture_db), "od_matrix.npy"))
+    for name in rebuilt.dtype.names:
+        assert np.allclose(loaded[name], rebuilt[name])
+
+    assert client.get("/api/stats/od-matrix?metric=tips").status_code == 400
+    assert client.get("/api/stats/od-matrix?group=city").status_code == 400
+    assert client.get("/api/stats/od-matrix?format=arrow").status_code == 406
+
+def test_od_matrix_is_staged_until_commit_and_rebuilt_when_stale(fixture_db, tmp_path):
+    import os
+    import sqlite3
+    import numpy as np
+    from data_version import read_data_version
+    from od_matrix import install_od_matrix, matrix_version, stage_od_matrix, write_matrix_version
+    conn = sqlite3.connect(fixture_db)
+    installed = np.load(os.path.join(os.path.dirname(fixture_db), "od_matrix.npy"))
+    (partition,) = conn.execute("SELECT table_name FROM trip_partitions ORDER BY month DESC").fetchone()
+    last_trip_id = conn.execute(f"SELECT MAX(trip_id) FROM {partition}").fetchone()[0]
+
+    # A matrix that holds trips the database does not
+    path = str(tmp_path / "od_matrix.npy")
+    doubled = installed.copy()
+    doubled["trip_count"] *= 2
+    np.save(path, doubled)
+
+    # Stamped with the database's version it is trusted and folded into
+    write_matrix_version(path, read_data_version(conn))
+    staged = stage_od_matrix(conn, partition, last_trip_id + 1, last_trip_id, path)
+    assert np.array_equal(np.load(staged)["trip_count"], doubled["trip_count"])
+
+    # Stamped with another version (say, a load whose commit failed after
+    # the swap) it is rebuilt, and only replaced on install
+    write_matrix_version(path, read_data_version(conn) + 1)
+    staged = stage_od_matrix(conn, partition, last_trip_id + 1, last_trip_id, path)
+    assert np.array_equal(np.load(path)["trip_count"], doubled["trip_count"])
+    install_od_matrix(conn, staged, path)
+    assert np.array_equal(np.load(path)["trip_count"], installed["trip_count"])
+    assert matrix_version(path) == read_data_version(conn)
+    assert not os.path.exists(staged)
+    conn.close()
+
+def test_od_route_rows_match_agg_routes(fixture_db):
+    import sqlite3
+    from flows import od_route_rows
+    conn = sqlite3.connect(fixture_db)
+    conn.row_factory = sqlite3.Row
+    expected = conn.execute("""
+        SELECT
+            pickup_borough || ' -> ' || dropoff_borough AS route,
+            pickup_zone,
+            dropoff_zone,
+            trip_count,
+            fare_amount_sum / fare_amount_count AS avg_fare,
+            trip_speed_mph_sum / trip_speed_mph_count AS avg_speed,
+            total_amount_sum AS revenue
+        FROM agg_routes
+        WHERE trip_count > 1
+        ORDER BY pickup_borough, pickup_zone, dropoff_borough, dropoff_zone
+    """).fetchall()
+    conn.close()
+
+    rows = od_route_rows(1)
+    assert [(r["route"], r["pickup_zone"], r["dropoff_zone"], r["trip_count"]) for r in rows] == [
+        (r["route"], r["pickup_zone"], r["dropoff_zone"], r["trip_count"]) for r in expected
+    ]
+    # Rounded in numpy rather than SQLite, so halves may land either side
+    for row, want in zip(rows, expected):
+        for name in ["avg_fare", "avg_speed", "revenue"]:
+            assert row[name] == pytest.approx(want[name], abs=0.006)
+
+def test_top_routes_without_od_matrix(client, monkeypatch):
+    from cache import result_cache
+    from routes import stats
+    monkeypatch.setattr(result_cache, "max_bytes", 0)
+    monkeypatch.setattr(stats, "TOP_ROUTES_MIN_TRIPS", 0)
+    from_matrix = client.get("/api/stats/top-routes?k=10").get_json()
+    monkeypatch.setattr(stats, "od_route_rows", lambda min_trips: None)
+    from_agg_routes = client.get("/api/stats/top-routes?k=10").get_json()
+    assert [r["trip_count"] for r in from_matrix] == [r["trip_count"] for r in from_agg_routes]
+
+def test_cube_matches_trips(client, fixture_db):
+    import sqlite3
+    conn = sqlite3.connect(fixture_db)
+
+    rows = client.get("/api/stats/cube?group_by=pickup_hour&pickup_borough=Manhattan&metrics=trip_count,avg_fare").get_json()
+    expected = conn.execute("""
+        SELECT CAST(STRFTIME('%H', tpep_pickup_datetime) AS INTEGER), COUNT(*), ROUND(AVG(fare_amount), 2)
+        FROM trips t JOIN zones z ON t.PULocationID = z.LocationID
+        WHERE z.Borough = 'Manhattan'
+        GROUP BY 1 ORDER BY 1
+    """).fetchall()
+    assert [(r["pickup_hour"], r["trip_count"], r["avg_fare"]) for r in rows] == expected
+
+    rows = client.get(
+        "/api/stats/cube?group_by=dropoff_borough,time_category&start_date=2019-02-01&end_date=2019-02-10"
+        "&pickup_hour=7,8&pickup_zone=Midtown Center"
+    ).get_json()
+    expected = conn.execute("""
+        SELECT d.Borough, time_category, COUNT(*), ROUND(SUM(total_amount), 2)
+        FROM trips t JOIN zones d ON t.DOLocationID = d.LocationID
+        WHERE tpep_pickup_datetime >= '2019-02-01' AND tpep_pickup_datetime < '2019-02-11'
+          AND CAST(STRFTIME('%H', tpep_pickup_datetime) AS INTEGER) IN (7, 8)
+          AND PULocationID = 161
+        GROUP BY 1, 2 ORDER BY 1, 2
+    """).fetchall()
+    assert [(r["dropoff_borough"], r["time_category"], r["trip_count"], r["total_revenue"]) for r in rows] == expected
+
+    totals = client.get("/api/stats/cube").get_json()
+    assert totals == [client.get("/api/stats/cube?metrics=trip_count,total_revenue,avg_fare,avg_speed").get_json()[0]]
+    assert totals[0]["trip_count"] == conn.execute("SELECT COUNT(*) FROM trips").fetchone()[0]
+    conn.close()
+
+    assert client.get("/api/stats/cube?group_by=fare_amount").status_code == 400
+    assert client.get("/api/stats/cube?metrics=max_fare").status_code == 400
+    assert client.get("/api/stats/cube?pickup_hour=morning").status_code == 400
+    assert client.get("/api/stats/cube?start_date=yesterday").status_code == 400
+
+def test_backfill_aggregates_fills_new_tables(fixture_db, tmp_path):
+    import shutil
+    import sqlite3
+    from aggregates import backfill_aggregates
+    path = tmp_path / "copy.db"
+    shutil.copy(fixture_db, path)
+    conn = sqlite3.connect(path)
+    before = conn.execute("SELECT * FROM agg_cube ORDER BY 1, 2, 3, 4, 5").fetchall()
+    conn.execute("DELETE FROM agg_cube")
+    backfill_aggregates(conn)
+    after = conn.execute("SELECT * FROM agg_cube ORDER BY 1, 2, 3, 4, 5").fetchall()
+    conn.close()
+    assert after == before and before
+
+def test_sketch_definitions_match(fixture_db):
+    import sqlite3
+    import distributions
+    import insert_data
+    import sketches
+    assert distributions.SKETCH_MEASURES == tuple(sketches.SKETCH_MEASURES)
+    # The loader picks the sketched values out of its insert tuples by column name
+    assert insert_data.sketch_row(tuple(insert_data.TRIP_COLUMNS)) == tuple(sketches.SKETCH_COLUMNS)
+
+    conn = sqlite3.connect(fixture_db)
+    stored = {row[0] for row in conn.execute("SELECT DISTINCT measure FROM trip_sketches")}
+    assert stored == set(distributions.SKETCH_MEASURES)
+    assert distributions.stored_sketch_gamma(conn) == sketches.sketch_gamma(conn) == sketches.GAMMA
+    conn.close()
+
+    # Before any sketches exist the loader starts with GAMMA, the API has nothing to read
+    conn = sqlite3.connect(":memory:")
+    assert distributions.stored_sketch_gamma(conn) is None
+    assert sketches.sketch_gamma(conn) == sketches.GAMMA
+    conn.close()
+
+def test_quantiles_within_sketch_accuracy(client, fixture_db):
+    import sqlite3
+    conn = sqlite3.connect(fixture_db)
+
+    def exact(query, params=()):
+        values = [row[0] for row in conn.execute(query, params)]
+        return {q: values[int(q * (len(values) - 1))] for q in (0.5, 0.9, 0.99)}, len(values)
+
+    rows = client.get("/api/stats/quantiles?measure=trip_speed_mph").get_json()
+    want, count = exact("SELECT trip_speed_mph FROM trips ORDER BY 1")
+    assert rows[0]["trip_count"] == count
+    for q, name in [(0.5, "p50"), (0.9, "p90"), (0.99, "p99")]:
+        assert rows[0][name] == pytest.approx(want[q], rel=0.0101)
+
+    rows = client.get(
+        "/api/stats/quantiles?measure=fare_amount&group_by=pickup_date&start_date=2019-02-03&end_date=2019-02-05&quantiles=0.5,0.75"
+    ).get_json()
+    assert [r["pickup_date"] for r in rows] == ["2019-02-03", "2019-02-04", "2019-02-05"]
+    for row in rows:
+        want, count = exact(
+            "SELECT fare_amount FROM trips WHERE tpep_pickup_datetime LIKE ? ORDER BY 1", (row["pickup_date"] + "%",)
+        )
+        assert row["trip_count"] == count
+        assert row["p50"] == pytest.approx(want[0.5], rel=0.0101)
+        assert set(row) == {"pickup_date", "trip_count", "p50", "p75"}
+
+    rows = client.get("/api/stats/quantiles?group_by=pickup_borough&pickup_zone=JFK Airport").get_json()
+    assert [r["pickup_borough"] for r in rows] == ["Queens"]
+    assert rows[0]["trip_count"] == conn.execute("SELECT COUNT(*) FROM trips WHERE PULocationID = 132").fetchone()[0]
+    conn.close()
+
+    assert client.get("/api/stats/quantiles?start_date=2030-01-01&end_date=2030-01-02").get_json() == [
+        {"trip_count": 0, "p50": None, "p90": None, "p99": None}
+    ]
+    assert client.get("/api/stats/quantiles?measure=tolls_amount").status_code == 400
+    assert client.get("/api/stats/quantiles?group_by=dropoff_borough").status_code == 400
+    assert client.get("/api/stats/quantiles?quantiles=50").status_code == 400
+
+def test_histogram_from_sketches(client, fixture_db):
+    import sqlite3
+    conn = sqlite3.connect(fixture_db)
+    tips = conn.execute("SELECT COUNT(tip_percentage) FROM trips WHERE PULocationID = 161").fetchone()[0]
+    conn.close()
+
+    bins = client.get("/api/stats/histogram?measure=tip_percentage&PULocationID=161&bins=10").get_json()
+    assert 1 <= len(bins) <= 11
+    assert sum(b["trip_count"] for b in bins) == tips
+    assert all(b["lower"] <= b["upper"] for b in bins)
+    assert [b["lower"] for b in bins] == sorted(b["lower"] for b in bins)
+    assert client.get("/api/stats/histogram?bins=0").status_code == 400
+
+def test_sketches_merge_across_saves(fixture_db, tmp_path):
+    import shutil
+    import sqlite3
+    from sketches import SKETCH_SOURCE_SQL, TripSketches, rebuild_sketches
+    path = tmp_path / "copy.db"
+    shutil.copy(fixture_db, path)
+    conn = sqlite3.connect(path)
+    stored = conn.execute("SELECT * FROM trip_sketches ORDER BY 1, 2, 3").fetchall()
+
+    # Saving the trips in two halves, in two loads, gives the same sketches
+    rows = conn.execute(SKETCH_SOURCE_SQL.format(partition="trips_2019_01")).fetchall()
+    rows += conn.execute(SKETCH_SOURCE_SQL.format(partition="trips_2019_02")).fetchall()
+    conn.execute("DELETE FROM trip_sketches")
+    for half in (rows[::2], rows[1::2]):
+        sketches = TripSketches(buffer_size=100)
+        sketches.add(half[:700])
+        sketches.add(half[700:])
+        sketches.save(conn)
+    assert conn.execute("SELECT * FROM trip_sketches ORDER BY 1, 2, 3").fetchall() == stored
+
+    rebuild_sketches(conn)
+    assert conn.execute("SELECT * FROM trip_sketches ORDER BY 1, 2, 3").fetchall() == stored
+    conn.close()
+
+def test_trip_fingerprints_match_a_set(tmp_path):
+    import random
+    import numpy as np
+    from fingerprints import TripFingerprints
+
+    rng = random.Random(5)
+    keys = [("2019-01-05 10:00:00", rng.randint(1, 400), rng.randint(1, 400), "12.5") for _ in range(3000)]
+    spill_file = str(tmp_path / "fingerprints.npy")
+
+    def check(fingerprints, batch, seen):
+        duplicates = 0
+        for key in batch:
+            assert fingerprints.check_and_add(key) == (key in seen)
+            duplicates += key in seen
+            seen.add(key)
+        return duplicates
+
+    # A small buffer forces many merges of pending into the sorted array
+    seen = set()
+    first = TripFingerprints(spill_file, buffer_size=64)
+    duplicates = check(first, keys[:2000], seen)
+    assert duplicates == 2000 - len(seen) > 0
+    assert len(first) == len(seen)
+    first.save()
+
+    # A second load reads the saved history and merges into it
+    second = TripFingerprints(spill_file, buffer_size=64)
+    assert len(second) == len(seen)
+    duplicates = check(second, keys[1000:], seen)
+    assert duplicates > 1000
+    second.save()
+
+    stored = np.load(spill_file)
+    assert len(stored) == len(seen) == len(TripFingerprints(spill_file))
+    assert (stored[1:] > stored[:-1]).all()  # sorted, and so unique
+    assert set(stored.tolist()) == {TripFingerprints.fingerprint(key) for key in seen}
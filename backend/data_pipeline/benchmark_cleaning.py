@@ -0,0 +1,85 @@
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+import clean_data
+
+
+# CLEANING BENCHMARK
+# Times the per-row validation + feature derivation on synthetic January
+# 2019 trips, comparing the original call pattern (strptime, parsed once in
+# validate_trip and again in add_derived_features) with the single-parse
+# path that clean_rows uses now.
+
+def make_rows(num_rows, seed=42):
+    rng = random.Random(seed)
+    start = datetime(2019, 1, 1)
+    rows = []
+
+    for _ in range(num_rows):
+        pickup = start + timedelta(seconds=rng.randint(0, 31 * 86400 - 7200))
+        distance = round(rng.uniform(0.2, 15), 2)
+        dropoff = pickup + timedelta(seconds=int(distance / rng.uniform(4, 25) * 3600) + 60)
+        fare = round(2.5 + distance * 2.5, 2)
+        tip = round(fare * rng.choice([0, 0.15, 0.2]), 2)
+        rows.append({
+            "tpep_pickup_datetime": pickup.strftime(clean_data.TIMESTAMP_FORMAT),
+            "tpep_dropoff_datetime": dropoff.strftime(clean_data.TIMESTAMP_FORMAT),
+            "passenger_count": str(rng.randint(1, 4)),
+            "trip_distance": str(distance),
+            "fare_amount": str(fare),
+            "tip_amount": str(tip),
+            "total_amount": str(round(fare + tip + 0.8, 2)),
+        })
+
+    return rows
+
+
+def run_original(rows):
+    # Reproduces the pre-change hot path: four strptime calls per kept row.
+    fast_parse = clean_data.parse_timestamp
+    clean_data.parse_timestamp = lambda value: datetime.strptime(value, clean_data.TIMESTAMP_FORMAT)
+    try:
+        for row in rows:
+            valid, _ = clean_data.validate_trip(row)
+            if valid:
+                clean_data.add_derived_features(row)
+    finally:
+        clean_data.parse_timestamp = fast_parse
+
+
+def run_single_parse(rows):
+    clean_data.parse_timestamp.cache_clear()
+    for row in rows:
+        trip = clean_data.parse_trip(row)
+        valid, _ = clean_data.validate_trip(row, trip)
+        if valid:
+            clean_data.add_derived_features(row, trip)
+
+
+def best_of(func, rows, repeat):
+    timings = []
+    for _ in range(repeat):
+        batch = [dict(row) for row in rows]
+        started = time.perf_counter()
+        func(batch)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark per-row trip cleaning")
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+
+    original = best_of(run_original, rows, args.repeat)
+    single = best_of(run_single_parse, rows, args.repeat)
+
+    print(f"Rows: {args.rows:,}")
+    print(f"strptime, parsed twice: {original:.3f}s ({args.rows / original:,.0f} rows/s)")
+    print(f"single parse + cache:   {single:.3f}s ({args.rows / single:,.0f} rows/s)")
+    print(f"Speedup: {original / single:.2f}x")
@@ -1,6 +1,10 @@
+import argparse
 import csv
 import os
+import shutil
 from datetime import datetime
+from functools import lru_cache
+from multiprocessing import Pool
 
 
 # PATH CONFIGURATION
@@ -9,6 +13,7 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 INPUT_FILE = os.path.join(BASE_DIR, "../../data/raw/yellow_tripdata_2019-01.csv")
 OUTPUT_FILE = os.path.join(BASE_DIR, "../../data/processed/yellow_tripdata_2019-01_cleaned.csv")
+PARQUET_OUTPUT_FILE = os.path.splitext(OUTPUT_FILE)[0] + ".parquet"
 LOG_FILE = os.path.join(BASE_DIR, "../../data/cleaning_log.txt")
 
 os.makedirs(os.path.dirname(OUTPUT_FILE), exist_ok=True)
@@ -33,32 +38,73 @@ THRESHOLDS = {
 
 # VALIDATION FUNCTIONS
 
-def has_missing_critical_fields(row):
-    required = [
-        "tpep_pickup_datetime",
-        "tpep_dropoff_datetime",
-        "trip_distance",
-        "fare_amount",
-        "PULocationID",
-        "DOLocationID",
-    ]
+CRITICAL_FIELDS = [
+    "tpep_pickup_datetime",
+    "tpep_dropoff_datetime",
+    "trip_distance",
+    "fare_amount",
+    "PULocationID",
+    "DOLocationID",
+]
 
-    for field in required:
+
+def has_missing_critical_fields(row):
+    for field in CRITICAL_FIELDS:
         if not row.get(field):
             return True
     return False
 
 
-def validate_trip(row):
+# PARSING
+# TLC timestamps are always "YYYY-MM-DD HH:MM:SS", so they are sliced by
+# position instead of going through strptime. Anything that does not fit
+# that layout still goes through strptime, so the same strings are
+# accepted and rejected either way.
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+@lru_cache(maxsize=1 << 16)
+def parse_timestamp(value):
+    digits = value[0:4] + value[5:7] + value[8:10] + value[11:13] + value[14:16] + value[17:19]
+    if (
+        len(value) == 19
+        and value[4] == "-" and value[7] == "-" and value[10] == " "
+        and value[13] == ":" and value[16] == ":"
+        and digits.isascii() and digits.isdigit()
+    ):
+        return datetime(
+            int(value[0:4]), int(value[5:7]), int(value[8:10]),
+            int(value[11:13]), int(value[14:16]), int(value[17:19]),
+        )
+    return datetime.strptime(value, TIMESTAMP_FORMAT)
+
+
+def parse_trip(row):
+    # Parses every field the rules need once, so validation and feature
+    # derivation can share the result. Returns None if any field is bad.
     try:
-        distance = float(row["trip_distance"])
-        fare = float(row["fare_amount"])
-        passengers = int(row["passenger_count"])
-        tip = float(row.get("tip_amount", 0))
-        total = float(row.get("total_amount", 0))
+        return (
+            float(row["trip_distance"]),
+            float(row["fare_amount"]),
+            int(row["passenger_count"]),
+            float(row.get("tip_amount", 0)),
+            float(row.get("total_amount", 0)),
+            parse_timestamp(row["tpep_pickup_datetime"]),
+            parse_timestamp(row["tpep_dropoff_datetime"]),
+        )
+    except Exception:
+        return None
 
-        pickup = datetime.strptime(row["tpep_pickup_datetime"], "%Y-%m-%d %H:%M:%S")
-        dropoff = datetime.strptime(row["tpep_dropoff_datetime"], "%Y-%m-%d %H:%M:%S")
+
+def validate_trip(row, trip=None):
+    try:
+        if trip is None:
+            trip = parse_trip(row)
+        if trip is None:
+            return False, "parsing"
+
+        distance, fare, passengers, tip, total, pickup, dropoff = trip
 
         duration = (dropoff - pickup).total_seconds() / 60
 
@@ -99,13 +145,11 @@ def validate_trip(row):
 
 # FEATURE ENGINEERING
 
-def add_derived_features(row):
-    pickup = datetime.strptime(row["tpep_pickup_datetime"], "%Y-%m-%d %H:%M:%S")
-    dropoff = datetime.strptime(row["tpep_dropoff_datetime"], "%Y-%m-%d %H:%M:%S")
+def add_derived_features(row, trip=None):
+    if trip is None:
+        trip = parse_trip(row)
 
-    distance = float(row["trip_distance"])
-    fare = float(row["fare_amount"])
-    tip = float(row.get("tip_amount", 0))
+    distance, fare, _, tip, _, pickup, dropoff = trip
 
     duration_minutes = (dropoff - pickup).total_seconds() / 60
 
@@ -139,9 +183,17 @@ def add_derived_features(row):
 
 # MAIN PIPELINE
 
-def clean_data():
+DERIVED_FIELDS = [
+    "trip_speed_mph",
+    "cost_per_mile",
+    "time_category",
+    "tip_percentage",
+    "efficiency_score",
+]
+
 
-    stats = {
+def new_stats():
+    return {
         "total": 0,
         "kept": 0,
         "removed": 0,
@@ -154,43 +206,171 @@ def clean_data():
         "temporal": 0,
         "parsing": 0,
         "missing": 0,
+        "unreadable": 0,
     }
 
-    with open(INPUT_FILE, "r", encoding="utf-8") as infile, \
-         open(OUTPUT_FILE, "w", newline="", encoding="utf-8") as outfile, \
-         open(LOG_FILE, "w", encoding="utf-8") as logfile:
 
+def merge_stats(total, part):
+    for key, value in part.items():
+        total[key] += value
+    return total
+
+
+# OUTPUT WRITERS
+# Both writers take one cleaned row at a time (writerow) and can append a
+# finished part file from a worker (append_part). The Parquet writer lives
+# in clean_data_arrow since it needs pyarrow.
+
+class CsvOutput:
+
+    def __init__(self, output_file, fieldnames, header=True):
+        self.file = open(output_file, "w", newline="", encoding="utf-8")
+        # A row with values past the header has them under DictReader's
+        # None key; they are dropped, as the Arrow path does.
+        self.writer = csv.DictWriter(self.file, fieldnames=fieldnames, extrasaction="ignore")
+        self.writerow = self.writer.writerow
+        if header:
+            self.writer.writeheader()
+
+    def append_part(self, part_file):
+        with open(part_file, "r", newline="", encoding="utf-8") as part:
+            shutil.copyfileobj(part, self.file)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_output(output_file, fieldnames, output_format="csv", header=True, stats=None):
+    if output_format == "parquet":
+        from clean_data_arrow import ParquetOutput
+        return ParquetOutput(output_file, fieldnames, stats)
+    return CsvOutput(output_file, fieldnames, header=header)
+
+
+def clean_rows(reader, writer, stats):
+    for row in reader:
+        stats["total"] += 1
+
+        if has_missing_critical_fields(row):
+            stats["removed"] += 1
+            stats["missing"] += 1
+            continue
+
+        trip = parse_trip(row)
+        valid, result = validate_trip(row, trip)
+
+        if valid:
+            row = add_derived_features(row, trip)
+            writer.writerow(row)
+            stats["kept"] += 1
+            stats["warnings"] += result
+        else:
+            stats["removed"] += 1
+            stats[result] += 1
+
+    return stats
+
+
+# PARALLEL CHUNKING
+# The raw file is split into byte ranges that start and end on line
+# boundaries, so every worker sees whole records. TLC exports never quote
+# embedded newlines, which is what makes line-aligned splitting safe.
+
+def read_header(input_file):
+    with open(input_file, "rb") as f:
+        header_line = f.readline()
+    fieldnames = next(csv.reader([header_line.decode("utf-8")]))
+    return fieldnames, len(header_line)
+
+
+def find_chunk_boundaries(input_file, num_chunks, data_start):
+    file_size = os.path.getsize(input_file)
+    chunk_size = max(1, (file_size - data_start) // num_chunks)
+
+    boundaries = [data_start]
+    with open(input_file, "rb") as f:
+        for i in range(1, num_chunks):
+            f.seek(data_start + i * chunk_size)
+            f.readline()
+            offset = f.tell()
+            if offset >= file_size:
+                break
+            if offset > boundaries[-1]:
+                boundaries.append(offset)
+    boundaries.append(file_size)
+
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def iter_chunk_lines(input_file, start, end):
+    with open(input_file, "rb") as f:
+        f.seek(start)
+        position = start
+        while position < end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line.decode("utf-8")
+
+
+def clean_chunk(task):
+    input_file, start, end, fieldnames, part_file, output_format = task
+    stats = new_stats()
+
+    reader = csv.DictReader(iter_chunk_lines(input_file, start, end), fieldnames=fieldnames)
+    with open_output(part_file, fieldnames + DERIVED_FIELDS, output_format, header=False, stats=stats) as writer:
+        clean_rows(reader, writer, stats)
+
+    return stats
+
+
+def clean_parallel(input_file, output_file, workers, output_format):
+    fieldnames, data_start = read_header(input_file)
+    chunks = find_chunk_boundaries(input_file, workers, data_start)
+
+    tasks = [
+        (input_file, start, end, fieldnames, f"{output_file}.part{i}", output_format)
+        for i, (start, end) in enumerate(chunks)
+    ]
+
+    stats = new_stats()
+    with open_output(output_file, fieldnames + DERIVED_FIELDS, output_format) as writer, \
+         Pool(processes=workers) as pool:
+        # imap keeps chunk order, so parts are appended as soon as the
+        # next one in sequence is finished.
+        for task, part_stats in zip(tasks, pool.imap(clean_chunk, tasks)):
+            part_file = task[4]
+            writer.append_part(part_file)
+            os.remove(part_file)
+            merge_stats(stats, part_stats)
+
+    return stats
+
+
+def clean_serial(input_file, output_file, output_format):
+    with open(input_file, "r", encoding="utf-8") as infile:
         reader = csv.DictReader(infile)
-        fieldnames = reader.fieldnames + [
-            "trip_speed_mph",
-            "cost_per_mile",
-            "time_category",
-            "tip_percentage",
-            "efficiency_score",
-        ]
-
-        writer = csv.DictWriter(outfile, fieldnames=fieldnames)
-        writer.writeheader()
-
-        for row in reader:
-            stats["total"] += 1
-
-            if has_missing_critical_fields(row):
-                stats["removed"] += 1
-                stats["missing"] += 1
-                continue
-
-            valid, result = validate_trip(row)
-
-            if valid:
-                row = add_derived_features(row)
-                writer.writerow(row)
-                stats["kept"] += 1
-                stats["warnings"] += result
-            else:
-                stats["removed"] += 1
-                stats[result] += 1
+        stats = new_stats()
+        with open_output(output_file, reader.fieldnames + DERIVED_FIELDS, output_format, stats=stats) as writer:
+            return clean_rows(reader, writer, stats)
+
+
+def clean_data(workers=1, input_file=INPUT_FILE, output_file=OUTPUT_FILE, log_file=LOG_FILE,
+               output_format="csv"):
 
+    if workers > 1:
+        stats = clean_parallel(input_file, output_file, workers, output_format)
+    else:
+        stats = clean_serial(input_file, output_file, output_format)
+
+    with open(log_file, "w", encoding="utf-8") as logfile:
         write_log(logfile, stats)
 
 
@@ -205,7 +385,8 @@ def write_log(logfile, stats):
     logfile.write(f"Total Records Processed: {stats['total']:,}\n")
     logfile.write(f"Records Kept: {stats['kept']:,}\n")
     logfile.write(f"Records Removed: {stats['removed']:,}\n")
-    logfile.write(f"Warnings Issued: {stats['warnings']:,}\n\n")
+    logfile.write(f"Warnings Issued: {stats['warnings']:,}\n")
+    logfile.write(f"Unreadable Values Stored as Null: {stats['unreadable']:,}\n\n")
 
     logfile.write("Removal Breakdown\n")
     logfile.write("-----------------\n")
@@ -223,5 +404,32 @@ def write_log(logfile, stats):
 
 
 if __name__ == "__main__":
-    clean_data()
+    parser = argparse.ArgumentParser(description="Clean raw NYC taxi trip data")
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="number of worker processes (default: 1, 0 uses every core)",
+    )
+    parser.add_argument(
+        "--engine", choices=["python", "arrow"], default="python",
+        help="row-wise python engine or columnar pyarrow engine",
+    )
+    parser.add_argument(
+        "--format", choices=["csv", "parquet"], default="csv",
+        help="cleaned output format (parquet is typed and zstd-compressed)",
+    )
+    args = parser.parse_args()
+    if args.workers < 0:
+        parser.error("--workers must be 0 or more")
+
+    output_file = PARQUET_OUTPUT_FILE if args.format == "parquet" else OUTPUT_FILE
+
+    if args.engine == "arrow":
+        from clean_data_arrow import clean_data_arrow
+        clean_data_arrow(output_file=output_file, output_format=args.format)
+    else:
+        clean_data(
+            workers=args.workers or os.cpu_count(),
+            output_file=output_file,
+            output_format=args.format,
+        )
 
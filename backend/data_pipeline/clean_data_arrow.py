@@ -0,0 +1,485 @@
+import csv
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+from clean_data import (
+    CRITICAL_FIELDS,
+    DERIVED_FIELDS,
+    INPUT_FILE,
+    LOG_FILE,
+    OUTPUT_FILE,
+    THRESHOLDS,
+    TIMESTAMP_FORMAT,
+    add_derived_features,
+    has_missing_critical_fields,
+    new_stats,
+    parse_timestamp,
+    parse_trip,
+    validate_trip,
+    write_log,
+)
+
+
+# COLUMNAR CLEANING ENGINE
+# Applies the same rules as validate_trip / add_derived_features, but on
+# whole Arrow record batches instead of one dict per row.
+#
+# Every raw column is read as a string so the output keeps the original
+# text. Rows whose fields are in the plain TLC format are validated with
+# vectorized masks; anything unusual (odd number formats, non-padded
+# timestamps, out-of-range clock values, ragged rows) is handed to the
+# row-wise functions, so rejection counts always match the serial run.
+
+BLOCK_SIZE = 1 << 24  # ~16 MB of raw CSV per record batch
+
+NUMBER_PATTERN = r"^-?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][+-]?[0-9]+)?$"
+INTEGER_PATTERN = r"^-?[0-9]+$"
+SIGNED_NUMBER_PATTERN = r"^[+-]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][+-]?[0-9]+)?$"
+TIMESTAMP_PATTERN = r"^[0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2}$"
+
+DERIVED_TYPES = {
+    "trip_speed_mph": pa.float64(),
+    "cost_per_mile": pa.float64(),
+    "time_category": pa.string(),
+    "tip_percentage": pa.float64(),
+    "efficiency_score": pa.float64(),
+}
+
+REJECTION_ORDER = ["temporal", "distance", "fare", "passengers", "duration", "speed"]
+
+# Column types used for the Parquet output. Columns not listed here (for
+# example fields added to newer TLC exports) are kept as strings.
+TRIP_TYPES = {
+    "VendorID": pa.int32(),
+    "tpep_pickup_datetime": pa.timestamp("s"),
+    "tpep_dropoff_datetime": pa.timestamp("s"),
+    "passenger_count": pa.int32(),
+    "trip_distance": pa.float64(),
+    "RatecodeID": pa.int32(),
+    "store_and_fwd_flag": pa.string(),
+    "PULocationID": pa.int32(),
+    "DOLocationID": pa.int32(),
+    "payment_type": pa.int32(),
+    "fare_amount": pa.float64(),
+    "extra": pa.float64(),
+    "mta_tax": pa.float64(),
+    "tip_amount": pa.float64(),
+    "tolls_amount": pa.float64(),
+    "improvement_surcharge": pa.float64(),
+    "total_amount": pa.float64(),
+    "congestion_surcharge": pa.float64(),
+    **DERIVED_TYPES,
+}
+
+ROW_GROUP_SIZE = 1 << 19
+PARQUET_COMPRESSION = "zstd"
+
+
+def _mask(values):
+    return pc.fill_null(values, False)
+
+
+def _count(mask):
+    return pc.sum(mask).as_py() or 0
+
+
+def _between(values, low, high, low_inclusive=True):
+    lower = pc.greater_equal(values, low) if low_inclusive else pc.greater(values, low)
+    return pc.and_(lower, pc.less_equal(values, high))
+
+
+def _round2(values):
+    # Dividing the rounded hundredths by 100 gives the nearest double to
+    # k/100, which is what Python's round(x, 2) returns. Scaling can still
+    # land on the wrong side of an .xx5 tie, so those few values are
+    # rounded in Python instead.
+    scaled = pc.multiply(values, 100.0)
+    rounded = pc.divide(pc.round(scaled, round_mode="half_to_even"), 100.0)
+    distance_to_half = pc.abs(pc.subtract(pc.subtract(scaled, pc.floor(scaled)), 0.5))
+    ambiguous = _mask(pc.less(distance_to_half, 1e-6))
+
+    if _count(ambiguous):
+        exact = [round(v, 2) for v in pc.filter(values, ambiguous).to_pylist()]
+        rounded = pc.replace_with_mask(rounded, ambiguous, pa.array(exact, pa.float64()))
+
+    return rounded
+
+
+def _time_category(pickup):
+    hour = pc.hour(pickup)
+    conditions = pc.make_struct(
+        _between(hour, 6, 9),
+        _between(hour, 10, 15),
+        _between(hour, 16, 19),
+        _between(hour, 20, 23),
+        field_names=["morning_rush", "midday", "evening_rush", "night"],
+    )
+    return pc.case_when(
+        conditions, "morning_rush", "midday", "evening_rush", "night", "late_night"
+    )
+
+
+def _column(batch, name):
+    index = batch.schema.get_field_index(name)
+    return batch.column(index) if index >= 0 else None
+
+
+def _matches(column, pattern):
+    return _mask(pc.match_substring_regex(column, pattern))
+
+
+def _only(column, mask, to_type):
+    # Null out rows outside the fast path so the cast never sees bad text.
+    return pc.cast(pc.if_else(mask, column, pa.scalar(None, pa.string())), to_type)
+
+
+# BATCH RULES
+
+def clean_batch(batch, stats):
+    num_rows = batch.num_rows
+    stats["total"] += num_rows
+
+    missing = pa.repeat(False, num_rows)
+    for field in CRITICAL_FIELDS:
+        column = _column(batch, field)
+        if column is None:
+            missing = pa.repeat(True, num_rows)
+            break
+        missing = pc.or_(missing, pc.equal(column, ""))
+
+    pickup_text = _column(batch, "tpep_pickup_datetime")
+    dropoff_text = _column(batch, "tpep_dropoff_datetime")
+    distance_text = _column(batch, "trip_distance")
+    fare_text = _column(batch, "fare_amount")
+    passengers_text = _column(batch, "passenger_count")
+    tip_text = _column(batch, "tip_amount")
+    total_text = _column(batch, "total_amount")
+
+    present = pc.invert(missing)
+    if passengers_text is None:
+        passengers_text = pa.nulls(num_rows, pa.string())
+    fast = pc.and_(present, _matches(passengers_text, INTEGER_PATTERN))
+    for column in (distance_text, fare_text, tip_text, total_text):
+        if column is not None:
+            fast = pc.and_(fast, _matches(column, NUMBER_PATTERN))
+    for column in (pickup_text, dropoff_text):
+        fast = pc.and_(fast, _matches(column, TIMESTAMP_PATTERN))
+
+    pickup = pc.strptime(
+        pc.if_else(fast, pickup_text, pa.scalar(None, pa.string())),
+        format=TIMESTAMP_FORMAT, unit="s", error_is_null=True,
+    )
+    dropoff = pc.strptime(
+        pc.if_else(fast, dropoff_text, pa.scalar(None, pa.string())),
+        format=TIMESTAMP_FORMAT, unit="s", error_is_null=True,
+    )
+    # A timestamp is only trusted if it formats back to the same text;
+    # this catches values like 24:00:00 that strptime would reject.
+    for parsed, text in ((pickup, pickup_text), (dropoff, dropoff_text)):
+        fast = pc.and_(fast, _mask(pc.equal(pc.strftime(parsed, format=TIMESTAMP_FORMAT), text)))
+
+    distance = _only(distance_text, fast, pa.float64())
+    fare = _only(fare_text, fast, pa.float64())
+    passengers = _only(passengers_text, fast, pa.int64())
+    tip = _only(tip_text, fast, pa.float64()) if tip_text is not None else pa.repeat(0.0, num_rows)
+    total = _only(total_text, fast, pa.float64()) if total_text is not None else pa.repeat(0.0, num_rows)
+    duration = pc.divide(pc.cast(pc.subtract(dropoff, pickup), pa.int64()), 60.0)
+    speed = pc.multiply(pc.divide(distance, duration), 60.0)
+
+    rules = {
+        "temporal": pc.less_equal(dropoff, pickup),
+        "distance": pc.invert(_between(distance, THRESHOLDS["distance_min"], THRESHOLDS["distance_max"], low_inclusive=False)),
+        "fare": pc.invert(_between(fare, THRESHOLDS["fare_min"], THRESHOLDS["fare_max"])),
+        "passengers": pc.invert(_between(passengers, THRESHOLDS["passengers_min"], THRESHOLDS["passengers_max"])),
+        "duration": pc.invert(_between(duration, THRESHOLDS["duration_min"], THRESHOLDS["duration_max"])),
+        "speed": pc.greater(speed, THRESHOLDS["speed_max"]),
+    }
+
+    alive = _mask(fast)
+    for reason in REJECTION_ORDER:
+        rejected = _mask(pc.and_(alive, rules[reason]))
+        count = _count(rejected)
+        stats[reason] += count
+        stats["removed"] += count
+        alive = pc.and_(alive, pc.invert(rejected))
+
+    tip_ratio = pc.divide(tip, fare)
+    tip_warning = pc.and_(
+        pc.greater(fare, 0),
+        pc.invert(_between(tip_ratio, THRESHOLDS["tip_ratio_min"], THRESHOLDS["tip_ratio_max"])),
+    )
+    total_warning = pc.greater(pc.abs(pc.subtract(pc.subtract(total, fare), tip)), 5)
+    stats["warnings"] += _count(_mask(pc.and_(alive, tip_warning)))
+    stats["warnings"] += _count(_mask(pc.and_(alive, total_warning)))
+
+    trip_speed_mph = _round2(speed)
+    cost_per_mile = _round2(pc.divide(fare, distance))
+    tip_percentage = _round2(pc.multiply(pc.divide(tip, fare), 100.0))
+    speed_score = pc.multiply(pc.min_element_wise(pc.divide(trip_speed_mph, 30.0), 1.0), 40.0)
+    cost_score = pc.multiply(pc.max_element_wise(pc.subtract(1.0, pc.divide(cost_per_mile, 10.0)), 0.0), 30.0)
+    tip_score = pc.multiply(pc.min_element_wise(pc.divide(tip_percentage, 20.0), 1.0), 30.0)
+    derived = {
+        "trip_speed_mph": trip_speed_mph,
+        "cost_per_mile": cost_per_mile,
+        "time_category": _time_category(pickup),
+        "tip_percentage": tip_percentage,
+        "efficiency_score": _round2(pc.add(pc.add(speed_score, cost_score), tip_score)),
+    }
+
+    stats["missing"] += _count(missing)
+    stats["removed"] += _count(missing)
+
+    keep = alive
+    slow = pc.and_(present, pc.invert(_mask(fast)))
+    if _count(slow):
+        keep, derived = _clean_slow_rows(batch, slow, keep, derived, stats)
+
+    stats["kept"] += _count(keep)
+
+    columns = list(batch.columns) + [derived[name] for name in DERIVED_FIELDS]
+    names = batch.schema.names + DERIVED_FIELDS
+    return pa.RecordBatch.from_arrays(columns, names=names).filter(keep)
+
+
+def _clean_slow_rows(batch, slow, keep, derived, stats):
+    rows = batch.filter(slow).to_pylist()
+    keep_values = []
+    derived_values = {name: [] for name in DERIVED_FIELDS}
+
+    for row in rows:
+        trip = parse_trip(row)
+        valid, result = validate_trip(row, trip)
+        keep_values.append(valid)
+        if valid:
+            row = add_derived_features(row, trip)
+            stats["warnings"] += result
+        else:
+            stats["removed"] += 1
+            stats[result] += 1
+        for name in DERIVED_FIELDS:
+            derived_values[name].append(row.get(name))
+
+    keep = pc.replace_with_mask(keep, slow, pa.array(keep_values))
+    derived = {
+        name: pc.replace_with_mask(
+            pc.cast(derived[name], DERIVED_TYPES[name]),
+            slow,
+            pa.array(derived_values[name], DERIVED_TYPES[name]),
+        )
+        for name in DERIVED_FIELDS
+    }
+    return keep, derived
+
+
+def clean_ragged_rows(lines, fieldnames, stats):
+    # Rows with the wrong number of columns are rejected by the Arrow
+    # reader; run them through the row-wise path with DictReader's
+    # padding so the counts stay identical.
+    kept = []
+    for values in csv.reader(lines):
+        row = dict(zip(fieldnames, values))
+        for name in fieldnames[len(values):]:
+            row[name] = None
+
+        stats["total"] += 1
+        if has_missing_critical_fields(row):
+            stats["removed"] += 1
+            stats["missing"] += 1
+            continue
+
+        trip = parse_trip(row)
+        valid, result = validate_trip(row, trip)
+        if valid:
+            kept.append(add_derived_features(row, trip))
+            stats["kept"] += 1
+            stats["warnings"] += result
+        else:
+            stats["removed"] += 1
+            stats[result] += 1
+
+    return kept
+
+
+# PARQUET OUTPUT
+
+def typed_column(column, to_type, stats=None):
+    if column.type == to_type:
+        return column
+    if not pa.types.is_string(column.type):
+        return pc.cast(column, to_type)
+
+    # Empty text becomes null. Plain values are converted in Arrow; the
+    # rest (padded or signed numbers, non-padded timestamps, ...) go
+    # through the same Python parsing the row rules use, so every value a
+    # kept row was validated with is stored. Text that is still unreadable
+    # can only be in a column the rules never check (extra, VendorID, ...);
+    # it is stored as null and counted in stats["unreadable"].
+    if pa.types.is_timestamp(to_type):
+        converted = pc.strptime(column, format=TIMESTAMP_FORMAT, unit="s", error_is_null=True)
+        return _convert_unread(column, converted, to_type, parse_timestamp, stats)
+    if pa.types.is_integer(to_type):
+        text = pc.utf8_trim_whitespace(column)
+        converted = _only(text, _matches(text, INTEGER_PATTERN), to_type)
+        return _convert_unread(text, converted, to_type, _to_int, stats)
+    if pa.types.is_floating(to_type):
+        text = pc.utf8_trim_whitespace(column)
+        converted = _only(text, _matches(text, SIGNED_NUMBER_PATTERN), to_type)
+        return _convert_unread(text, converted, to_type, float, stats)
+    return pc.if_else(pc.equal(column, ""), pa.scalar(None, to_type), column)
+
+
+def _to_int(text):
+    try:
+        return int(text)
+    except ValueError:
+        # Integer columns of some exports are written as "1.0"
+        number = float(text)
+        if not number.is_integer():
+            raise
+        return int(number)
+
+
+def _convert_unread(text, converted, to_type, convert, stats):
+    unread = _mask(pc.and_(pc.is_null(converted), pc.not_equal(text, "")))
+    if not _count(unread):
+        return converted
+    values = []
+    for value in pc.filter(text, unread).to_pylist():
+        try:
+            values.append(convert(value))
+        except ValueError:
+            values.append(None)
+            if stats is not None:
+                stats["unreadable"] += 1
+    return pc.replace_with_mask(converted, unread, pa.array(values, to_type))
+
+
+def parquet_schema(fieldnames):
+    return pa.schema([(name, TRIP_TYPES.get(name, pa.string())) for name in fieldnames])
+
+
+class ParquetOutput:
+
+    def __init__(self, output_file, fieldnames, stats=None):
+        self.fieldnames = fieldnames
+        self.stats = stats
+        self.schema = parquet_schema(fieldnames)
+        self.writer = pq.ParquetWriter(output_file, self.schema, compression=PARQUET_COMPRESSION)
+        self.rows = []
+        self.batches = []
+        self.buffered = 0
+
+    def writerow(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= ROW_GROUP_SIZE:
+            self._flush_rows()
+
+    def write_batch(self, batch):
+        columns = [
+            typed_column(batch.column(name), field.type, self.stats)
+            for name, field in zip(self.fieldnames, self.schema)
+        ]
+        self.batches.append(pa.RecordBatch.from_arrays(columns, schema=self.schema))
+        self.buffered += batch.num_rows
+        if self.buffered >= ROW_GROUP_SIZE:
+            self._flush_batches()
+
+    def append_part(self, part_file):
+        for batch in pq.ParquetFile(part_file).iter_batches():
+            self.write_batch(batch)
+
+    def _flush_rows(self):
+        if self.rows:
+            # Raw fields are still text here; derived fields are numbers.
+            columns = {
+                name: pa.array(
+                    [row.get(name) for row in self.rows],
+                    DERIVED_TYPES.get(name, pa.string()),
+                )
+                for name in self.fieldnames
+            }
+            self.rows = []
+            self.write_batch(pa.RecordBatch.from_pydict(columns))
+
+    def _flush_batches(self):
+        if self.batches:
+            table = pa.Table.from_batches(self.batches, schema=self.schema)
+            self.writer.write_table(table, row_group_size=ROW_GROUP_SIZE)
+            self.batches = []
+            self.buffered = 0
+
+    def close(self):
+        self._flush_rows()
+        self._flush_batches()
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# MAIN PIPELINE
+
+def open_reader(input_file, ragged_lines):
+    with open(input_file, "r", encoding="utf-8") as f:
+        fieldnames = next(csv.reader(f))
+
+    def on_invalid_row(row):
+        ragged_lines.append(row.text)
+        return "skip"
+
+    reader = pacsv.open_csv(
+        input_file,
+        read_options=pacsv.ReadOptions(block_size=BLOCK_SIZE),
+        parse_options=pacsv.ParseOptions(invalid_row_handler=on_invalid_row),
+        convert_options=pacsv.ConvertOptions(
+            column_types={name: pa.string() for name in fieldnames},
+            strings_can_be_null=False,
+            quoted_strings_can_be_null=False,
+        ),
+    )
+    return reader, fieldnames
+
+
+def output_schema(fieldnames):
+    return pa.schema(
+        [(name, pa.string()) for name in fieldnames]
+        + [(name, DERIVED_TYPES[name]) for name in DERIVED_FIELDS]
+    )
+
+
+def clean_data_arrow(input_file=INPUT_FILE, output_file=OUTPUT_FILE, log_file=LOG_FILE,
+                     output_format="csv"):
+    stats = new_stats()
+    ragged_lines = []
+
+    reader, fieldnames = open_reader(input_file, ragged_lines)
+    schema = output_schema(fieldnames)
+
+    if output_format == "parquet":
+        output = ParquetOutput(output_file, fieldnames + DERIVED_FIELDS, stats)
+    else:
+        output = pacsv.CSVWriter(output_file, schema)
+
+    with output as writer:
+        for batch in reader:
+            writer.write_batch(clean_batch(batch, stats))
+
+        if ragged_lines:
+            kept = clean_ragged_rows(ragged_lines, fieldnames, stats)
+            if kept:
+                writer.write_batch(pa.RecordBatch.from_pylist(kept, schema=schema))
+
+    with open(log_file, "w", encoding="utf-8") as logfile:
+        write_log(logfile, stats)
+
+    return stats
+
+
+if __name__ == "__main__":
+    clean_data_arrow()
@@ -1,4 +1,15 @@
+import argparse
 import csv
+import hashlib
+import heapq
+import json
+import math
+import os
+from collections import Counter
+from itertools import islice
+from multiprocessing import Pool
+
+from clean_data import INPUT_FILE, find_chunk_boundaries, iter_chunk_lines, read_header
 
 # CSV DATA LOADING UTILITIES
 # These functions abstract reading CSV files into a list of dictionaries.
@@ -45,51 +56,334 @@ def load_zone_lookup():
     return load_csv("data/raw/taxi_zone_lookup.csv")
 
 
-# BASIC DATA PROFILING
-# This function computes null counts and total counts per column
-# for the first N rows (default 1000). This is a lightweight
-# exploratory step to check data completeness.
+# STREAMING PROFILE
+# profile_csv reads every row of a file once, a batch at a time, and keeps
+# a fixed-size summary per column, so memory does not grow with the file:
+#   - null, value and numeric counts, min and max
+#   - mean and variance, folded in batch by batch with Chan's parallel form
+#     of Welford's update so they stay numerically stable
+#   - distinct values, estimated with a HyperLogLog sketch
+#   - frequent values, from a Misra-Gries summary
+#   - a histogram of the numeric values in logarithmic buckets
+# Each batch is first reduced to its distinct values with a Counter, so the
+# per-value work runs once per distinct value rather than once per row.
+# Summaries of the same column merge, which is how the chunks profiled by
+# parallel workers are combined.
+
+BATCH_SIZE = 10_000
+
+# 2^14 registers: about 0.8% standard error on distinct counts
+HLL_PRECISION = 14
+HLL_SHIFT = 64 - HLL_PRECISION
+HLL_MASK = (1 << HLL_SHIFT) - 1
+
+# Counters kept per column. A value's count is at most top_values_error
+# below its true count, and the summary is exact until the column has more
+# distinct values than this.
+TOP_VALUES_CAPACITY = 1000
+
+# Bucket i holds magnitudes in (gamma^(i-1), gamma^i], as in the quantile
+# sketches, with a coarser accuracy since this is for looking at shapes.
+# Values at or below HISTOGRAM_MIN_VALUE count as zero.
+HISTOGRAM_ACCURACY = 0.02
+HISTOGRAM_GAMMA = (1 + HISTOGRAM_ACCURACY) / (1 - HISTOGRAM_ACCURACY)
+HISTOGRAM_LOG_GAMMA = math.log(HISTOGRAM_GAMMA)
+HISTOGRAM_MIN_VALUE = 1e-6
+PROFILE_QUANTILES = (0.01, 0.5, 0.99)
+
+
+def histogram_bucket(value):
+    """Bucket of a value: 0 for zero, else +-(bucket index) of its magnitude"""
+    magnitude = abs(value)
+    if magnitude <= HISTOGRAM_MIN_VALUE:
+        return (0, 0)
+    return (1 if value > 0 else -1, math.ceil(math.log(magnitude) / HISTOGRAM_LOG_GAMMA))
+
+
+def bucket_bounds(bucket):
+    """(lower, upper, representative value) of a histogram bucket"""
+    sign, index = bucket
+    if not sign:
+        return 0.0, 0.0, 0.0
+    low, high = HISTOGRAM_GAMMA ** (index - 1), HISTOGRAM_GAMMA ** index
+    value = 2 * high / (HISTOGRAM_GAMMA + 1)
+    if sign < 0:
+        return -high, -low, -value
+    return low, high, value
+
+
+def hll_estimate(registers):
+    m = len(registers)
+    estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -register for register in registers)
+    zeros = registers.count(0)
+    if estimate <= 2.5 * m and zeros:
+        # Small cardinalities: linear counting of empty registers
+        estimate = m * math.log(m / zeros)
+    return round(estimate)
+
+
+class ColumnProfile:
+
+    def __init__(self):
+        self.count = 0
+        self.null_count = 0
+        self.numeric_count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.text_min = None
+        self.text_max = None
+        self.registers = bytearray(1 << HLL_PRECISION)
+        self.top = Counter()
+        self.top_error = 0
+        self.buckets = Counter()
+
+    def add_values(self, values):
+        """Add one batch of raw CSV values; empty strings are nulls"""
+        counts = Counter(values)
+        nulls = counts.pop("", 0)
+        self.null_count += nulls
+        self.count += len(values) - nulls
+        if not counts:
+            return
+
+        numbers, texts = [], []
+        for value, count in counts.items():
+            try:
+                number = float(value)
+            except ValueError:
+                texts.append(value)
+                continue
+            if math.isfinite(number):
+                numbers.append((number, count))
+            else:
+                texts.append(value)
+
+        self.add_numbers(numbers)
+        if texts:
+            self.add_text_range(min(texts), max(texts))
+        self.add_distinct(counts)
+        self.top.update(counts)
+        if len(self.top) > TOP_VALUES_CAPACITY:
+            self.prune_top()
+
+    def add_numbers(self, numbers):
+        count = sum(n for _, n in numbers)
+        if not count:
+            return
+        mean = sum(number * n for number, n in numbers) / count
+        m2 = sum(n * (number - mean) ** 2 for number, n in numbers)
+        self.add_moments(count, mean, m2)
+        self.add_range(min(number for number, _ in numbers), max(number for number, _ in numbers))
+        buckets = self.buckets
+        for number, n in numbers:
+            buckets[histogram_bucket(number)] += n
+
+    def add_moments(self, count, mean, m2):
+        """Fold in the count, mean and squared deviations of other values"""
+        if not count:
+            return
+        total = self.numeric_count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta * delta * self.numeric_count * count / total
+        self.numeric_count = total
+
+    def add_range(self, low, high):
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+
+    def add_text_range(self, low, high):
+        self.text_min = low if self.text_min is None else min(self.text_min, low)
+        self.text_max = high if self.text_max is None else max(self.text_max, high)
+
+    def add_distinct(self, values):
+        registers = self.registers
+        for value in values:
+            hashed = int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+            index = hashed >> HLL_SHIFT
+            rank = HLL_SHIFT - (hashed & HLL_MASK).bit_length() + 1
+            if rank > registers[index]:
+                registers[index] = rank
+
+    def prune_top(self):
+        # Misra-Gries: take the (capacity + 1)th largest count off every
+        # counter and drop the ones that reach zero
+        threshold = heapq.nlargest(TOP_VALUES_CAPACITY + 1, self.top.values())[-1]
+        self.top = Counter({value: n - threshold for value, n in self.top.items() if n > threshold})
+        self.top_error += threshold
 
-def generate_basic_profile(records, num_rows=1000):
+    def merge(self, other):
+        self.count += other.count
+        self.null_count += other.null_count
+        self.add_moments(other.numeric_count, other.mean, other.m2)
+        if other.min is not None:
+            self.add_range(other.min, other.max)
+        if other.text_min is not None:
+            self.add_text_range(other.text_min, other.text_max)
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        self.top.update(other.top)
+        self.top_error += other.top_error
+        if len(self.top) > TOP_VALUES_CAPACITY:
+            self.prune_top()
+        self.buckets.update(other.buckets)
+        return self
+
+    def quantiles(self, qs):
+        """Approximate quantiles of the numeric values, from the histogram"""
+        buckets = sorted(self.buckets.items(), key=lambda item: bucket_bounds(item[0])[2])
+        results = {}
+        for q in qs:
+            rank = q * (self.numeric_count - 1)
+            seen = 0
+            for bucket, n in buckets:
+                seen += n
+                if seen > rank:
+                    value = min(max(bucket_bounds(bucket)[2], self.min), self.max)
+                    results[f"p{q * 100:g}"] = round(value, 4)
+                    break
+        return results
+
+    def histogram(self):
+        bins = []
+        for bucket, n in sorted(self.buckets.items(), key=lambda item: bucket_bounds(item[0])[2]):
+            lower, upper, _ = bucket_bounds(bucket)
+            bins.append({"lower": round(lower, 6), "upper": round(upper, 6), "count": n})
+        return bins
+
+    def summary(self, top_k=10):
+        exact = not self.top_error
+        summary = {
+            "count": self.count,
+            "null_count": self.null_count,
+            "distinct": len(self.top) if exact else hll_estimate(self.registers),
+            "distinct_exact": exact,
+            "top_values": [{"value": value, "count": n} for value, n in self.top.most_common(top_k)],
+            "top_values_error": self.top_error,
+            "numeric_count": self.numeric_count,
+        }
+        if self.numeric_count:
+            summary.update({
+                "min": self.min,
+                "max": self.max,
+                "mean": self.mean,
+                "variance": self.m2 / (self.numeric_count - 1) if self.numeric_count > 1 else 0.0,
+                "quantiles": self.quantiles(PROFILE_QUANTILES),
+                "histogram": self.histogram(),
+            })
+        else:
+            summary.update({"min": self.text_min, "max": self.text_max})
+        return summary
+
+
+def new_profile(fieldnames):
+    return {
+        "rows": 0,
+        "malformed_rows": 0,
+        "columns": {name: ColumnProfile() for name in fieldnames},
+    }
+
+
+def merge_profiles(total, part):
+    total["rows"] += part["rows"]
+    total["malformed_rows"] += part["malformed_rows"]
+    for name, column in part["columns"].items():
+        total["columns"][name].merge(column)
+    return total
+
+
+def profile_rows(rows, profile, batch_size=BATCH_SIZE):
+    """Profile parsed CSV rows; rows whose width does not match the header are only counted"""
+    columns = list(profile["columns"].values())
+    width = len(columns)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return profile
+        complete = [row for row in batch if len(row) == width]
+        # csv yields [] for blank lines, which are not records at all
+        profile["malformed_rows"] += sum(1 for row in batch if row and len(row) != width)
+        profile["rows"] += len(complete)
+        if complete:
+            for column, values in zip(columns, zip(*complete)):
+                column.add_values(values)
+
+
+def profile_chunk(task):
+    input_file, start, end, fieldnames = task
+    rows = csv.reader(iter_chunk_lines(input_file, start, end))
+    return profile_rows(rows, new_profile(fieldnames))
+
+
+def profile_csv(file_path=INPUT_FILE, workers=1):
     """
-    Generate a basic null count profile for each column.
+    Profile every row of a CSV file in one pass with bounded memory.
+
+    With workers > 1 the file is split into line-aligned byte ranges that
+    are profiled in parallel and merged.
 
     Args:
-        records (list[dict]): List of records to profile.
-        num_rows (int): Number of rows to sample for the profile.
+        file_path (str): Path to the CSV file.
+        workers (int): Number of worker processes.
 
     Returns:
-        dict: Column-wise profile with 'null_count' and 'total_count'.
+        dict: 'rows', 'malformed_rows' and a ColumnProfile per column.
     """
-    profile = {}
-    sample = records[:num_rows]  # Limit profiling to first N rows for speed
-
-    for row in sample:
-        for key, value in row.items():
-            if key not in profile:
-                profile[key] = {"null_count": 0, "total_count": 0}
-            profile[key]["total_count"] += 1
-            if value == "" or value is None:
-                profile[key]["null_count"] += 1
+    fieldnames, data_start = read_header(file_path)
+    if workers <= 1:
+        return profile_chunk((file_path, data_start, os.path.getsize(file_path), fieldnames))
 
+    tasks = [
+        (file_path, start, end, fieldnames)
+        for start, end in find_chunk_boundaries(file_path, workers, data_start)
+    ]
+    profile = new_profile(fieldnames)
+    with Pool(processes=workers) as pool:
+        for part in pool.imap_unordered(profile_chunk, tasks):
+            merge_profiles(profile, part)
     return profile
 
-# SCRIPT EXECUTION
-# Demonstrates how to load and inspect the datasets.
-# Prints counts and a basic null profile for the trips dataset.
 
-if __name__ == "__main__":
-    # Load raw datasets
-    trips = load_trip_data()
-    zones = load_zone_lookup()
+def summarize_profile(profile, top_k=10):
+    """JSON-ready form of a profile"""
+    return {
+        "rows": profile["rows"],
+        "malformed_rows": profile["malformed_rows"],
+        "columns": {name: column.summary(top_k) for name, column in profile["columns"].items()},
+    }
 
-    # Output basic information
-    print("Trips loaded:", len(trips))
-    print("Zones loaded:", len(zones))
 
-    # Generate null profile for first 1000 trip records
-    print("\nSample trip profile (first 1000 rows):")
-    profile = generate_basic_profile(trips)
-    for col, stats in profile.items():
-        print(f"{col}: nulls={stats['null_count']}, total={stats['total_count']}")
+def print_profile(summary):
+    print(f"Rows: {summary['rows']:,} ({summary['malformed_rows']:,} malformed)")
+    for name, column in summary["columns"].items():
+        distinct = f"{'' if column['distinct_exact'] else '~'}{column['distinct']:,}"
+        print(f"\n{name}: nulls={column['null_count']:,}, distinct={distinct}, "
+              f"min={column['min']}, max={column['max']}")
+        if column["numeric_count"]:
+            quantiles = ", ".join(f"{q}={value:g}" for q, value in column["quantiles"].items())
+            print(f"  mean={column['mean']:.4g}, std={math.sqrt(column['variance']):.4g}, {quantiles}")
+        top = ", ".join(f"{value['value']} ({value['count']:,})" for value in column["top_values"])
+        print(f"  top: {top}")
+
+
+# SCRIPT EXECUTION
+# Profiles the raw trips file in a single streaming pass and prints a
+# summary per column; --json also writes the full profile with histograms.
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Profile a raw NYC taxi trip CSV in one pass")
+    parser.add_argument("--input", default=INPUT_FILE)
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="number of worker processes (default: 1, 0 uses every core)",
+    )
+    parser.add_argument("--top", type=int, default=5, help="frequent values shown per column")
+    parser.add_argument("--json", help="also write the full profile to this file")
+    args = parser.parse_args()
 
+    summary = summarize_profile(profile_csv(args.input, args.workers or os.cpu_count()), args.top)
+    print_profile(summary)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
@@ -0,0 +1,274 @@
+import csv
+import os
+
+import pytest
+
+RAW_FIELDS = [
+    "VendorID", "tpep_pickup_datetime", "tpep_dropoff_datetime", "passenger_count",
+    "trip_distance", "RatecodeID", "store_and_fwd_flag", "PULocationID", "DOLocationID",
+    "payment_type", "fare_amount", "extra", "mta_tax", "tip_amount", "tolls_amount",
+    "improvement_surcharge", "total_amount", "congestion_surcharge",
+]
+
+
+def raw_trip(pickup="2019-01-05 10:00:00", dropoff="2019-01-05 10:20:00", passengers="1",
+             distance="3.2", fare="12.5", tip="2", total="15.3", ratecode="1"):
+    return [
+        "2", pickup, dropoff, passengers, distance, ratecode, "N", "161", "236",
+        "1", fare, "0.5", "0.5", tip, "0", "0.3", total, "",
+    ]
+
+
+def write_raw(path, rows):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(RAW_FIELDS)
+        writer.writerows(rows)
+
+
+def test_parquet_output_keeps_every_value_the_rules_accept(tmp_path):
+    pa = pytest.importorskip("pyarrow")
+    pq = pytest.importorskip("pyarrow.parquet")
+    from clean_data import parse_timestamp
+    from clean_data_arrow import TRIP_TYPES, clean_data_arrow
+
+    raw = tmp_path / "raw.csv"
+    write_raw(raw, [
+        raw_trip(),
+        # Text float() and int() accept but the vectorized patterns do not
+        raw_trip(fare=" 12.5", tip="+3", total="15.8 ", passengers=" 2"),
+        raw_trip(distance="+3.2", fare="12.50 ", ratecode="1.0"),
+        raw_trip(pickup="2019-1-5 9:00:00", dropoff="2019-01-05 09:30:00"),
+        raw_trip(fare="abc"),
+    ])
+    clean_data_arrow(str(raw), str(tmp_path / "out.csv"), str(tmp_path / "log.txt"))
+    clean_data_arrow(str(raw), str(tmp_path / "out.parquet"), str(tmp_path / "log.txt"),
+                     output_format="parquet")
+
+    with open(tmp_path / "out.csv", newline="", encoding="utf-8") as f:
+        csv_rows = list(csv.DictReader(f))
+    parquet_rows = pq.read_table(tmp_path / "out.parquet").to_pylist()
+
+    assert len(csv_rows) == len(parquet_rows) == 4
+    for csv_row, parquet_row in zip(csv_rows, parquet_rows):
+        for name, value in csv_row.items():
+            stored = parquet_row[name]
+            if value == "":
+                assert stored is None
+            elif pa.types.is_string(TRIP_TYPES.get(name, pa.string())):
+                assert stored == value
+            elif name.endswith("datetime"):
+                assert stored == parse_timestamp(value)
+            else:
+                assert stored == pytest.approx(float(value)), name
+
+
+def test_parquet_output_stores_unreadable_unchecked_values_as_null(tmp_path):
+    pytest.importorskip("pyarrow")
+    pq = pytest.importorskip("pyarrow.parquet")
+    from clean_data import clean_data
+    from clean_data_arrow import clean_data_arrow
+
+    # The rules never look at extra or VendorID, so these rows are kept
+    rows = [raw_trip(), raw_trip(), raw_trip()]
+    rows[1][11] = "N/A"
+    rows[2][0] = "two"
+    raw = tmp_path / "raw.csv"
+    write_raw(raw, rows)
+
+    stats = clean_data_arrow(str(raw), str(tmp_path / "arrow.parquet"), str(tmp_path / "arrow_log.txt"),
+                             output_format="parquet")
+    assert stats["kept"] == 3 and stats["unreadable"] == 2
+    clean_data(input_file=str(raw), output_file=str(tmp_path / "rows.parquet"),
+               log_file=str(tmp_path / "rows_log.txt"), output_format="parquet")
+    assert "Unreadable Values Stored as Null: 2" in (tmp_path / "rows_log.txt").read_text()
+
+    for name in ("arrow.parquet", "rows.parquet"):
+        stored = pq.read_table(tmp_path / name).to_pylist()
+        assert [row["extra"] for row in stored] == [0.5, None, 0.5]
+        assert [row["VendorID"] for row in stored] == [2, 2, None]
+        assert [row["fare_amount"] for row in stored] == [12.5] * 3
+
+
+def write_profile_input(path, num_rows=3000, seed=7):
+    import random
+    rng = random.Random(seed)
+    rows = []
+    for i in range(num_rows):
+        fare = f"{rng.uniform(2.5, 80):.2f}" if i % 17 else ""
+        rows.append(raw_trip(
+            pickup=f"2019-01-{1 + i % 28:02d} {i % 24:02d}:{i % 60:02d}:00",
+            passengers=str(rng.randint(1, 6)),
+            distance=f"{rng.expovariate(0.3):.2f}",
+            fare=fare,
+            tip="abc" if i == 5 else f"{rng.uniform(0, 10):.2f}",
+        ))
+    write_raw(path, rows)
+
+
+def test_profile_parallel_matches_serial(tmp_path):
+    from load_data import profile_csv, summarize_profile
+
+    raw = tmp_path / "raw.csv"
+    write_profile_input(raw)
+    serial = summarize_profile(profile_csv(str(raw), workers=1))
+    parallel = summarize_profile(profile_csv(str(raw), workers=3))
+
+    assert serial["rows"] == parallel["rows"] == 3000
+    for name, column in serial["columns"].items():
+        other = parallel["columns"][name]
+        for key in ("count", "null_count", "numeric_count", "min", "max", "distinct"):
+            assert column[key] == other[key], (name, key)
+        if column["numeric_count"]:
+            assert column["mean"] == pytest.approx(other["mean"], rel=1e-9)
+            assert column["variance"] == pytest.approx(other["variance"], rel=1e-9)
+
+
+def test_profile_counts_match_exact_values(tmp_path):
+    import statistics
+    from load_data import TOP_VALUES_CAPACITY, profile_csv, summarize_profile
+
+    raw = tmp_path / "raw.csv"
+    write_profile_input(raw)
+    summary = summarize_profile(profile_csv(str(raw)), top_k=3)
+    with open(raw, newline="", encoding="utf-8") as f:
+        rows = list(csv.DictReader(f))
+
+    fares = [float(row["fare_amount"]) for row in rows if row["fare_amount"]]
+    fare = summary["columns"]["fare_amount"]
+    assert fare["null_count"] == len(rows) - len(fares)
+    assert (fare["min"], fare["max"]) == (min(fares), max(fares))
+    assert fare["mean"] == pytest.approx(statistics.mean(fares))
+    assert fare["variance"] == pytest.approx(statistics.variance(fares))
+    assert summary["columns"]["tip_amount"]["numeric_count"] == len(rows) - 1
+
+    # Below TOP_VALUES_CAPACITY distinct values, counts are exact
+    pickups = [row["tpep_pickup_datetime"] for row in rows]
+    assert len(set(pickups)) < TOP_VALUES_CAPACITY
+    pickup = summary["columns"]["tpep_pickup_datetime"]
+    assert pickup["distinct_exact"] and pickup["distinct"] == len(set(pickups))
+    assert (pickup["min"], pickup["max"]) == (min(pickups), max(pickups))
+    passengers = summary["columns"]["passenger_count"]
+    assert passengers["distinct"] == 6 and passengers["top_values_error"] == 0
+    counts = {value: pickups.count(value) for value in set(pickups)}
+    assert [value["count"] for value in pickup["top_values"]] == sorted(counts.values(), reverse=True)[:3]
+
+
+def test_hll_estimate_of_known_cardinality():
+    from load_data import ColumnProfile, hll_estimate
+
+    for cardinality in (1_000, 50_000, 200_000):
+        column = ColumnProfile()
+        column.add_distinct(f"value {i}" for i in range(cardinality))
+        assert hll_estimate(column.registers) == pytest.approx(cardinality, rel=0.03)
+
+    # Past capacity the profile falls back to the sketch
+    column = ColumnProfile()
+    for start in range(0, 20_000, 5_000):
+        column.add_values([str(i) for i in range(start, start + 5_000)])
+    summary = column.summary()
+    assert not summary["distinct_exact"]
+    assert summary["distinct"] == pytest.approx(20_000, rel=0.03)
+
+
+def read_log_counts(path):
+    # Every line of the report but the timestamp
+    return [line for line in path.read_text().splitlines() if not line.startswith("Generated:")]
+
+
+def test_arrow_cleaning_matches_row_wise(tmp_path):
+    pytest.importorskip("pyarrow")
+    from clean_data import clean_data
+    from clean_data_arrow import clean_data_arrow
+
+    rows = [
+        raw_trip(),
+        raw_trip(),  # duplicate rows are both kept by either path
+        raw_trip(fare=" 12.5", tip="+3", total="15.8 ", passengers=" 2"),
+        raw_trip(distance="+3.2", fare="12.50 ", ratecode="1.0"),
+        raw_trip(distance="3.2e0", fare="1_2.5"),
+        raw_trip(pickup="2019-1-5 9:00:00", dropoff="2019-01-05 09:30:00"),
+        raw_trip(pickup="2019-02-30 10:00:00"),
+        raw_trip(pickup="05/01/2019 10:00"),
+        raw_trip(dropoff="2019-01-05 09:00:00"),
+        raw_trip(fare="abc"),
+        raw_trip(fare=""),
+        raw_trip(passengers="0"),
+        raw_trip(passengers="1.5"),
+        raw_trip(distance="-1"),
+        raw_trip(dropoff="2019-01-05 10:00:30"),
+        raw_trip(distance="90", dropoff="2019-01-05 10:30:00"),
+        raw_trip(tip="40", total="52.5"),
+        raw_trip(fare="nan", total="nan"),
+        raw_trip(fare="inf"),
+    ]
+    # Ragged lines: short rows cut after total_amount, fare_amount and
+    # trip_distance, and a row with a trailing extra value
+    rows.append(raw_trip()[:17])
+    rows.append(raw_trip()[:11])
+    rows.append(raw_trip()[:5])
+    rows.append(raw_trip() + ["extra"])
+    raw = tmp_path / "raw.csv"
+    write_raw(raw, rows)
+
+    clean_data(input_file=str(raw), output_file=str(tmp_path / "rows.csv"), log_file=str(tmp_path / "rows_log.txt"))
+    stats = clean_data_arrow(str(raw), str(tmp_path / "arrow.csv"), str(tmp_path / "arrow_log.txt"))
+
+    assert stats["total"] == len(rows)
+    assert read_log_counts(tmp_path / "arrow_log.txt") == read_log_counts(tmp_path / "rows_log.txt")
+
+    # Ragged rows are written after the batches, so compare as multisets
+    def kept(name):
+        with open(tmp_path / name, newline="", encoding="utf-8") as f:
+            reader = csv.DictReader(f)
+            return sorted(
+                tuple((key, normalize(value)) for key, value in row.items())
+                for row in reader
+            )
+
+    def normalize(value):
+        try:
+            return round(float(value), 6)
+        except (TypeError, ValueError):
+            return value
+
+    assert kept("arrow.csv") == kept("rows.csv")
+    assert len(kept("rows.csv")) == stats["kept"]
+
+
+def test_parallel_cleaning_matches_serial(tmp_path):
+    from clean_data import clean_data, find_chunk_boundaries, read_header
+
+    raw = tmp_path / "raw.csv"
+    write_profile_input(raw, num_rows=2000)
+    data = raw.read_bytes()
+    line_starts = {i + 1 for i, byte in enumerate(data) if byte == ord("\n")}
+
+    clean_data(input_file=str(raw), output_file=str(tmp_path / "serial.csv"),
+               log_file=str(tmp_path / "serial_log.txt"))
+    serial = (tmp_path / "serial.csv").read_bytes()
+
+    _, data_start = read_header(str(raw))
+    for workers in (2, 3, 7):
+        # The even split points fall inside rows, so the chunks are moved
+        # to the next line start and the straddling row is read once
+        chunk_size = (len(data) - data_start) // workers
+        assert any(data_start + i * chunk_size not in line_starts for i in range(1, workers))
+        chunks = find_chunk_boundaries(str(raw), workers, data_start)
+        assert all(start in line_starts for start, _ in chunks)
+
+        output = tmp_path / f"parallel{workers}.csv"
+        log = tmp_path / f"parallel{workers}_log.txt"
+        clean_data(workers=workers, input_file=str(raw), output_file=str(output), log_file=str(log))
+        assert output.read_bytes() == serial
+        assert read_log_counts(log) == read_log_counts(tmp_path / "serial_log.txt")
+
+
+def test_cli_rejects_negative_workers():
+    import subprocess
+    import sys
+
+    script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "clean_data.py")
+    result = subprocess.run([sys.executable, script, "--workers", "-1"], capture_output=True, text=True)
+    assert result.returncode == 2
+    assert "--workers must be 0 or more" in result.stderr
@@ -0,0 +1,131 @@
+# MATERIALIZED AGGREGATES
+# Each agg_* table holds additive totals per group: a trip count, plus a
+# sum and a non-null count for every column that the views average. New
+# trips can therefore be folded in with an UPSERT, and the v_* views in
+# schema.sql compute averages as SUM(x_sum) / SUM(x_count), which matches
+# AVG(x) over the raw trips.
+#
+ZONE_JOINS = """
+    JOIN zones pu ON t.PULocationID = pu.LocationID
+    JOIN zones do ON t.DOLocationID = do.LocationID
+"""
+DROPOFF_ZONE_JOIN = """
+    JOIN zones do ON t.DOLocationID = do.LocationID
+"""
+
+# table: (group-by columns as (name, expression), measured columns, joins)
+AGGREGATES = {
+    "agg_daily": (
+        [("pickup_date", "DATE(tpep_pickup_datetime)")],
+        ["total_amount", "fare_amount", "trip_distance", "trip_speed_mph", "tip_percentage"],
+        "",
+    ),
+    "agg_hourly": (
+        [("pickup_hour", "CAST(STRFTIME('%H', tpep_pickup_datetime) AS INTEGER)")],
+        ["fare_amount", "trip_speed_mph", "tip_percentage"],
+        "",
+    ),
+    "agg_time_category": (
+        # NULL never matches ON CONFLICT, so a missing category is stored
+        # as '' and mapped back by v_time_category_stats.
+        [("time_category", "COALESCE(time_category, '')")],
+        ["fare_amount", "trip_speed_mph", "tip_percentage", "efficiency_score"],
+        "",
+    ),
+    "agg_pickup_zones": (
+        [("PULocationID", "PULocationID")],
+        ["total_amount", "trip_distance"],
+        "",
+    ),
+    # Keyed by names, not LocationIDs, because v_top_routes groups by zone
+    # name and some names (e.g. Corona) belong to more than one LocationID.
+    "agg_routes": (
+        [
+            ("pickup_borough", "pu.Borough"),
+            ("pickup_zone", "pu.Zone"),
+            ("dropoff_borough", "do.Borough"),
+            ("dropoff_zone", "do.Zone"),
+        ],
+        ["total_amount", "fare_amount", "trip_distance", "trip_speed_mph"],
+        ZONE_JOINS,
+    ),
+    # The finest grain /api/stats/cube can slice by. Any filter and
+    # group-by over these keys is a GROUP BY over this table instead of
+    # the trips. Pickup boroughs and zone names come from joining zones
+    # on PULocationID.
+    "agg_cube": (
+        [
+            ("pickup_date", "DATE(tpep_pickup_datetime)"),
+            ("pickup_hour", "CAST(STRFTIME('%H', tpep_pickup_datetime) AS INTEGER)"),
+            ("PULocationID", "PULocationID"),
+            ("dropoff_borough", "do.Borough"),
+            ("time_category", "COALESCE(time_category, '')"),
+        ],
+        ["total_amount", "fare_amount", "trip_distance", "trip_speed_mph", "tip_percentage", "efficiency_score"],
+        DROPOFF_ZONE_JOIN,
+    ),
+}
+
+
+def refresh_sql(table, partition, trip_range=False):
+    keys, measures, joins = AGGREGATES[table]
+    key_names = [name for name, _ in keys]
+    columns = key_names + ["trip_count"]
+    selects = [expression for _, expression in keys] + ["COUNT(*)"]
+    updates = ["trip_count = trip_count + excluded.trip_count"]
+
+    for measure in measures:
+        columns += [f"{measure}_sum", f"{measure}_count"]
+        selects += [f"TOTAL({measure})", f"COUNT({measure})"]
+        updates += [
+            f"{measure}_sum = {measure}_sum + excluded.{measure}_sum",
+            f"{measure}_count = {measure}_count + excluded.{measure}_count",
+        ]
+
+    # The WHERE clause is required: without it SQLite cannot tell the
+    # UPSERT's ON CONFLICT apart from a join constraint.
+    where = "trip_id BETWEEN ? AND ?" if trip_range else "1=1"
+    return f"""
+        INSERT INTO {table} ({", ".join(columns)})
+        SELECT {", ".join(selects)}
+        FROM {partition} t
+        {joins}
+        WHERE {where}
+        GROUP BY {", ".join(str(i + 1) for i in range(len(keys)))}
+        ON CONFLICT ({", ".join(key_names)}) DO UPDATE SET
+            {", ".join(updates)};
+    """
+
+
+def refresh_aggregates(conn, partition, first_trip_id=None, last_trip_id=None):
+    """Fold the trips of one partition into every aggregate table.
+
+    With a trip_id range only those trips are added, which is how an
+    append refreshes the aggregates without rescanning older data.
+    """
+    trip_range = first_trip_id is not None
+    params = (first_trip_id, last_trip_id) if trip_range else ()
+    for table in AGGREGATES:
+        conn.execute(refresh_sql(table, partition, trip_range), params)
+
+
+def backfill_aggregates(conn):
+    """Fill aggregate tables added since the database was built from the trips already loaded.
+
+    Run before an append folds its own trips in, so a new table does not
+    start out holding only the latest file.
+    """
+    partitions = [row[0] for row in conn.execute("SELECT table_name FROM trip_partitions")]
+    for table in AGGREGATES:
+        if conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone() is None:
+            for partition in partitions:
+                conn.execute(refresh_sql(table, partition))
+
+
+def rebuild_aggregates(conn):
+    """Recompute every aggregate table from all trip partitions"""
+    for table in AGGREGATES:
+        conn.execute(f"DELETE FROM {table};")
+    partitions = [row[0] for row in conn.execute("SELECT table_name FROM trip_partitions")]
+    for partition in partitions:
+        refresh_aggregates(conn, partition)
@@ -0,0 +1,25 @@
+import sqlite3
+
+
+BUMP_DATA_VERSION_SQL = """
+    INSERT INTO data_version (id, version, updated_at)
+    VALUES (1, 1, DATETIME('now'))
+    ON CONFLICT (id) DO UPDATE SET
+        version = version + 1,
+        updated_at = excluded.updated_at;
+"""
+
+
+def bump_data_version(conn):
+    """Mark the trip data as changed; commit it with the change itself"""
+    conn.execute(BUMP_DATA_VERSION_SQL)
+
+
+def read_data_version(conn):
+    """Version of the trip data as conn sees it; 0 before the first load"""
+    try:
+        row = conn.execute("SELECT version FROM data_version").fetchone()
+    except sqlite3.OperationalError:
+        # Built before data_version existed
+        return 0
+    return row[0] if row else 0
@@ -0,0 +1,91 @@
+import hashlib
+import os
+
+import numpy as np
+
+
+class TripFingerprints:
+    """Compact set of 64-bit trip fingerprints for duplicate detection.
+
+    Each trip key is hashed to 8 bytes with BLAKE2b. New fingerprints go
+    into a small set, which is merged into a sorted uint64 array whenever
+    it reaches buffer_size, so memory grows by 8 bytes per trip instead of
+    a tuple of strings. At 7M trips a month, the chance of any two distinct
+    trips sharing a fingerprint is about 1 in 750,000.
+
+    With spill_file, fingerprints from earlier loads are memory-mapped from
+    disk rather than read into RAM, and save() merges the new ones into
+    that file for the next load.
+    """
+
+    def __init__(self, spill_file=None, buffer_size=1 << 18):
+        self.spill_file = spill_file
+        self.buffer_size = buffer_size
+        self.pending = set()
+        self.current = np.empty(0, dtype=np.uint64)
+
+        if spill_file and os.path.exists(spill_file):
+            self.stored = np.load(spill_file, mmap_mode="r")
+        else:
+            self.stored = np.empty(0, dtype=np.uint64)
+
+    def __len__(self):
+        return len(self.pending) + len(self.current) + len(self.stored)
+
+    @staticmethod
+    def fingerprint(key):
+        data = "\x1f".join(map(str, key)).encode("utf-8")
+        return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+    def check_and_add(self, key):
+        """Return True if key was seen before, otherwise remember it"""
+        value = self.fingerprint(key)
+
+        if value in self.pending:
+            return True
+        if _contains(self.current, value) or _contains(self.stored, value):
+            return True
+
+        self.pending.add(value)
+        if len(self.pending) >= self.buffer_size:
+            self._merge_pending()
+        return False
+
+    def _merge_pending(self):
+        new = np.fromiter(self.pending, dtype=np.uint64, count=len(self.pending))
+        new.sort()
+        self.current = np.insert(self.current, self.current.searchsorted(new), new)
+        self.pending = set()
+
+    def save(self):
+        """Merge this load's fingerprints into spill_file"""
+        if not self.spill_file:
+            return
+
+        self._merge_pending()
+        total = len(self.stored) + len(self.current)
+        tmp_file = self.spill_file + ".tmp.npy"
+
+        # Merge through a memory-mapped output so a multi-month history
+        # never has to sit in RAM.
+        merged = np.lib.format.open_memmap(tmp_file, mode="w+", dtype=np.uint64, shape=(total,))
+        positions = self.stored.searchsorted(self.current) + np.arange(len(self.current))
+        is_new = np.zeros(total, dtype=bool)
+        is_new[positions] = True
+        merged[positions] = self.current
+        merged[~is_new] = self.stored
+        merged.flush()
+        del merged
+
+        self.stored = None
+        os.replace(tmp_file, self.spill_file)
+        self.stored = np.load(self.spill_file, mmap_mode="r")
+        self.current = np.empty(0, dtype=np.uint64)
+
+
+def _contains(sorted_values, value):
+    if not len(sorted_values):
+        return False
+    value = np.uint64(value)
+    index = sorted_values.searchsorted(value)
+    return index < len(sorted_values) and sorted_values[index] == value
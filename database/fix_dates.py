@@ -1,31 +1,59 @@
 import sqlite3
 
+from aggregates import rebuild_aggregates
+from data_version import bump_data_version
+from od_matrix import install_od_matrix, stage_od_matrix
+from sketches import rebuild_sketches
+
 DB_FILE = "database/nyc_taxi.db"
 
 conn = sqlite3.connect(DB_FILE)
 cursor = conn.cursor()
 
+# Each monthly partition should only hold trips picked up in its month.
+# Databases built before partitioning keep January 2019 in one trips table.
+try:
+    partitions = cursor.execute(
+        "SELECT table_name, start_datetime, end_datetime FROM trip_partitions ORDER BY start_datetime"
+    ).fetchall()
+    partitioned = True
+except sqlite3.OperationalError:
+    partitions = [("trips", "2019-01-01 00:00:00", "2019-02-01 00:00:00")]
+    partitioned = False
+
 print("Checking invalid dates...")
 
-cursor.execute("""
-    SELECT COUNT(*)
-    FROM trips
-    WHERE tpep_pickup_datetime < '2019-01-01'
-       OR tpep_pickup_datetime >= '2019-02-01';
-""")
+total_deleted = 0
+for table, start, end in partitions:
+    cursor.execute(f"""
+        SELECT COUNT(*)
+        FROM {table}
+        WHERE tpep_pickup_datetime < ?
+           OR tpep_pickup_datetime >= ?;
+    """, (start, end))
+
+    invalid_count = cursor.fetchone()[0]
+    print(f"Invalid date rows in {table}: {invalid_count:,}")
 
-invalid_count = cursor.fetchone()[0]
-print(f"Invalid date rows: {invalid_count:,}")
+    if invalid_count > 0:
+        print("Deleting invalid rows...")
+        cursor.execute(f"""
+            DELETE FROM {table}
+            WHERE tpep_pickup_datetime < ?
+               OR tpep_pickup_datetime >= ?;
+        """, (start, end))
+        conn.commit()
+        total_deleted += invalid_count
+        print("Deletion complete.")
 
-if invalid_count > 0:
-    print("Deleting invalid rows...")
-    cursor.execute("""
-        DELETE FROM trips
-        WHERE tpep_pickup_datetime < '2019-01-01'
-           OR tpep_pickup_datetime >= '2019-02-01';
-    """)
+if total_deleted and partitioned:
+    print("Rebuilding aggregate tables...")
+    rebuild_aggregates(conn)
+    staged_matrix = stage_od_matrix(conn)
+    rebuild_sketches(conn)
+    bump_data_version(conn)
     conn.commit()
-    print("Deletion complete.")
+    install_od_matrix(conn, staged_matrix)
 
 print("Checking new date range...")
 cursor.execute("""
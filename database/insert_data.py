@@ -1,7 +1,21 @@
+import argparse
+import hashlib
+import re
 import sqlite3
 import csv
 import os
 from collections import defaultdict
+from operator import itemgetter
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from aggregates import backfill_aggregates, refresh_aggregates
+from data_version import bump_data_version
+from fingerprints import TripFingerprints
+from od_matrix import discard_od_matrix, install_od_matrix, stage_od_matrix, version_path
+from sketches import SKETCH_COLUMNS, TripSketches, backfill_sketches, sketch_gamma
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -9,28 +23,100 @@ DB_FILE = os.path.join(BASE_DIR, "nyc_taxi.db")
 SCHEMA_FILE = os.path.join(BASE_DIR, "schema.sql")
 ZONES_FILE = os.path.join(BASE_DIR, "..", "data", "raw", "taxi_zone_lookup.csv")
 TRIPS_FILE = os.path.join(BASE_DIR, "..", "data", "processed", "yellow_tripdata_2019-01_cleaned.csv")
+TRIPS_PARQUET_FILE = os.path.splitext(TRIPS_FILE)[0] + ".parquet"
 DUPLICATES_LOG = os.path.join(BASE_DIR, "..", "data", "cleaning_log_duplicates.csv")
+FINGERPRINTS_FILE = os.path.join(BASE_DIR, "trip_fingerprints.npy")
+OD_MATRIX_FILE = os.path.join(BASE_DIR, "od_matrix.npy")
 
 BATCH_SIZE = 10000
+BULK_COMMIT_ROWS = 1_000_000
+
+# Build-time settings for --bulk. The database is thrown away if a bulk
+# build fails, so durability is traded for speed until finish_bulk_load.
+BULK_PRAGMAS = [
+    "PRAGMA journal_mode = OFF;",
+    "PRAGMA synchronous = OFF;",
+    "PRAGMA locking_mode = EXCLUSIVE;",
+    "PRAGMA temp_store = MEMORY;",
+    "PRAGMA cache_size = -262144;",
+]
+
+PARTITION_TEMPLATE = "trips_template"
+
+# Order of the values in each inserted trip tuple
+TRIP_COLUMNS = [
+    "trip_id", "VendorID", "tpep_pickup_datetime", "tpep_dropoff_datetime",
+    "passenger_count", "trip_distance", "RatecodeID", "store_and_fwd_flag",
+    "PULocationID", "DOLocationID", "payment_type", "fare_amount", "extra",
+    "mta_tax", "tip_amount", "tolls_amount", "improvement_surcharge",
+    "total_amount", "congestion_surcharge", "trip_speed_mph", "cost_per_mile",
+    "time_category", "tip_percentage", "efficiency_score",
+]
 
-def create_database():
+INSERT_TRIP_SQL = f"""
+    INSERT INTO {{table}} ({", ".join(TRIP_COLUMNS)})
+    VALUES ({", ".join("?" * len(TRIP_COLUMNS))});
+"""
+
+# Picks SKETCH_COLUMNS out of an inserted trip tuple
+sketch_row = itemgetter(*(TRIP_COLUMNS.index(name) for name in SKETCH_COLUMNS))
+
+def create_database(bulk=False):
+    """Create a fresh database, with build-time PRAGMAs in bulk mode"""
     print("Creating database...")
     os.makedirs("database", exist_ok=True)
     
     if os.path.exists(DB_FILE):
         os.remove(DB_FILE)
         print(f"Removed existing database: {DB_FILE}")
+
+    if os.path.exists(FINGERPRINTS_FILE):
+        os.remove(FINGERPRINTS_FILE)
+
+    for derived_file in (OD_MATRIX_FILE, version_path(OD_MATRIX_FILE)):
+        if os.path.exists(derived_file):
+            os.remove(derived_file)
     
     conn = sqlite3.connect(DB_FILE)
     conn.execute("PRAGMA foreign_keys = ON;")
     
     with open(SCHEMA_FILE, 'r') as f:
-        conn.executescript(f.read())
+        schema = f.read()
+
+    if bulk:
+        for pragma in BULK_PRAGMAS:
+            conn.execute(pragma)
+
+    conn.executescript(schema)
     
     conn.commit()
     print("Database schema created successfully")
     return conn
 
+def finish_bulk_load(conn, deferred_indexes):
+    print(f"\nBuilding {len(deferred_indexes)} indexes...")
+    for statement in deferred_indexes:
+        conn.execute(statement)
+    conn.commit()
+
+    print("Running ANALYZE...")
+    conn.execute("ANALYZE;")
+    conn.commit()
+
+    conn.execute("PRAGMA locking_mode = NORMAL;")
+    conn.execute("PRAGMA journal_mode = DELETE;")
+    conn.execute("PRAGMA synchronous = FULL;")
+
+def analyze_partition(conn, table):
+    """Refresh planner statistics for one partition.
+
+    analysis_limit samples each index instead of reading all of it, which
+    is enough for the planner to choose between the trips search indexes.
+    """
+    conn.execute("PRAGMA analysis_limit = 1000;")
+    conn.execute(f"ANALYZE {table};")
+    conn.commit()
+
 def load_zones(conn):
     print("Loading zones...")
     cursor = conn.cursor()
@@ -77,124 +163,227 @@ def load_rate_types(conn):
     print(f"Loaded {len(rate_types)} rate types")
     return valid_rates
 
-def is_valid_jan_2019(date_str):
-    """Fast string-based validation for January 2019"""
-    return '2019-01-01 00:00:00' <= date_str < '2019-02-01 00:00:00'
+def month_bounds(month):
+    """Return the [start, end) datetime strings for a 'YYYY-MM' month"""
+    year, mon = (int(part) for part in month.split('-'))
+    next_year, next_mon = (year + 1, 1) if mon == 12 else (year, mon + 1)
+    return f"{year:04d}-{mon:02d}-01 00:00:00", f"{next_year:04d}-{next_mon:02d}-01 00:00:00"
+
+def is_in_month(date_str, bounds):
+    """Fast string-based check that a timestamp falls inside bounds"""
+    return bounds[0] <= date_str < bounds[1]
 
-def load_trips(conn, valid_location_ids, valid_rate_codes):
-    print("Loading trips...")
+def infer_month(path):
+    """Read the 'YYYY-MM' month from a TLC file name such as yellow_tripdata_2019-01_cleaned.csv"""
+    match = re.search(r'(\d{4})-(\d{2})', os.path.basename(path))
+    return f"{match.group(1)}-{match.group(2)}" if match else None
+
+def file_checksum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def partition_name(month):
+    return "trips_" + month.replace('-', '_')
+
+def list_partitions(conn):
+    return [row[0] for row in conn.execute("SELECT table_name FROM trip_partitions ORDER BY start_datetime")]
+
+def refresh_trips_view(conn):
+    """Redefine the trips view as the UNION ALL of every partition"""
+    tables = list_partitions(conn) or [PARTITION_TEMPLATE]
+    conn.execute("DROP VIEW IF EXISTS trips;")
+    conn.execute("CREATE VIEW trips AS\n" + "\nUNION ALL\n".join(f"SELECT * FROM {table}" for table in tables))
+
+def ensure_partition(conn, month, build_indexes=True):
+    """Create the trips partition for month if it does not exist yet.
+
+    The table and its indexes are copied from trips_template. Returns
+    (table name, index statements left for the caller to run).
+    """
+    table = partition_name(month)
+    if conn.execute("SELECT 1 FROM trip_partitions WHERE table_name = ?", (table,)).fetchone():
+        return table, []
+
+    print(f"Creating partition {table}...")
+    template = conn.execute(
+        "SELECT type, sql FROM sqlite_master WHERE tbl_name = ? AND sql IS NOT NULL",
+        (PARTITION_TEMPLATE,)
+    ).fetchall()
+    for kind, sql in template:
+        if kind == 'table':
+            conn.execute(sql.replace(PARTITION_TEMPLATE, table, 1))
+    index_statements = [sql.replace(PARTITION_TEMPLATE, table) for kind, sql in template if kind == 'index']
+
+    start, end = month_bounds(month)
+    conn.execute(
+        "INSERT INTO trip_partitions (table_name, month, start_datetime, end_datetime) VALUES (?, ?, ?, ?);",
+        (table, month, start, end)
+    )
+    refresh_trips_view(conn)
+
+    if not build_indexes:
+        return table, index_statements
+    for statement in index_statements:
+        conn.execute(statement)
+    return table, []
+
+def to_int(value):
+    """int() that maps empty CSV fields and Parquet nulls to None"""
+    return int(value) if value not in (None, '') else None
+
+def to_float(value):
+    """float() that maps empty CSV fields and Parquet nulls to None"""
+    return float(value) if value not in (None, '') else None
+
+def iter_csv_trips(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        yield from csv.DictReader(f)
+
+def iter_parquet_trips(path):
+    """Yield rows from a typed Parquet file, one row group batch at a time.
+
+    Numbers arrive already typed, so nothing is re-parsed from text. The
+    two timestamp columns are formatted back to 'YYYY-MM-DD HH:MM:SS' for
+    the whole batch at once, since the database stores them as TEXT.
+    """
+    parquet = pq.ParquetFile(path)
+    for batch in parquet.iter_batches(batch_size=BATCH_SIZE):
+        names = batch.schema.names
+        columns = []
+        for column in batch.columns:
+            if pa.types.is_timestamp(column.type):
+                # Parquet stores seconds as timestamp[ms]; cast back so
+                # strftime does not add a ".000" fraction.
+                column = pc.strftime(column.cast(pa.timestamp("s")), format="%Y-%m-%d %H:%M:%S")
+            columns.append(column.to_pylist())
+        for values in zip(*columns):
+            yield dict(zip(names, values))
+
+def iter_trips(path):
+    if path.endswith('.parquet'):
+        return iter_parquet_trips(path)
+    return iter_csv_trips(path)
+
+def add_to_sketches(sketches, batch):
+    if sketches is not None:
+        sketches.add([sketch_row(row) for row in batch])
+
+def load_trips(conn, valid_location_ids, valid_rate_codes, trips_file=TRIPS_FILE, seen_trips=None,
+               commit_every=BATCH_SIZE, month="2019-01", table=None, first_trip_id=1, sketches=None):
+    """Insert trips whose pickup and dropoff fall inside month into its partition.
+
+    Trips are numbered from first_trip_id. With commit_every=None nothing
+    is committed here, so the caller can commit the whole file together
+    with its ingested_files record. Each inserted batch is also counted
+    into sketches, if given. Returns the number of trips inserted.
+    """
+    table = table or partition_name(month)
+    print(f"Loading {month} trips from {trips_file} into {table}...")
+    bounds = month_bounds(month)
+    insert_sql = INSERT_TRIP_SQL.format(table=table)
+    next_trip_id = first_trip_id
 
     total_inserted = 0
+    last_commit = 0
     total_skipped = 0
     batch = []
     skip_reasons = defaultdict(int)
 
-    seen_trips = set()
+    if seen_trips is None:
+        seen_trips = TripFingerprints()
     log_duplicates = []
 
     cursor = conn.cursor()
 
-    with open(TRIPS_FILE, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
+    for row_num, row in enumerate(iter_trips(trips_file), start=1):
+        try:
+            pickup_dt = row['tpep_pickup_datetime']
+            dropoff_dt = row['tpep_dropoff_datetime']
 
-        for row_num, row in enumerate(reader, start=1):
-            try:
-                pickup_dt = row['tpep_pickup_datetime']
-                dropoff_dt = row['tpep_dropoff_datetime']
-
-                if not is_valid_jan_2019(pickup_dt) or not is_valid_jan_2019(dropoff_dt) or dropoff_dt <= pickup_dt:
-                    total_skipped += 1
-                    skip_reasons["date"] += 1
-                    continue
-
-                pu_location = int(row['PULocationID'])
-                do_location = int(row['DOLocationID'])
-                if pu_location not in valid_location_ids or do_location not in valid_location_ids:
-                    total_skipped += 1
-                    skip_reasons["location"] += 1
-                    continue
-
-                rate_code = int(row.get('RatecodeID') or 1)
-                if rate_code not in valid_rate_codes:
-                    rate_code = 1
-                    skip_reasons["ratecode"] += 1
-
-                trip_key = (
-                    row.get('VendorID'), pickup_dt, dropoff_dt,
-                    pu_location, do_location,
-                    row.get('passenger_count'), row.get('trip_distance'),
-                    row.get('fare_amount')
-                )
-
-                if trip_key in seen_trips:
-                    total_skipped += 1
-                    skip_reasons["duplicate"] += 1
-                    if len(log_duplicates) < 1000:
-                        log_duplicates.append(row)
-                    continue
-                seen_trips.add(trip_key)
-
-                batch.append((
-                    int(row['VendorID']) if row.get('VendorID') else None,
-                    pickup_dt,
-                    dropoff_dt,
-                    int(row['passenger_count']) if row.get('passenger_count') else None,
-                    float(row['trip_distance']) if row.get('trip_distance') else None,
-                    rate_code,
-                    row.get('store_and_fwd_flag'),
-                    pu_location,
-                    do_location,
-                    int(row['payment_type']) if row.get('payment_type') else None,
-                    float(row['fare_amount']) if row.get('fare_amount') else None,
-                    float(row['extra']) if row.get('extra') else None,
-                    float(row['mta_tax']) if row.get('mta_tax') else None,
-                    float(row['tip_amount']) if row.get('tip_amount') else None,
-                    float(row['tolls_amount']) if row.get('tolls_amount') else None,
-                    float(row['improvement_surcharge']) if row.get('improvement_surcharge') else None,
-                    float(row['total_amount']) if row.get('total_amount') else None,
-                    float(row['congestion_surcharge']) if row.get('congestion_surcharge') else None,
-                    float(row['trip_speed_mph']) if row.get('trip_speed_mph') else None,
-                    float(row['cost_per_mile']) if row.get('cost_per_mile') else None,
-                    row.get('time_category'),
-                    float(row['tip_percentage']) if row.get('tip_percentage') else None,
-                    float(row['efficiency_score']) if row.get('efficiency_score') else None
-                ))
-
-                if len(batch) >= BATCH_SIZE:
-                    cursor.executemany("""
-                        INSERT INTO trips (
-                            VendorID, tpep_pickup_datetime, tpep_dropoff_datetime,
-                            passenger_count, trip_distance, RatecodeID, store_and_fwd_flag,
-                            PULocationID, DOLocationID, payment_type, fare_amount, extra,
-                            mta_tax, tip_amount, tolls_amount, improvement_surcharge,
-                            total_amount, congestion_surcharge, trip_speed_mph, cost_per_mile,
-                            time_category, tip_percentage, efficiency_score
-                        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
-                    """, batch)
-                    conn.commit()
-                    total_inserted += len(batch)
-                    print(f"Loaded {total_inserted:,} trips (skipped {total_skipped:,})...")
-                    batch = []
+            if not is_in_month(pickup_dt, bounds) or not is_in_month(dropoff_dt, bounds) or dropoff_dt <= pickup_dt:
+                total_skipped += 1
+                skip_reasons["date"] += 1
+                continue
+
+            pu_location = int(row['PULocationID'])
+            do_location = int(row['DOLocationID'])
+            if pu_location not in valid_location_ids or do_location not in valid_location_ids:
+                total_skipped += 1
+                skip_reasons["location"] += 1
+                continue
+
+            rate_code = int(row.get('RatecodeID') or 1)
+            if rate_code not in valid_rate_codes:
+                rate_code = 1
+                skip_reasons["ratecode"] += 1
 
-            except Exception as e:
+            trip_key = (
+                row.get('VendorID'), pickup_dt, dropoff_dt,
+                pu_location, do_location,
+                row.get('passenger_count'), row.get('trip_distance'),
+                row.get('fare_amount')
+            )
+
+            if seen_trips.check_and_add(trip_key):
                 total_skipped += 1
-                skip_reasons["other"] += 1
-                if skip_reasons["other"] <= 5:
-                    print(f"Row {row_num} error: {e}")
+                skip_reasons["duplicate"] += 1
+                if len(log_duplicates) < 1000:
+                    log_duplicates.append(row)
+                continue
+
+            batch.append((
+                next_trip_id,
+                to_int(row.get('VendorID')),
+                pickup_dt,
+                dropoff_dt,
+                to_int(row.get('passenger_count')),
+                to_float(row.get('trip_distance')),
+                rate_code,
+                row.get('store_and_fwd_flag'),
+                pu_location,
+                do_location,
+                to_int(row.get('payment_type')),
+                to_float(row.get('fare_amount')),
+                to_float(row.get('extra')),
+                to_float(row.get('mta_tax')),
+                to_float(row.get('tip_amount')),
+                to_float(row.get('tolls_amount')),
+                to_float(row.get('improvement_surcharge')),
+                to_float(row.get('total_amount')),
+                to_float(row.get('congestion_surcharge')),
+                to_float(row.get('trip_speed_mph')),
+                to_float(row.get('cost_per_mile')),
+                row.get('time_category'),
+                to_float(row.get('tip_percentage')),
+                to_float(row.get('efficiency_score'))
+            ))
+            next_trip_id += 1
+
+            if len(batch) >= BATCH_SIZE:
+                cursor.executemany(insert_sql, batch)
+                total_inserted += len(batch)
+                add_to_sketches(sketches, batch)
+                if commit_every and total_inserted - last_commit >= commit_every:
+                    conn.commit()
+                    last_commit = total_inserted
+                print(f"Loaded {total_inserted:,} trips (skipped {total_skipped:,})...")
+                batch = []
+
+        except Exception as e:
+            total_skipped += 1
+            skip_reasons["other"] += 1
+            if skip_reasons["other"] <= 5:
+                print(f"Row {row_num} error: {e}")
 
     if batch:
-        cursor.executemany("""
-            INSERT INTO trips (
-                VendorID, tpep_pickup_datetime, tpep_dropoff_datetime,
-                passenger_count, trip_distance, RatecodeID, store_and_fwd_flag,
-                PULocationID, DOLocationID, payment_type, fare_amount, extra,
-                mta_tax, tip_amount, tolls_amount, improvement_surcharge,
-                total_amount, congestion_surcharge, trip_speed_mph, cost_per_mile,
-                time_category, tip_percentage, efficiency_score
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
-        """, batch)
-        conn.commit()
+        cursor.executemany(insert_sql, batch)
         total_inserted += len(batch)
+        add_to_sketches(sketches, batch)
+    if commit_every:
+        conn.commit()
 
     if log_duplicates:
         print(f"\nSaving {len(log_duplicates)} duplicate samples to log...")
@@ -209,6 +398,40 @@ def load_trips(conn, valid_location_ids, valid_rate_codes):
     for reason, count in sorted(skip_reasons.items(), key=lambda x: x[1], reverse=True):
         print(f"  {reason}: {count:,}")
 
+    return total_inserted
+
+def open_database():
+    conn = sqlite3.connect(DB_FILE)
+    conn.execute("PRAGMA foreign_keys = ON;")
+    return conn
+
+def find_ingested_file(conn, checksum):
+    return conn.execute(
+        "SELECT file_name, month, ingested_at FROM ingested_files WHERE checksum = ?",
+        (checksum,)
+    ).fetchone()
+
+def max_trip_id(conn):
+    # MAX on each partition's primary key is a single b-tree lookup; on the
+    # trips view it would scan every partition.
+    return max(
+        (conn.execute(f"SELECT COALESCE(MAX(trip_id), 0) FROM {table}").fetchone()[0]
+         for table in list_partitions(conn)),
+        default=0
+    )
+
+def record_ingestion(conn, trips_file, checksum, month, first_trip_id, rows_inserted):
+    last_trip_id = first_trip_id + rows_inserted - 1
+    conn.execute("""
+        INSERT INTO ingested_files (file_name, checksum, month, first_trip_id, last_trip_id, rows_inserted)
+        VALUES (?, ?, ?, ?, ?, ?);
+    """, (
+        os.path.basename(trips_file), checksum, month,
+        first_trip_id if rows_inserted else None,
+        last_trip_id if rows_inserted else None,
+        rows_inserted,
+    ))
+
 def verify_data(conn):
     print("\nVerifying data...")
     cursor = conn.cursor()
@@ -227,15 +450,109 @@ def verify_data(conn):
     if date_range[0]:
         print(f"Date range: {date_range[0]} to {date_range[1]}")
 
+    cursor.execute("SELECT month, file_name, rows_inserted FROM ingested_files ORDER BY month")
+    for month, file_name, rows_inserted in cursor.fetchall():
+        print(f"Ingested {month}: {file_name} ({rows_inserted:,} trips)")
+
+    print(f"Partitions: {', '.join(list_partitions(conn))}")
+
 def main():
+    parser = argparse.ArgumentParser(description="Build the NYC taxi SQLite database")
+    parser.add_argument(
+        "--trips", default=TRIPS_FILE,
+        help=f"cleaned trips file, .csv or .parquet (default: {TRIPS_FILE}; "
+             f"Parquet output of clean_data.py is at {TRIPS_PARQUET_FILE})",
+    )
+    parser.add_argument(
+        "--bulk", action="store_true",
+        help="fast rebuild: no journal, large transactions, indexes built after the load",
+    )
+    parser.add_argument(
+        "--append", action="store_true",
+        help="add the file to the existing database instead of rebuilding it",
+    )
+    parser.add_argument(
+        "--month",
+        help="month the file covers as YYYY-MM (default: read from the file name)",
+    )
+    args = parser.parse_args()
+
+    month = args.month or infer_month(args.trips)
+    if not month:
+        parser.error("could not read the month from the file name; pass --month YYYY-MM")
+    if args.append and args.bulk:
+        parser.error("--bulk rebuilds from scratch and cannot be combined with --append")
+
     print("="*70)
     print("NYC TAXI DATABASE SETUP")
     print("="*70 + "\n")
-    
-    conn = create_database()
-    valid_location_ids = load_zones(conn)
-    valid_rate_codes = load_rate_types(conn)
-    load_trips(conn, valid_location_ids, valid_rate_codes)
+
+    checksum = file_checksum(args.trips)
+
+    if args.append and os.path.exists(DB_FILE):
+        conn = open_database()
+        conn.executescript(open(SCHEMA_FILE).read())
+
+        ingested = find_ingested_file(conn, checksum)
+        if ingested:
+            print(f"{ingested[0]} ({ingested[1]}) was already ingested on {ingested[2]}; nothing to do.")
+            conn.close()
+            return
+
+        valid_location_ids = set(row[0] for row in conn.execute("SELECT LocationID FROM zones"))
+        valid_rate_codes = set(row[0] for row in conn.execute("SELECT RatecodeID FROM rate_types"))
+    else:
+        conn = create_database(bulk=args.bulk)
+        valid_location_ids = load_zones(conn)
+        valid_rate_codes = load_rate_types(conn)
+
+    # Appends load the whole file in one transaction, committed together
+    # with its partition and ingested_files row, so a failed append leaves
+    # no trace.
+    if args.append:
+        commit_every = None
+        conn.execute("BEGIN;")
+        backfill_aggregates(conn)
+        backfill_sketches(conn)
+    elif args.bulk:
+        commit_every = BULK_COMMIT_ROWS
+    else:
+        commit_every = BATCH_SIZE
+
+    # In bulk mode the partition's indexes are built after the load.
+    table, deferred_indexes = ensure_partition(conn, month, build_indexes=not args.bulk)
+
+    seen_trips = TripFingerprints(FINGERPRINTS_FILE)
+    sketches = TripSketches(sketch_gamma(conn))
+    first_trip_id = max_trip_id(conn) + 1
+    inserted = load_trips(
+        conn, valid_location_ids, valid_rate_codes, args.trips, seen_trips, commit_every, month,
+        table, first_trip_id, sketches
+    )
+    if inserted:
+        # Only the trips this file added are folded into the aggregates.
+        print("Refreshing aggregate tables...")
+        refresh_aggregates(conn, table, first_trip_id, first_trip_id + inserted - 1)
+        print("Saving quantile sketches...")
+        sketches.save(conn)
+    # The matrix file is staged now and only swapped in once the trips it
+    # covers are committed.
+    print("Refreshing OD matrix...")
+    staged_matrix = stage_od_matrix(conn, table, first_trip_id, first_trip_id + inserted - 1, OD_MATRIX_FILE)
+    record_ingestion(conn, args.trips, checksum, month, first_trip_id, inserted)
+    bump_data_version(conn)
+    try:
+        conn.commit()
+    except BaseException:
+        discard_od_matrix(staged_matrix)
+        raise
+    install_od_matrix(conn, staged_matrix, OD_MATRIX_FILE)
+    seen_trips.save()
+
+    if args.bulk:
+        finish_bulk_load(conn, deferred_indexes)
+    else:
+        analyze_partition(conn, table)
     verify_data(conn)
     
     conn.close()
@@ -0,0 +1,152 @@
+import os
+import sqlite3
+
+import numpy as np
+
+from data_version import read_data_version
+
+
+# ORIGIN-DESTINATION MATRIX
+# A dense pickup zone x dropoff zone matrix of additive trip totals, kept
+# next to the database as a .npy file the API memory-maps. Like the agg_*
+# tables it holds a trip count plus a sum and a non-null count for every
+# measured column, so appends are folded in by adding the new trips' matrix
+# and averages are sum / count. Cell [i, j] is PULocationID i + 1 to
+# DOLocationID j + 1.
+#
+# The matrix lives outside the database's transactions, so a load stages
+# the new file before its commit and installs it only after the commit
+# succeeds. A .version file beside the matrix records the data_version it
+# matches; a matrix whose version is not the database's (a crash between
+# commit and install, or a load that failed after installing) is rebuilt
+# from the trips instead of having new trips folded in.
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+OD_MATRIX_FILE = os.path.join(BASE_DIR, "od_matrix.npy")
+OD_MEASURES = ["total_amount", "fare_amount", "trip_distance", "trip_speed_mph"]
+
+# One named float64 field per total, so the file describes its own layout
+OD_DTYPE = np.dtype(
+    [("trip_count", "f8")]
+    + [(f"{measure}_{total}", "f8") for measure in OD_MEASURES for total in ("sum", "count")]
+)
+
+
+def od_matrix_size(conn):
+    """Rows and columns of the matrix: one per LocationID up to the highest"""
+    return conn.execute("SELECT COALESCE(MAX(LocationID), 0) FROM zones").fetchone()[0]
+
+
+def compute_od_matrix(conn, partition, first_trip_id=None, last_trip_id=None):
+    """OD totals of the trips in one partition, or of a trip_id range in it"""
+    size = od_matrix_size(conn)
+    selects = ["COUNT(*)"]
+    for measure in OD_MEASURES:
+        selects += [f"TOTAL({measure})", f"COUNT({measure})"]
+    where = "trip_id BETWEEN ? AND ?" if first_trip_id is not None else "1=1"
+    params = (first_trip_id, last_trip_id) if first_trip_id is not None else ()
+
+    rows = conn.execute(f"""
+        SELECT PULocationID, DOLocationID, {", ".join(selects)}
+        FROM {partition}
+        WHERE {where}
+        GROUP BY PULocationID, DOLocationID
+    """, params).fetchall()
+
+    matrix = np.zeros((size, size), dtype=OD_DTYPE)
+    if not rows:
+        return matrix
+    totals = np.array(rows, dtype=np.float64)
+    pickups = totals[:, 0].astype(np.intp) - 1
+    dropoffs = totals[:, 1].astype(np.intp) - 1
+    for column, name in enumerate(OD_DTYPE.names, start=2):
+        matrix[name][pickups, dropoffs] = totals[:, column]
+    return matrix
+
+
+def add_od_matrix(matrix, other):
+    for name in OD_DTYPE.names:
+        matrix[name] += other[name]
+    return matrix
+
+
+def version_path(path):
+    return path + ".version"
+
+
+def staged_path(path):
+    return path + ".tmp.npy"
+
+
+def matrix_version(path):
+    """data_version the matrix at path was installed for, or None"""
+    try:
+        with open(version_path(path)) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def write_matrix_version(path, version):
+    tmp_file = version_path(path) + ".tmp"
+    with open(tmp_file, "w") as f:
+        f.write(str(version))
+    os.replace(tmp_file, version_path(path))
+
+
+def full_od_matrix(conn):
+    matrix = np.zeros((od_matrix_size(conn),) * 2, dtype=OD_DTYPE)
+    for (partition,) in conn.execute("SELECT table_name FROM trip_partitions").fetchall():
+        add_od_matrix(matrix, compute_od_matrix(conn, partition))
+    return matrix
+
+
+def stage_od_matrix(conn, partition=None, first_trip_id=None, last_trip_id=None, path=OD_MATRIX_FILE):
+    """Write the matrix for the trips conn sees beside path, without installing it.
+
+    Given a partition and trip_id range, those trips are folded into the
+    installed matrix. That needs a matrix of the right shape whose version
+    matches the database before this load's data_version bump; otherwise,
+    or with no partition, it is rebuilt from every partition. Returns the
+    staged file for install_od_matrix.
+    """
+    existing = np.load(path) if partition is not None and os.path.exists(path) else None
+    if (
+        existing is None
+        or existing.dtype != OD_DTYPE
+        or existing.shape != (od_matrix_size(conn),) * 2
+        or matrix_version(path) != read_data_version(conn)
+    ):
+        matrix = full_od_matrix(conn)
+    else:
+        matrix = add_od_matrix(existing, compute_od_matrix(conn, partition, first_trip_id, last_trip_id))
+    staged_file = staged_path(path)
+    with open(staged_file, "wb") as f:
+        np.save(f, matrix)
+    return staged_file
+
+
+def install_od_matrix(conn, staged_file, path=OD_MATRIX_FILE):
+    """Swap a staged matrix in once the trips it covers are committed"""
+    os.replace(staged_file, path)
+    write_matrix_version(path, read_data_version(conn))
+
+
+def discard_od_matrix(staged_file):
+    if os.path.exists(staged_file):
+        os.remove(staged_file)
+
+
+def rebuild_od_matrix(conn, path=OD_MATRIX_FILE):
+    """Recompute the matrix from every committed trip partition and install it"""
+    install_od_matrix(conn, stage_od_matrix(conn, path=path), path)
+
+
+if __name__ == "__main__":
+    # The matrix is derived data: rebuild it if it is lost or out of step
+    conn = sqlite3.connect(os.path.join(BASE_DIR, "nyc_taxi.db"))
+    print(f"Rebuilding {OD_MATRIX_FILE}...")
+    rebuild_od_matrix(conn)
+    conn.close()
+    print("Done.")
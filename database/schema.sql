@@ -10,19 +10,18 @@ CREATE TABLE IF NOT EXISTS rate_types (
     Description VARCHAR(100) NOT NULL
 );
 
-CREATE TABLE IF NOT EXISTS trips (
-    trip_id INTEGER PRIMARY KEY AUTOINCREMENT,
+-- Trips are stored in one table per pickup month (trips_2019_01, ...).
+-- insert_data.py creates each partition by copying this table and its
+-- indexes, records it in trip_partitions, and redefines the trips view
+-- below as the UNION ALL of all partitions. trip_id is assigned by the
+-- loader so it stays unique across partitions.
+CREATE TABLE IF NOT EXISTS trips_template (
+    trip_id INTEGER PRIMARY KEY,
     VendorID INT,
     tpep_pickup_datetime TEXT NOT NULL
-        CHECK (
-            tpep_pickup_datetime >= '2019-01-01 00:00:00'
-            AND tpep_pickup_datetime < '2019-02-01 00:00:00'
-        ),
+        CHECK (LENGTH(tpep_pickup_datetime) = 19),
     tpep_dropoff_datetime TEXT NOT NULL
-        CHECK (
-            tpep_dropoff_datetime >= '2019-01-01 00:00:00'
-            AND tpep_dropoff_datetime < '2019-02-01 23:59:59'
-        ),
+        CHECK (LENGTH(tpep_dropoff_datetime) = 19),
     passenger_count INT CHECK (passenger_count >= 1 AND passenger_count <= 6),
     trip_distance FLOAT CHECK (trip_distance >= 0.1 AND trip_distance <= 100),
     RatecodeID INT,
@@ -49,15 +48,75 @@ CREATE TABLE IF NOT EXISTS trips (
     FOREIGN KEY (RatecodeID) REFERENCES rate_types(RatecodeID)
 );
 
-CREATE INDEX IF NOT EXISTS idx_trips_pickup_datetime ON trips(tpep_pickup_datetime);
-CREATE INDEX IF NOT EXISTS idx_trips_dropoff_datetime ON trips(tpep_dropoff_datetime);
-CREATE INDEX IF NOT EXISTS idx_trips_pickup_location ON trips(PULocationID);
-CREATE INDEX IF NOT EXISTS idx_trips_dropoff_location ON trips(DOLocationID);
-CREATE INDEX IF NOT EXISTS idx_trips_time_category ON trips(time_category);
-CREATE INDEX IF NOT EXISTS idx_trips_fare ON trips(fare_amount);
-CREATE INDEX IF NOT EXISTS idx_trips_distance ON trips(trip_distance);
-CREATE INDEX IF NOT EXISTS idx_trips_pickup_borough ON trips(PULocationID, tpep_pickup_datetime);
-CREATE INDEX IF NOT EXISTS idx_trips_time_fare ON trips(tpep_pickup_datetime, fare_amount);
+-- One row per cleaned monthly file loaded by insert_data.py. The checksum
+-- makes re-running a load a no-op; the trip_id range identifies the rows
+-- each file added.
+CREATE TABLE IF NOT EXISTS ingested_files (
+    file_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    file_name TEXT NOT NULL,
+    checksum TEXT NOT NULL UNIQUE,
+    month TEXT NOT NULL,
+    first_trip_id INTEGER,
+    last_trip_id INTEGER,
+    rows_inserted INTEGER NOT NULL,
+    ingested_at TEXT NOT NULL DEFAULT (DATETIME('now'))
+);
+
+-- Single row stamped by every load or repair of trip data. The API keys
+-- its response cache on the version, so cached results are dropped as
+-- soon as the data they were computed from changes.
+CREATE TABLE IF NOT EXISTS data_version (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    version INTEGER NOT NULL,
+    updated_at TEXT NOT NULL
+);
+
+-- Quantile sketches of fares, speeds and tip percentages per pickup date
+-- and pickup zone, written by database/sketches.py. counts holds
+-- little-endian uint32 trip counts for the log buckets min_bucket,
+-- min_bucket + 1, ...; bucket i covers values in (gamma^(i-1), gamma^i].
+-- Values at or near zero are counted in zero_count. Rows are clustered by
+-- measure and date, so a query reads one contiguous range.
+CREATE TABLE IF NOT EXISTS trip_sketches (
+    pickup_date TEXT NOT NULL,
+    PULocationID INT NOT NULL,
+    measure TEXT NOT NULL,
+    zero_count INTEGER NOT NULL DEFAULT 0,
+    min_bucket INTEGER NOT NULL,
+    counts BLOB NOT NULL,
+    PRIMARY KEY (measure, pickup_date, PULocationID)
+) WITHOUT ROWID;
+
+-- Single row: the bucket growth factor every stored sketch uses, so
+-- sketches from different loads always merge.
+CREATE TABLE IF NOT EXISTS sketch_settings (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    relative_accuracy FLOAT NOT NULL,
+    gamma FLOAT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS trip_partitions (
+    table_name TEXT PRIMARY KEY,
+    month TEXT NOT NULL UNIQUE,
+    start_datetime TEXT NOT NULL,
+    end_datetime TEXT NOT NULL
+);
+
+-- Indexes for the /api/trips search. Pickup time alone serves date
+-- ranges and keyset paging, whose (pickup time, trip_id) order is the
+-- index order since entries end in the rowid. The zone indexes lead with
+-- the LocationIDs, then pickup time for date ranges and paging, and carry
+-- fare_amount so rows outside a fare range are skipped without reading
+-- the table. A fare index alone serves narrow fare ranges.
+CREATE INDEX IF NOT EXISTS idx_trips_template_pickup_datetime ON trips_template(tpep_pickup_datetime);
+CREATE INDEX IF NOT EXISTS idx_trips_template_time_fare ON trips_template(tpep_pickup_datetime, fare_amount);
+CREATE INDEX IF NOT EXISTS idx_trips_template_fare ON trips_template(fare_amount);
+CREATE INDEX IF NOT EXISTS idx_trips_template_pickup_search ON trips_template(PULocationID, tpep_pickup_datetime, fare_amount);
+CREATE INDEX IF NOT EXISTS idx_trips_template_dropoff_search ON trips_template(DOLocationID, tpep_pickup_datetime, fare_amount);
+CREATE INDEX IF NOT EXISTS idx_trips_template_route_search ON trips_template(PULocationID, DOLocationID, tpep_pickup_datetime, fare_amount);
+
+CREATE VIEW IF NOT EXISTS trips AS
+SELECT * FROM trips_template;
 
 CREATE VIEW IF NOT EXISTS v_trips_enriched AS
 SELECT
@@ -84,51 +143,146 @@ FROM trips t
 JOIN zones pu ON t.PULocationID = pu.LocationID
 JOIN zones do ON t.DOLocationID = do.LocationID;
 
+-- Additive totals per group, filled by database/aggregates.py when trips
+-- are loaded and folded forward on every append. Averages are stored as
+-- a sum and a non-null count so they stay exact under incremental updates.
+CREATE TABLE IF NOT EXISTS agg_daily (
+    pickup_date TEXT NOT NULL,
+    trip_count INTEGER NOT NULL,
+    total_amount_sum FLOAT NOT NULL DEFAULT 0,
+    total_amount_count INTEGER NOT NULL DEFAULT 0,
+    fare_amount_sum FLOAT NOT NULL DEFAULT 0,
+    fare_amount_count INTEGER NOT NULL DEFAULT 0,
+    trip_distance_sum FLOAT NOT NULL DEFAULT 0,
+    trip_distance_count INTEGER NOT NULL DEFAULT 0,
+    trip_speed_mph_sum FLOAT NOT NULL DEFAULT 0,
+    trip_speed_mph_count INTEGER NOT NULL DEFAULT 0,
+    tip_percentage_sum FLOAT NOT NULL DEFAULT 0,
+    tip_percentage_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (pickup_date)
+);
+
+CREATE TABLE IF NOT EXISTS agg_hourly (
+    pickup_hour INTEGER NOT NULL,
+    trip_count INTEGER NOT NULL,
+    fare_amount_sum FLOAT NOT NULL DEFAULT 0,
+    fare_amount_count INTEGER NOT NULL DEFAULT 0,
+    trip_speed_mph_sum FLOAT NOT NULL DEFAULT 0,
+    trip_speed_mph_count INTEGER NOT NULL DEFAULT 0,
+    tip_percentage_sum FLOAT NOT NULL DEFAULT 0,
+    tip_percentage_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (pickup_hour)
+);
+
+CREATE TABLE IF NOT EXISTS agg_time_category (
+    time_category TEXT NOT NULL,
+    trip_count INTEGER NOT NULL,
+    fare_amount_sum FLOAT NOT NULL DEFAULT 0,
+    fare_amount_count INTEGER NOT NULL DEFAULT 0,
+    trip_speed_mph_sum FLOAT NOT NULL DEFAULT 0,
+    trip_speed_mph_count INTEGER NOT NULL DEFAULT 0,
+    tip_percentage_sum FLOAT NOT NULL DEFAULT 0,
+    tip_percentage_count INTEGER NOT NULL DEFAULT 0,
+    efficiency_score_sum FLOAT NOT NULL DEFAULT 0,
+    efficiency_score_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (time_category)
+);
+
+CREATE TABLE IF NOT EXISTS agg_pickup_zones (
+    PULocationID INT NOT NULL,
+    trip_count INTEGER NOT NULL,
+    total_amount_sum FLOAT NOT NULL DEFAULT 0,
+    total_amount_count INTEGER NOT NULL DEFAULT 0,
+    trip_distance_sum FLOAT NOT NULL DEFAULT 0,
+    trip_distance_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (PULocationID)
+);
+
+CREATE TABLE IF NOT EXISTS agg_routes (
+    pickup_borough VARCHAR(50) NOT NULL,
+    pickup_zone VARCHAR(100) NOT NULL,
+    dropoff_borough VARCHAR(50) NOT NULL,
+    dropoff_zone VARCHAR(100) NOT NULL,
+    trip_count INTEGER NOT NULL,
+    total_amount_sum FLOAT NOT NULL DEFAULT 0,
+    total_amount_count INTEGER NOT NULL DEFAULT 0,
+    fare_amount_sum FLOAT NOT NULL DEFAULT 0,
+    fare_amount_count INTEGER NOT NULL DEFAULT 0,
+    trip_distance_sum FLOAT NOT NULL DEFAULT 0,
+    trip_distance_count INTEGER NOT NULL DEFAULT 0,
+    trip_speed_mph_sum FLOAT NOT NULL DEFAULT 0,
+    trip_speed_mph_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (pickup_borough, pickup_zone, dropoff_borough, dropoff_zone)
+);
+
+CREATE INDEX IF NOT EXISTS idx_agg_routes_trip_count ON agg_routes(trip_count);
+
+-- Rollup behind /api/stats/cube: one row per pickup date, hour, pickup
+-- zone, dropoff borough and time category. A missing time category is
+-- stored as '', as in agg_time_category.
+CREATE TABLE IF NOT EXISTS agg_cube (
+    pickup_date TEXT NOT NULL,
+    pickup_hour INTEGER NOT NULL,
+    PULocationID INT NOT NULL,
+    dropoff_borough VARCHAR(50) NOT NULL,
+    time_category TEXT NOT NULL,
+    trip_count INTEGER NOT NULL,
+    total_amount_sum FLOAT NOT NULL DEFAULT 0,
+    total_amount_count INTEGER NOT NULL DEFAULT 0,
+    fare_amount_sum FLOAT NOT NULL DEFAULT 0,
+    fare_amount_count INTEGER NOT NULL DEFAULT 0,
+    trip_distance_sum FLOAT NOT NULL DEFAULT 0,
+    trip_distance_count INTEGER NOT NULL DEFAULT 0,
+    trip_speed_mph_sum FLOAT NOT NULL DEFAULT 0,
+    trip_speed_mph_count INTEGER NOT NULL DEFAULT 0,
+    tip_percentage_sum FLOAT NOT NULL DEFAULT 0,
+    tip_percentage_count INTEGER NOT NULL DEFAULT 0,
+    efficiency_score_sum FLOAT NOT NULL DEFAULT 0,
+    efficiency_score_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (pickup_date, pickup_hour, PULocationID, dropoff_borough, time_category)
+);
 CREATE VIEW IF NOT EXISTS v_daily_revenue AS
 SELECT
-    DATE(tpep_pickup_datetime) AS pickup_date,
-    COUNT(*) AS total_trips,
-    ROUND(SUM(total_amount), 2) AS total_revenue,
-    ROUND(AVG(total_amount), 2) AS avg_trip_value,
-    ROUND(AVG(trip_distance), 2) AS avg_distance,
-    ROUND(AVG(trip_speed_mph), 2) AS avg_speed
-FROM trips
-GROUP BY pickup_date
+    pickup_date,
+    trip_count AS total_trips,
+    ROUND(total_amount_sum, 2) AS total_revenue,
+    ROUND(total_amount_sum / total_amount_count, 2) AS avg_trip_value,
+    ROUND(trip_distance_sum / trip_distance_count, 2) AS avg_distance,
+    ROUND(trip_speed_mph_sum / trip_speed_mph_count, 2) AS avg_speed
+FROM agg_daily
 ORDER BY pickup_date;
 
 CREATE VIEW IF NOT EXISTS v_hourly_demand AS
 SELECT
-    CAST(STRFTIME('%H', tpep_pickup_datetime) AS INTEGER) AS pickup_hour,
-    COUNT(*) AS trip_count,
-    ROUND(AVG(fare_amount), 2) AS avg_fare,
-    ROUND(AVG(trip_speed_mph), 2) AS avg_speed,
-    ROUND(AVG(tip_percentage), 2) AS avg_tip_pct
-FROM trips
-GROUP BY pickup_hour
+    pickup_hour,
+    trip_count,
+    ROUND(fare_amount_sum / fare_amount_count, 2) AS avg_fare,
+    ROUND(trip_speed_mph_sum / trip_speed_mph_count, 2) AS avg_speed,
+    ROUND(tip_percentage_sum / tip_percentage_count, 2) AS avg_tip_pct
+FROM agg_hourly
 ORDER BY pickup_hour;
 
 CREATE VIEW IF NOT EXISTS v_borough_revenue AS
 SELECT
     z.Borough,
-    COUNT(*) AS total_trips,
-    ROUND(SUM(t.total_amount), 2) AS total_revenue,
-    ROUND(AVG(t.total_amount), 2) AS avg_trip_value,
-    ROUND(AVG(t.trip_distance), 2) AS avg_distance
-FROM trips t
-JOIN zones z ON t.PULocationID = z.LocationID
+    SUM(a.trip_count) AS total_trips,
+    ROUND(SUM(a.total_amount_sum), 2) AS total_revenue,
+    ROUND(SUM(a.total_amount_sum) / SUM(a.total_amount_count), 2) AS avg_trip_value,
+    ROUND(SUM(a.trip_distance_sum) / SUM(a.trip_distance_count), 2) AS avg_distance
+FROM agg_pickup_zones a
+JOIN zones z ON a.PULocationID = z.LocationID
 GROUP BY z.Borough
 ORDER BY total_revenue DESC;
 
 CREATE VIEW IF NOT EXISTS v_time_category_stats AS
 SELECT
-    time_category,
-    COUNT(*) AS trip_count,
-    ROUND(AVG(fare_amount), 2) AS avg_fare,
-    ROUND(AVG(trip_speed_mph), 2) AS avg_speed,
-    ROUND(AVG(tip_percentage), 2) AS avg_tip_pct,
-    ROUND(AVG(efficiency_score), 2) AS avg_efficiency
-FROM trips
-GROUP BY time_category
+    NULLIF(time_category, '') AS time_category,
+    trip_count,
+    ROUND(fare_amount_sum / fare_amount_count, 2) AS avg_fare,
+    ROUND(trip_speed_mph_sum / trip_speed_mph_count, 2) AS avg_speed,
+    ROUND(tip_percentage_sum / tip_percentage_count, 2) AS avg_tip_pct,
+    ROUND(efficiency_score_sum / efficiency_score_count, 2) AS avg_efficiency
+FROM agg_time_category
 ORDER BY 
     CASE time_category
         WHEN 'late_night' THEN 1
@@ -140,17 +294,14 @@ ORDER BY
 
 CREATE VIEW IF NOT EXISTS v_top_routes AS
 SELECT
-    pu.Borough || ' -> ' || do.Borough AS route,
-    pu.Zone AS pickup_zone,
-    do.Zone AS dropoff_zone,
-    COUNT(*) AS trip_count,
-    ROUND(AVG(t.fare_amount), 2) AS avg_fare,
-    ROUND(AVG(t.trip_distance), 2) AS avg_distance,
-    ROUND(AVG(t.trip_speed_mph), 2) AS avg_speed
-FROM trips t
-JOIN zones pu ON t.PULocationID = pu.LocationID
-JOIN zones do ON t.DOLocationID = do.LocationID
-GROUP BY pu.Borough, do.Borough, pu.Zone, do.Zone
-HAVING trip_count > 100
+    pickup_borough || ' -> ' || dropoff_borough AS route,
+    pickup_zone,
+    dropoff_zone,
+    trip_count,
+    ROUND(fare_amount_sum / fare_amount_count, 2) AS avg_fare,
+    ROUND(trip_distance_sum / trip_distance_count, 2) AS avg_distance,
+    ROUND(trip_speed_mph_sum / trip_speed_mph_count, 2) AS avg_speed
+FROM agg_routes
+WHERE trip_count > 100
 ORDER BY trip_count DESC
 LIMIT 50;
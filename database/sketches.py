@@ -0,0 +1,199 @@
+import sqlite3
+
+import numpy as np
+
+
+# QUANTILE SKETCHES
+# Per pickup date, pickup zone and measure, the trips' values are counted
+# in logarithmic buckets (the DDSketch scheme): bucket i holds values in
+# (gamma^(i-1), gamma^i]. Any value is then known to within
+# RELATIVE_ACCURACY, and sketches merge by adding counts, so a percentile
+# over any set of days and zones is a sum of stored sketches rather than
+# a sort of the trips. Values at or below MIN_VALUE go in a separate zero
+# count.
+
+# backend/api/distributions.py serves these; a test keeps its list in step
+SKETCH_MEASURES = ["fare_amount", "trip_speed_mph", "tip_percentage"]
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+MIN_VALUE = 1e-3
+
+# Bucket indexes are packed with the date, zone and measure into one
+# int64 key while loading; these bound each part.
+BUCKET_OFFSET = 2048
+ZERO_BUCKET = -BUCKET_OFFSET
+MAX_BUCKET = BUCKET_OFFSET - 1
+ZONE_SLOTS = 512
+MEASURE_SLOTS = 4
+
+# Columns of the rows passed to TripSketches.add
+SKETCH_COLUMNS = ["tpep_pickup_datetime", "PULocationID"] + SKETCH_MEASURES
+SKETCH_SOURCE_SQL = f"""
+    SELECT {", ".join(SKETCH_COLUMNS)}
+    FROM {{partition}}
+"""
+
+
+def sketch_gamma(conn):
+    """gamma the database's sketches were built with, or GAMMA for a new database"""
+    try:
+        row = conn.execute("SELECT gamma FROM sketch_settings").fetchone()
+    except sqlite3.OperationalError:
+        # Built before sketches existed
+        row = None
+    return row[0] if row else GAMMA
+
+
+def encode_counts(counts):
+    return np.asarray(counts, dtype="<u4").tobytes()
+
+
+def decode_counts(blob):
+    return np.frombuffer(blob, dtype="<u4")
+
+
+class TripSketches:
+    """Sketch counts for a stream of trips, written to trip_sketches by save().
+
+    Each added batch is reduced to unique (date, zone, measure, bucket)
+    keys with counts; the batches are merged whenever buffer_size keys
+    are pending, so memory follows the number of distinct buckets rather
+    than the number of trips.
+    """
+
+    def __init__(self, gamma=GAMMA, buffer_size=1 << 20):
+        self.gamma = gamma
+        self.log_gamma = np.log(gamma)
+        self.buffer_size = buffer_size
+        self.pending = []
+        self.pending_size = 0
+        self.keys = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+
+    def buckets(self, values):
+        buckets = np.full(len(values), ZERO_BUCKET, dtype=np.int64)
+        positive = values > MIN_VALUE
+        buckets[positive] = np.clip(
+            np.ceil(np.log(values[positive]) / self.log_gamma), ZERO_BUCKET + 1, MAX_BUCKET
+        )
+        return buckets
+
+    def add(self, rows):
+        """Count rows of (pickup datetime, PULocationID, *SKETCH_MEASURES); None values are skipped"""
+        if not rows:
+            return
+        pickups, zones, *columns = zip(*rows)
+        days = np.array([pickup[:10] for pickup in pickups], dtype="datetime64[D]").astype(np.int64)
+        zones = np.array(zones, dtype=np.int64)
+        for measure, column in enumerate(columns):
+            values = np.array(column, dtype=np.float64)
+            present = ~np.isnan(values)
+            group = (days[present] * ZONE_SLOTS + zones[present]) * MEASURE_SLOTS + measure
+            keys = group * (2 * BUCKET_OFFSET) + self.buckets(values[present]) + BUCKET_OFFSET
+            self.pending.append(keys)
+            self.pending_size += len(keys)
+        if self.pending_size >= self.buffer_size:
+            self.merge()
+
+    def merge(self):
+        if not self.pending:
+            return
+        new_keys, new_counts = np.unique(np.concatenate(self.pending), return_counts=True)
+        keys, inverse = np.unique(np.concatenate([self.keys, new_keys]), return_inverse=True)
+        counts = np.bincount(inverse, weights=np.concatenate([self.counts, new_counts]))
+        self.keys, self.counts = keys, counts.astype(np.int64)
+        self.pending = []
+        self.pending_size = 0
+
+    def sketches(self):
+        """Yield (pickup_date, PULocationID, measure, zero_count, min_bucket, counts) per sketch"""
+        self.merge()
+        if not len(self.keys):
+            return
+        groups, buckets = np.divmod(self.keys, 2 * BUCKET_OFFSET)
+        buckets -= BUCKET_OFFSET
+        # Keys are sorted, so each sketch is a run of equal groups
+        starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+        ends = np.r_[starts[1:], len(groups)]
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            day_zone, measure = divmod(int(groups[start]), MEASURE_SLOTS)
+            day, zone = divmod(day_zone, ZONE_SLOTS)
+            sketch_buckets, sketch_counts = buckets[start:end], self.counts[start:end]
+            zero_count = int(sketch_counts[0]) if sketch_buckets[0] == ZERO_BUCKET else 0
+            if zero_count:
+                sketch_buckets, sketch_counts = sketch_buckets[1:], sketch_counts[1:]
+            min_bucket = int(sketch_buckets[0]) if len(sketch_buckets) else 0
+            dense = np.zeros(int(sketch_buckets[-1]) - min_bucket + 1 if len(sketch_buckets) else 0, dtype=np.int64)
+            dense[sketch_buckets - min_bucket] = sketch_counts
+            yield str(np.datetime64(day, "D")), zone, SKETCH_MEASURES[measure], zero_count, min_bucket, dense
+
+    def save(self, conn):
+        """Add these counts to trip_sketches, merging with sketches already stored"""
+        conn.execute(
+            "INSERT OR IGNORE INTO sketch_settings (id, relative_accuracy, gamma) VALUES (1, ?, ?);",
+            ((self.gamma - 1) / (self.gamma + 1), self.gamma),
+        )
+        for pickup_date, zone, measure, zero_count, min_bucket, counts in self.sketches():
+            stored = conn.execute(
+                "SELECT zero_count, min_bucket, counts FROM trip_sketches"
+                " WHERE pickup_date = ? AND PULocationID = ? AND measure = ?",
+                (pickup_date, zone, measure),
+            ).fetchone()
+            if stored:
+                zero_count, min_bucket, counts = add_sketch(zero_count, min_bucket, counts, *stored)
+            conn.execute(
+                "INSERT OR REPLACE INTO trip_sketches"
+                " (pickup_date, PULocationID, measure, zero_count, min_bucket, counts) VALUES (?, ?, ?, ?, ?, ?);",
+                (pickup_date, zone, measure, zero_count, min_bucket, encode_counts(counts)),
+            )
+        self.keys = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+
+
+def add_sketch(zero_count, min_bucket, counts, stored_zero_count, stored_min_bucket, stored_blob):
+    """Sum of a sketch and a stored one, as (zero_count, min_bucket, counts)"""
+    stored = decode_counts(stored_blob)
+    if not len(stored):
+        return zero_count + stored_zero_count, min_bucket, counts
+    if not len(counts):
+        return zero_count + stored_zero_count, stored_min_bucket, stored.astype(np.int64)
+    low = min(min_bucket, stored_min_bucket)
+    high = max(min_bucket + len(counts), stored_min_bucket + len(stored))
+    merged = np.zeros(high - low, dtype=np.int64)
+    merged[min_bucket - low:min_bucket - low + len(counts)] += counts
+    merged[stored_min_bucket - low:stored_min_bucket - low + len(stored)] += stored
+    return zero_count + stored_zero_count, low, merged
+
+
+def rebuild_sketches(conn, batch_size=100_000):
+    """Recompute trip_sketches from every trip partition"""
+    conn.execute("DELETE FROM trip_sketches;")
+    sketches = TripSketches(sketch_gamma(conn))
+    for (partition,) in conn.execute("SELECT table_name FROM trip_partitions").fetchall():
+        cursor = conn.execute(SKETCH_SOURCE_SQL.format(partition=partition))
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            sketches.add(rows)
+    sketches.save(conn)
+
+
+def backfill_sketches(conn):
+    """Build trip_sketches for a database loaded before it existed"""
+    if conn.execute("SELECT 1 FROM trip_sketches LIMIT 1").fetchone() is None:
+        rebuild_sketches(conn)
+
+
+if __name__ == "__main__":
+    # Adds the sketch tables to an existing database if needed
+    import os
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    conn = sqlite3.connect(os.path.join(base_dir, "nyc_taxi.db"))
+    with open(os.path.join(base_dir, "schema.sql")) as f:
+        conn.executescript(f.read())
+    print("Rebuilding quantile sketches...")
+    rebuild_sketches(conn)
+    conn.commit()
+    conn.close()
+    print("Done.")
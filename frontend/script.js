@@ -7,6 +7,7 @@ const state = {
     view: 'dashboard',
     page: 1,
     pageSize: 50,
+    cursors: [''],  // cursors[n] opens page n + 1; null once there are no more pages
     charts: {},
     data: {}
 };
@@ -60,7 +61,16 @@ const api = {
     timeCategories: () => api.fetch('/stats/time-categories'),
     fareDistribution: () => api.fetch('/stats/fare-distribution'),
     routes: () => api.fetch('/stats/top-routes'),
-    trips: (limit, offset) => api.fetch(`/trips?limit=${limit}&offset=${offset}`)
+    batch: (...metrics) => api.fetch(`/stats/batch?metrics=${metrics.join(',')}`),
+    trips: (limit, cursor) => api.fetch(`/trips?limit=${limit}&cursor=${encodeURIComponent(cursor)}&${tripFilters()}`)
+};
+
+// Search params for the data view's filters, shared by the trips table and the CSV export
+const tripFilters = () => {
+    const params = new URLSearchParams();
+    const zone = ui.get('search-input')?.value.trim();
+    if (zone) params.set('pickup_zone', zone);
+    return params;
 };
 
 
@@ -179,17 +189,18 @@ const views = {
     async dashboard() {
         ui.show('loader');
 
-        const [summary, hourly, boroughs] = await Promise.all([
-            api.summary(),
-            api.hourly(),
-            api.boroughRevenue()
-        ]);
+        // One round trip; summary and overview come from the same totals.
+        const { summary, overview, hourly, boroughs } = await api.batch('summary', 'overview', 'hourly', 'boroughs') || {};
+        state.data.hourly = hourly;
+        state.data.boroughs = boroughs;
 
         if (summary) {
             ui.setText('stat-trips', format.num(summary.total_trips));
             ui.setText('stat-revenue', format.curr(summary.total_revenue));
             ui.setText('stat-fare', format.curr(summary.avg_fare));
-            ui.setText('stat-speed', `${format.dec(summary.avg_speed)} mph`);
+        }
+        if (overview) {
+            ui.setText('stat-speed', `${format.dec(overview.avg_speed)} mph`);
         }
 
         if (hourly) {
@@ -215,10 +226,8 @@ const views = {
     async analytics() {
         ui.show('loader');
         
-        const [daily, timeCategories] = await Promise.all([
-            api.daily(),
-            api.timeCategories()
-        ]);
+        const { daily, 'time-categories': timeCategories } = await api.batch('daily', 'time-categories') || {};
+        state.data.timeCategories = timeCategories;
         
         if (daily) {
             charts.line(
@@ -258,9 +267,12 @@ const views = {
     async insights() {
         ui.show('loader');
         
-        if (!state.data.hourly) state.data.hourly = await api.hourly();
-        if (!state.data.boroughs) state.data.boroughs = await api.boroughRevenue();
-        if (!state.data.timeCategories) state.data.timeCategories = await api.timeCategories();
+        if (!state.data.hourly || !state.data.boroughs || !state.data.timeCategories) {
+            const batch = await api.batch('hourly', 'boroughs', 'time-categories') || {};
+            state.data.hourly = batch.hourly;
+            state.data.boroughs = batch.boroughs;
+            state.data.timeCategories = batch['time-categories'];
+        }
         
         const { hourly, boroughs, timeCategories } = state.data;
         
@@ -332,15 +344,15 @@ const views = {
     
     async data() {
         ui.show('loader');
-        const offset = (state.page - 1) * state.pageSize;
-        const [trips, routes] = await Promise.all([
-            api.trips(state.pageSize, offset),
+        const [page, routes] = await Promise.all([
+            api.trips(state.pageSize, state.cursors[state.page - 1]),
             api.routes()
         ]);
 
-        if (trips) {
+        if (page) {
+            const trips = page.trips;
+            state.cursors[state.page] = page.next_cursor;
             state.data.trips = trips; // store for CSV export
-            state.data.trips = trips;
             const tbody = ui.get('data-tbody');
             tbody.innerHTML = '';
             trips.forEach(trip => {
@@ -432,19 +444,13 @@ const navigate = (view) => {
 // CSV EXPORT
 
 const exportCSV = () => {
-    const data = state.data.trips;
-    if (!data || data.length === 0) { alert('No data to export'); return; }
-
-    const headers = ['ID', 'Time', 'Pickup', 'Dropoff', 'Distance', 'Fare', 'Speed'];
-    const rows = data.map(t => [t.trip_id, t.pickup_datetime, t.pickup_borough, t.dropoff_borough, t.distance, t.fare, t.speed]);
-    const csv = [headers, ...rows].map(r => r.join(',')).join('\n');
-    const blob = new Blob([csv], { type: 'text/csv' });
-    const url = URL.createObjectURL(blob);
+    // The API streams every trip matching the filters, not just the rows on screen.
+    const params = tripFilters();
+    params.set('format', 'csv');
     const a = document.createElement('a');
-    a.href = url;
+    a.href = `${API_BASE}/trips/export?${params}`;
     a.download = `nyc-taxi-${Date.now()}.csv`;
     a.click();
-    URL.revokeObjectURL(url);
 };
 
 // INIT
@@ -457,33 +463,9 @@ const init = () => {
     ui.get('refresh-btn')?.addEventListener('click', () => { if (views[state.view]) views[state.view](); });
     ui.get('export-btn')?.addEventListener('click', exportCSV);
     ui.get('prev-btn')?.addEventListener('click', () => { if (state.page > 1) { state.page--; views.data(); } });
-    ui.get('next-btn')?.addEventListener('click', () => { state.page++; views.data(); });
-    ui.get('apply-filter')?.addEventListener('click', () => { state.page = 1; views.data(); });
+    ui.get('next-btn')?.addEventListener('click', () => { if (state.cursors[state.page]) { state.page++; views.data(); } });
+    ui.get('apply-filter')?.addEventListener('click', () => { state.page = 1; state.cursors = ['']; views.data(); });
 
-    
-    ui.get('refresh-btn')?.addEventListener('click', () => {
-        if (views[state.view]) views[state.view]();
-    });
-    
-    ui.get('export-btn')?.addEventListener('click', exportCSV);
-    
-    ui.get('prev-btn')?.addEventListener('click', () => {
-        if (state.page > 1) {
-            state.page--;
-            views.data();
-        }
-    });
-    
-    ui.get('next-btn')?.addEventListener('click', () => {
-        state.page++;
-        views.data();
-    });
-    
-    ui.get('apply-filter')?.addEventListener('click', () => {
-        state.page = 1;
-        views.data();
-    });
-    
     navigate('dashboard');
 };
 